@@ -0,0 +1,190 @@
+# testing/benchmarks/pipeline_stages.py
+#
+# Stage-level timings of the trip-planning pipeline: every mode's r5r call and its
+# R-side stages (park-and-ride sub-steps included), the Arrow -> pandas transfer,
+# post-processing, and the response work of main.process_input (sanitizing,
+# build_transport_structure, JSON encoding, CSV archiving). Origin/destination
+# pairs are sampled from metz_points_of_interest.csv with a fixed seed.
+#
+#   cd test_isit && python -m benchmarks.pipeline_stages run --data-path metz/metz --save benchmarks/baselines/main.json
+#   cd test_isit && python -m benchmarks.pipeline_stages run --data-path metz/metz --baseline benchmarks/baselines/main.json
+#   cd test_isit && python -m benchmarks.pipeline_stages compare benchmarks/baselines/main.json current.json
+#
+# Results are JSON (one entry per stage: count, median, p90 and mean in ms). Comparing
+# against a baseline prints the change per stage and exits with status 1 when a
+# stage's median got slower than --threshold, so it can gate a deployment.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import functions
+from main import sanitize_trip_summary, build_transport_structure, iter_transport_json, GEOMETRY_PRECISION
+
+
+def sample_pairs(data_path, count, seed):
+    """
+    `count` distinct origin/destination pairs ("lat,lon" strings) of points of interest.
+    """
+    points = pd.read_csv(os.path.join(data_path, "metz_points_of_interest.csv")).dropna(subset=["lat", "lon"])
+    coords = sorted({f"{lat},{lon}" for lat, lon in zip(points["lat"], points["lon"])})
+    rng = random.Random(seed)
+    pairs = set()
+    while len(pairs) < min(count, len(coords) * (len(coords) - 1)):
+        origin, destination = rng.sample(coords, 2)
+        pairs.add((origin, destination))
+    return sorted(pairs)
+
+
+def timed(samples, stage, call, *args, **kwargs):
+    started = time.perf_counter()
+    result = call(*args, **kwargs)
+    samples.setdefault(stage, []).append(time.perf_counter() - started)
+    return result
+
+
+def route_pair(samples, data_path, origin, destination, executor, archive_dir):
+    trip_summary_df = timed(samples, "process_r5r", functions.process_r5r, data_path, origin, destination, executor=executor)
+    stage_seconds = trip_summary_df.attrs.get("stage_seconds", {})
+    for mode_label, mode_stages in stage_seconds.get("modes", {}).items():
+        for stage, seconds in mode_stages.items():
+            samples.setdefault(f"mode.{mode_label}.{stage}", []).append(seconds)
+    if "concat" in stage_seconds:
+        samples.setdefault("process_r5r.concat", []).append(stage_seconds["concat"])
+    if trip_summary_df.empty:
+        return
+
+    records, issues_log = timed(samples, "response.sanitize", sanitize_trip_summary, trip_summary_df)
+    timed(samples, "response.build_transport_structure", build_transport_structure, records)
+    extra_fields = {"departure_time": functions.DEFAULT_DEPARTURE_DATETIME, "geometry_encoding": "wkt",
+                    "geometry_precision": GEOMETRY_PRECISION["wkt"], "issues_detected": bool(issues_log), "log": issues_log}
+    timed(samples, "response.json_encode", lambda: b"".join(iter_transport_json(records, extra_fields)))
+    archived_path = timed(samples, "response.archive_csv", functions.archive_trip_summary, trip_summary_df, archive_dir)
+    timed(samples, "response.read_csv", pd.read_csv, archived_path)
+
+
+def summarize(samples):
+    stages = {}
+    for stage, values in sorted(samples.items()):
+        values_ms = sorted(value * 1000 for value in values)
+        stages[stage] = {
+            "count": len(values_ms),
+            "median_ms": round(statistics.median(values_ms), 3),
+            "p90_ms": round(values_ms[min(len(values_ms) - 1, int(0.9 * len(values_ms)))], 3),
+            "mean_ms": round(statistics.fmean(values_ms), 3),
+        }
+    return stages
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    pairs = sample_pairs(args.data_path, args.pairs, args.seed)
+    executor = functions.create_routing_pool(args.data_path, args.workers) if args.workers else None
+    load_seconds = functions.init_r5r_core(args.data_path) if executor is None else {}
+    samples = {}
+    try:
+        with tempfile.TemporaryDirectory() as archive_dir:
+            # The first trips pay for JIT compilation and lazily built tables; keep them out of the samples.
+            for origin, destination in pairs[:args.warmup]:
+                route_pair({}, args.data_path, origin, destination, executor, archive_dir)
+            for _ in range(args.repeat):
+                for pair_idx, (origin, destination) in enumerate(pairs):
+                    print(f"[{pair_idx + 1}/{len(pairs)}] {origin} -> {destination}", file=sys.stderr)
+                    route_pair(samples, args.data_path, origin, destination, executor, archive_dir)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "data_path": os.path.abspath(args.data_path),
+        "pairs": len(pairs),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "workers": args.workers,
+        "load_seconds": load_seconds,
+        "stages": summarize(samples),
+    }
+
+
+def compare(baseline, current, threshold, min_delta_ms):
+    """
+    Prints the median change of every stage and returns the stages that regressed:
+    slower by more than threshold (relative) and min_delta_ms (absolute).
+    """
+    regressions = []
+    print(f"baseline {baseline.get('git_revision')} ({baseline.get('created_at')}) -> "
+          f"current {current.get('git_revision')} ({current.get('created_at')})")
+    print(f"{'stage':<52} {'baseline ms':>12} {'current ms':>12} {'change':>9}")
+    for stage in sorted(set(baseline["stages"]) | set(current["stages"])):
+        before, after = baseline["stages"].get(stage), current["stages"].get(stage)
+        if before is None or after is None:
+            print(f"{stage:<52} {before['median_ms'] if before else '-':>12} {after['median_ms'] if after else '-':>12} {'n/a':>9}")
+            continue
+        delta_ms = after["median_ms"] - before["median_ms"]
+        change = delta_ms / before["median_ms"] if before["median_ms"] else 0.0
+        regressed = change > threshold and delta_ms > min_delta_ms
+        if regressed:
+            regressions.append(stage)
+        print(f"{stage:<52} {before['median_ms']:>12.3f} {after['median_ms']:>12.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def load(path):
+    with open(path) as result_file:
+        return json.load(result_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage-level benchmark of the trip-planning pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="replay sampled trips and record stage timings")
+    run_parser.add_argument("--data-path", required=True, help="r5r data directory containing metz_points_of_interest.csv")
+    run_parser.add_argument("--pairs", type=int, default=20)
+    run_parser.add_argument("--repeat", type=int, default=1, help="passes over the sampled pairs")
+    run_parser.add_argument("--warmup", type=int, default=2, help="pairs routed once before measuring")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--workers", type=int, default=0, help="routing worker processes (0 = this process only)")
+    run_parser.add_argument("--save", help="write the results to this JSON file")
+    run_parser.add_argument("--baseline", help="compare the results against this JSON file")
+    compare_parser = commands.add_parser("compare", help="compare two saved results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    for command_parser in (run_parser, compare_parser):
+        command_parser.add_argument("--threshold", type=float, default=0.15, help="relative slowdown counted as a regression")
+        command_parser.add_argument("--min-delta-ms", type=float, default=5.0, help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        current = run(args)
+        if args.save:
+            os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+            with open(args.save, "w") as result_file:
+                json.dump(current, result_file, indent=2)
+        baseline = load(args.baseline) if args.baseline else None
+        if baseline is None:
+            for stage, summary in current["stages"].items():
+                print(f"{stage:<52} median {summary['median_ms']:10.3f} ms   p90 {summary['p90_ms']:10.3f} ms   n={summary['count']}")
+    else:
+        baseline, current = load(args.baseline), load(args.current)
+
+    if baseline is not None:
+        regressions = compare(baseline, current, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed: {', '.join(regressions)}")
+            sys.exit(1)
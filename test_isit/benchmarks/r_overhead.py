@@ -0,0 +1,88 @@
+# testing/benchmarks/r_overhead.py
+#
+# Per-request R interpreter overhead of the routing path, before and after the
+# R helpers were hoisted into byte-compiled closures called through rpy2 handles.
+#
+#   cd test_isit && python -m benchmarks.r_overhead [--repeat 200] [--data-path metz/metz]
+#
+# Without --data-path only the interpreter work is measured (no JVM needed).
+# With it, every mode job is also timed end to end on a warm r5r_core.
+
+import argparse
+import statistics
+import time
+
+import rpy2.robjects as ro
+from rpy2.robjects import default_converter, globalenv, pandas2ri
+from rpy2.robjects.conversion import localconverter
+from rpy2.robjects.vectors import StrVector
+
+import functions
+
+LEGACY_LIBRARY_BLOCK = "library(data.table); library(lubridate)"
+LEGACY_GLOBALS = ("lat_ori_r_glob", "lon_ori_r_glob", "lat_des_r_glob", "lon_des_r_glob", "walk_time_r_glob",
+                  "max_trip_duration_r_glob", "transit_freq_window_min_r", "max_walk_time_itinerary_min_r",
+                  "max_access_time_min_r", "max_walk_to_stop_min_r")
+
+
+def legacy_request_overhead():
+    """
+    The R work one /process request used to do besides routing: library() blocks
+    for the five modes, ten globals set one by one, the park-and-ride source text
+    parsed for both park-and-ride modes, and pandas2ri.activate().
+    """
+    for _ in range(len(functions.MODE_LABELS)):
+        ro.r(LEGACY_LIBRARY_BLOCK)
+    for name in LEGACY_GLOBALS:
+        globalenv[name] = 1.0
+    for _ in functions.PARK_AND_RIDE_MODES:
+        ro.r["parse"](text=functions.R_OPTIMAL_PARK_AND_RIDE_LOGIC)
+    pandas2ri.activate()
+
+
+def hoisted_request_overhead(noop_handle):
+    """
+    The R work left per request: one typed call per mode on a compiled closure
+    (a no-op with route_direct_ipc's signature, so routing itself is excluded).
+    """
+    with localconverter(default_converter):
+        for _ in functions.MODE_LABELS:
+            noop_handle(49.1, 6.17, 49.12, 6.18, StrVector(["WALK", "TRANSIT"]), functions.DEFAULT_DEPARTURE_DATETIME, 20.0, 120.0, False)
+
+
+def time_call(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples)
+
+
+def report(label, median_ms, max_ms):
+    print(f"{label:<42} median {median_ms:8.3f} ms   max {max_ms:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request R overhead of the routing path.")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--data-path", default=None)
+    args = parser.parse_args()
+
+    ro.r("library(data.table); library(lubridate)")
+    noop_handle = ro.r("compiler::cmpfun(function(lat_ori, lon_ori, lat_des, lon_des, mode, departure_str, "
+                       "max_walk_time, max_trip_duration, shortest_path) raw(0))")
+    legacy = time_call(legacy_request_overhead, args.repeat)
+    hoisted = time_call(lambda: hoisted_request_overhead(noop_handle), args.repeat)
+    report("legacy per-request R setup", *legacy)
+    report("hoisted per-request R dispatch", *hoisted)
+    print(f"interpreter time removed per request: {legacy[0] - hoisted[0]:.3f} ms")
+
+    if args.data_path:
+        functions.init_r5r_core(args.data_path)
+        trip = {"lat_ori": 49.1196, "lon_ori": 6.1767, "lat_des": 49.1036, "lon_des": 6.2190,
+                "walk_time": 20, "bicycle_time": 20, "max_trip_duration": 120, "car_time": 5,
+                "transit_freq_window_min": 60}
+        for mode_label in functions.MODE_LABELS:
+            report(f"run_mode_job {mode_label}", *time_call(
+                lambda: functions.run_mode_job(args.data_path, mode_label, trip), max(1, args.repeat // 20)))
@@ -1,28 +1,46 @@
 # testing/functions.py
 
 import pandas as pd
+import numpy as np
 import uuid
 import os
+import glob
+import time
+import random
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 os.environ['R_HOME'] = '/usr/lib/R'
 os.environ['JAVA_HOME'] = '/usr/lib/jvm/java-21-openjdk-amd64'
 os.environ['LD_LIBRARY_PATH'] = '/usr/lib/jvm/java-21-openjdk-amd64/lib/server'
 
-import rpy2
-import rpy2.robjects as ro
-from rpy2.robjects.packages import importr
-from rpy2.robjects import r, pandas2ri, globalenv
-from rpy2.robjects.vectors import StrVector, FloatVector
-from rpy2.robjects import default_converter
-import rpy2.robjects.conversion as conversion
-from shapely.wkt import loads
+# Only the r5r routing backend needs R; the replay backend (ROUTING_BACKEND=replay) runs without it.
+try:
+    import rpy2
+    import rpy2.robjects as ro
+    from rpy2.robjects.packages import importr
+    from rpy2.robjects import r, globalenv
+    from rpy2.robjects.vectors import StrVector, FloatVector
+    from rpy2.robjects import default_converter
+    from rpy2.robjects.conversion import localconverter
+    RPY2_IMPORT_ERROR = None
+except (ImportError, OSError, RuntimeError) as exc:
+    ro = None
+    RPY2_IMPORT_ERROR = exc
+import pyarrow as pa
+import shapely
 import warnings
+from service_index import TransitServiceIndex
 # warnings.filterwarnings('ignore')
 warnings.filterwarnings("ignore", category=DeprecationWarning)
-ro.r("options(warn=-1)")
+if ro is not None:
+    ro.r("options(warn=-1)")
 
-# R code for optimal park and ride logic
-R_OPTIMAL_PARK_AND_RIDE_LOGIC = """
+# R code for the GTFS timetable index, built once per R session.
+# stop_times are keyed by (service_id, stop_id, departure_s) so that frequency
+# lookups are binary searches instead of full-table scans.
+R_GTFS_TIMETABLE_INDEX = """
     get_gtfs_dir <- function(base_data_path) {
       zip_files <- list.files(base_data_path, pattern = "\\\\.zip$", ignore.case = TRUE, full.names = TRUE)
       gtfs_zip_candidates <- character(0)
@@ -36,13 +54,27 @@ R_OPTIMAL_PARK_AND_RIDE_LOGIC = """
       }
       if (length(gtfs_zip_candidates) > 0) {
         selected_zip <- gtfs_zip_candidates[1]
-        temp_gtfs_dir <- tempfile(pattern = "gtfs_unzipped_")
-        dir.create(temp_gtfs_dir, showWarnings = FALSE)
-        tryCatch(unzip(selected_zip, exdir = temp_gtfs_dir), error = function(e) stop(paste("Failed to unzip GTFS file:", selected_zip, "\\nError: ", e$message)))
-        if (check_files_exist(temp_gtfs_dir, required_core_gtfs_files)) return(temp_gtfs_dir)
-        subdirs_in_zip <- list.dirs(temp_gtfs_dir, recursive = FALSE, full.names = TRUE)
+        # Extractions are cached by the zip's content hash, so every request and process shares one copy
+        # and a changed feed gets a fresh directory while the stale ones are evicted.
+        cache_root <- Sys.getenv("GTFS_CACHE_DIR", file.path(base_data_path, ".gtfs_cache"))
+        dir.create(cache_root, showWarnings = FALSE, recursive = TRUE)
+        zip_stem <- tools::file_path_sans_ext(basename(selected_zip))
+        cached_gtfs_dir <- file.path(cache_root, paste0(zip_stem, "_", unname(tools::md5sum(selected_zip))))
+        if (!dir.exists(cached_gtfs_dir)) {
+          staging_dir <- tempfile(pattern = paste0(zip_stem, "_staging_"), tmpdir = cache_root)
+          dir.create(staging_dir, showWarnings = FALSE)
+          tryCatch(unzip(selected_zip, exdir = staging_dir), error = function(e) { unlink(staging_dir, recursive = TRUE); stop(paste("Failed to unzip GTFS file:", selected_zip, "\\nError: ", e$message)) })
+          # rename() is atomic; if another process published the same hash first, keep theirs.
+          if (!file.rename(staging_dir, cached_gtfs_dir)) unlink(staging_dir, recursive = TRUE)
+          cached_entries <- list.dirs(cache_root, recursive = FALSE, full.names = TRUE)
+          stale_entries <- cached_entries[startsWith(basename(cached_entries), paste0(zip_stem, "_")) & grepl("_[0-9a-f]{32}$", basename(cached_entries)) & cached_entries != cached_gtfs_dir]
+          abandoned_staging <- cached_entries[grepl("_staging_", basename(cached_entries)) & difftime(Sys.time(), file.info(cached_entries)$mtime, units = "hours") > 1]
+          unlink(c(stale_entries, abandoned_staging), recursive = TRUE)
+        }
+        if (check_files_exist(cached_gtfs_dir, required_core_gtfs_files)) return(cached_gtfs_dir)
+        subdirs_in_zip <- list.dirs(cached_gtfs_dir, recursive = FALSE, full.names = TRUE)
         for (s_dir in subdirs_in_zip) if (check_files_exist(s_dir, required_core_gtfs_files)) return(s_dir)
-        unlink(temp_gtfs_dir, recursive = TRUE); stop("Unzipped GTFS archive '", selected_zip, "' but could not find required GTFS .txt files.")
+        unlink(cached_gtfs_dir, recursive = TRUE); stop("Unzipped GTFS archive '", selected_zip, "' but could not find required GTFS .txt files.")
       }
       if (check_files_exist(base_data_path, required_core_gtfs_files)) return(base_data_path)
       subdirs_of_base <- list.dirs(base_data_path, recursive = FALSE, full.names = TRUE)
@@ -50,464 +82,1441 @@ R_OPTIMAL_PARK_AND_RIDE_LOGIC = """
       stop("Could not find GTFS data (zip or unzipped .txt files) in or around '", base_data_path, "'.")
     }
 
-    calculate_stop_frequencies <- function(stop_ids_to_query, gtfs_dir, current_datetime_param,
-                                           time_window_minutes = 60, desired_route_types = c(0, 3)) { # time_window_minutes is transit_freq_window_min_r
-      if (length(stop_ids_to_query) == 0) return(data.table(stop_id = character(0), frequency_count = integer(0)))
-      stops_txt <- fread(file.path(gtfs_dir, "stops.txt")); stop_times_txt <- fread(file.path(gtfs_dir, "stop_times.txt"))
-      trips_txt <- fread(file.path(gtfs_dir, "trips.txt")); routes_txt <- fread(file.path(gtfs_dir, "routes.txt"))
-      calendar_txt <- if (file.exists(file.path(gtfs_dir, "calendar.txt"))) fread(file.path(gtfs_dir, "calendar.txt")) else NULL
-      calendar_dates_txt <- if (file.exists(file.path(gtfs_dir, "calendar_dates.txt"))) fread(file.path(gtfs_dir, "calendar_dates.txt")) else NULL
-      if (is.null(calendar_txt) && is.null(calendar_dates_txt)) stop("GTFS error: Neither calendar.txt nor calendar_dates.txt found.")
-      current_date_nodash <- format(current_datetime_param, "%Y%m%d"); current_day_of_week <- tolower(weekdays(current_datetime_param))
+    gtfs_weekday_columns <- c("sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday")
+
+    compute_active_service_ids <- function(calendar_txt, calendar_dates_txt, service_date_nodash) {
+      day_of_week <- gtfs_weekday_columns[as.POSIXlt(as.Date(service_date_nodash, format = "%Y%m%d"))$wday + 1]
       active_service_ids <- character(0)
-      if (!is.null(calendar_txt) && current_day_of_week %in% names(calendar_txt)) {
-        active_service_ids <- c(active_service_ids, calendar_txt[get(current_day_of_week) == 1 & start_date <= current_date_nodash & end_date >= current_date_nodash, service_id])
+      if (!is.null(calendar_txt) && day_of_week %in% names(calendar_txt)) {
+        active_service_ids <- c(active_service_ids, calendar_txt[get(day_of_week) == "1" & start_date <= service_date_nodash & end_date >= service_date_nodash, service_id])
       }
       if (!is.null(calendar_dates_txt)) {
-        active_service_ids <- c(active_service_ids, calendar_dates_txt[date == current_date_nodash & exception_type == 1, service_id])
-        active_service_ids <- setdiff(active_service_ids, calendar_dates_txt[date == current_date_nodash & exception_type == 2, service_id])
+        active_service_ids <- c(active_service_ids, calendar_dates_txt[date == service_date_nodash & exception_type == "1", service_id])
+        active_service_ids <- setdiff(active_service_ids, calendar_dates_txt[date == service_date_nodash & exception_type == "2", service_id])
+      }
+      unique(active_service_ids)
+    }
+
+    build_gtfs_timetable_index <- function(gtfs_dir) {
+      read_optional <- function(name) if (file.exists(file.path(gtfs_dir, name))) fread(file.path(gtfs_dir, name), colClasses = "character") else NULL
+      calendar_txt <- read_optional("calendar.txt"); calendar_dates_txt <- read_optional("calendar_dates.txt")
+      if (is.null(calendar_txt) && is.null(calendar_dates_txt)) stop("GTFS error: Neither calendar.txt nor calendar_dates.txt found.")
+
+      stops_dt <- fread(file.path(gtfs_dir, "stops.txt"), colClasses = list(character = "stop_id"))
+      if (!"stop_id" %in% names(stops_dt)) stop("GTFS stops.txt needs a 'stop_id' column.")
+      if (!all(c("stop_lon", "stop_lat") %in% names(stops_dt))) stop("GTFS stops.txt needs 'stop_lon'/'stop_lat'.")
+      stops_for_r5r <- stops_dt[, .(id = stop_id, lon = as.numeric(stop_lon), lat = as.numeric(stop_lat))]
+
+      trips_txt <- fread(file.path(gtfs_dir, "trips.txt"), select = c("route_id", "service_id", "trip_id"), colClasses = "character")
+      routes_txt <- fread(file.path(gtfs_dir, "routes.txt"), select = c("route_id", "route_type"), colClasses = list(character = "route_id"))
+      trips_txt <- merge(trips_txt, routes_txt, by = "route_id", all.x = TRUE)
+
+      stop_times_txt <- fread(file.path(gtfs_dir, "stop_times.txt"), select = c("trip_id", "stop_id", "departure_time"), colClasses = "character")
+      hms <- tstrsplit(stop_times_txt$departure_time, ":", fixed = TRUE)
+      if (length(hms) < 3) stop("GTFS error: stop_times.txt departure_time is not in HH:MM:SS format.")
+      stop_times_txt[, departure_s := as.integer(hms[[1]]) * 3600L + as.integer(hms[[2]]) * 60L + as.integer(hms[[3]])]
+      stop_times_txt <- stop_times_txt[!is.na(departure_s), .(trip_id, stop_id, departure_s)]
+      stop_times_txt[trips_txt, on = "trip_id", `:=`(service_id = i.service_id, route_type = i.route_type)]
+      stop_times_txt <- stop_times_txt[!is.na(service_id), .(service_id, stop_id, departure_s, route_type)]
+      setkey(stop_times_txt, service_id, stop_id, departure_s)
+
+      service_dates <- character(0)
+      if (!is.null(calendar_txt) && nrow(calendar_txt) > 0) {
+        service_dates <- format(seq(as.Date(min(calendar_txt$start_date), format = "%Y%m%d"), as.Date(max(calendar_txt$end_date), format = "%Y%m%d"), by = "day"), "%Y%m%d")
       }
-      active_service_ids <- unique(active_service_ids)
+      if (!is.null(calendar_dates_txt)) service_dates <- unique(c(service_dates, calendar_dates_txt$date))
+      active_services <- new.env(hash = TRUE)
+      for (service_date in service_dates) assign(service_date, compute_active_service_ids(calendar_txt, calendar_dates_txt, service_date), envir = active_services)
+
+      list(stop_times = stop_times_txt, stops_for_r5r = stops_for_r5r, active_services = active_services,
+           calendar = calendar_txt, calendar_dates = calendar_dates_txt, source_dir = gtfs_dir)
+    }
+
+    get_active_service_ids <- function(gtfs_index, current_datetime_param) {
+      service_date_nodash <- format(current_datetime_param, "%Y%m%d")
+      if (!exists(service_date_nodash, envir = gtfs_index$active_services, inherits = FALSE)) {
+        assign(service_date_nodash, compute_active_service_ids(gtfs_index$calendar, gtfs_index$calendar_dates, service_date_nodash), envir = gtfs_index$active_services)
+      }
+      get(service_date_nodash, envir = gtfs_index$active_services, inherits = FALSE)
+    }
+
+    calculate_stop_frequencies <- function(stop_ids_to_query, gtfs_index, current_datetime_param,
+                                           time_window_minutes = 60, desired_route_types = c(0, 3)) { # time_window_minutes is transit_freq_window_min_r
+      if (length(stop_ids_to_query) == 0) return(data.table(stop_id = character(0), frequency_count = integer(0)))
+      stop_ids_to_query <- as.character(stop_ids_to_query)
+      active_service_ids <- get_active_service_ids(gtfs_index, current_datetime_param)
       if (length(active_service_ids) == 0) { return(data.table(stop_id = stop_ids_to_query, frequency_count = 0)) }
-      relevant_routes <- routes_txt[route_type %in% desired_route_types, route_id]
-      active_trips <- trips_txt[service_id %in% active_service_ids & route_id %in% relevant_routes, trip_id]
-      if (length(active_trips) == 0) { return(data.table(stop_id = stop_ids_to_query, frequency_count = 0)) }
-      window_end_datetime <- current_datetime_param + lubridate::minutes(time_window_minutes) # Uses the parameter
-      service_day_midnight_posix <- floor_date(current_datetime_param, unit = "day")
-      stop_times_txt[, departure_time_char := as.character(departure_time)]
-      stop_times_txt[, departure_s_since_midnight := sapply(strsplit(departure_time_char, ":", fixed = TRUE), function(p) {
-        if (length(p) == 3 && !any(is.na(as.numeric(p)))) as.numeric(p[1])*3600 + as.numeric(p[2])*60 + as.numeric(p[3]) else NA_real_ })]
-      stop_times_txt <- stop_times_txt[!is.na(departure_s_since_midnight)]
-      stop_times_txt[, departure_posix := service_day_midnight_posix + lubridate::seconds(departure_s_since_midnight)]
-      relevant_stop_times <- stop_times_txt[stop_id %in% stop_ids_to_query & trip_id %in% active_trips & !is.na(departure_posix) & departure_posix >= current_datetime_param & departure_posix < window_end_datetime]
+      window_start_s <- as.integer(as.numeric(difftime(current_datetime_param, floor_date(current_datetime_param, unit = "day"), units = "secs")))
+      window_end_s <- window_start_s + as.integer(time_window_minutes * 60)
+      window_queries <- CJ(service_id = active_service_ids, stop_id = unique(stop_ids_to_query))
+      window_queries[, `:=`(window_start_s = window_start_s, window_end_s = window_end_s)]
+      relevant_stop_times <- gtfs_index$stop_times[window_queries, on = .(service_id, stop_id, departure_s >= window_start_s, departure_s < window_end_s),
+                                                   .(stop_id = x.stop_id, route_type = x.route_type), nomatch = NULL]
+      relevant_stop_times <- relevant_stop_times[route_type %in% desired_route_types]
       if (nrow(relevant_stop_times) == 0) { return(data.table(stop_id = stop_ids_to_query, frequency_count = 0)) }
       stop_frequencies_calculated <- relevant_stop_times[, .(frequency_count = .N), by = stop_id]
       all_stops_dt <- data.table(stop_id = stop_ids_to_query)
       stop_frequencies_final <- merge(all_stops_dt, stop_frequencies_calculated, by = "stop_id", all.x = TRUE)
       stop_frequencies_final[is.na(frequency_count), frequency_count := 0]; return(stop_frequencies_final)
     }
+"""
 
-    park_points_all <- fread(file.path(data_path_r, "bike_park_metz.csv"))
-    if (!all(c("id", "lon", "lat") %in% names(park_points_all))) stop("Parking CSV must have 'id', 'lon', 'lat' columns.")
-    park_points_all[, id := as.character(id)][, lon := as.numeric(lon)][, lat := as.numeric(lat)]
-    bike_parking_points <- unique(na.omit(park_points_all, cols = c("id", "lon", "lat")), by = "id")
-    if (nrow(bike_parking_points) == 0) stop("No valid parking points loaded after cleaning.")
-
-    ttm_origin_to_park <- travel_time_matrix(
-        r5r_core = .GlobalEnv$r5r_core_glob,
-        origins = .GlobalEnv$origin_r, 
-        destinations = bike_parking_points,
-        mode = .GlobalEnv$access_mode_r, 
-        max_trip_duration = .GlobalEnv$max_access_time_min_r + 5, 
-        departure_datetime = .GlobalEnv$departure_datetime_r, 
-        progress = FALSE
-    )
-    if (is.null(ttm_origin_to_park) || nrow(ttm_origin_to_park) == 0) stop(paste0("No parking points reachable by ", .GlobalEnv$access_mode_r, " from origin."))
-    time_col_name_from_r5r <- if ("travel_time_p50" %in% names(ttm_origin_to_park)) "travel_time_p50" else "travel_time"
-    setnames(ttm_origin_to_park, c("from_id", "to_id", time_col_name_from_r5r), c("from_id_origin", "to_id_park", "travel_time_access_min"))
-
-    reachable_parking_ids <- ttm_origin_to_park[travel_time_access_min <= .GlobalEnv$max_access_time_min_r, to_id_park]
-    favorable_parking_points <- bike_parking_points[id %in% reachable_parking_ids]
-    if (nrow(favorable_parking_points) == 0) stop(paste0("No parking points reachable within ", .GlobalEnv$max_access_time_min_r, " minutes by ", .GlobalEnv$access_mode_r, "."))
-    favorable_parking_points_sf <- st_as_sf(favorable_parking_points, coords = c("lon", "lat"), crs = 4326)
-
-    snapped_network_locs_raw <- find_snap(r5r_core = .GlobalEnv$r5r_core_glob, points = favorable_parking_points_sf)
-    if (is.null(snapped_network_locs_raw) || nrow(snapped_network_locs_raw) == 0) stop("find_snap (to network) returned no results.")
-    snapped_network_locs_dt <- as.data.table(snapped_network_locs_raw)
-    if (!"point_id" %in% names(snapped_network_locs_dt)) stop("find_snap output missing 'point_id'.")
-    if (!all(c("snap_lat", "snap_lon") %in% names(snapped_network_locs_dt))) stop("find_snap output missing 'snap_lat'/'snap_lon'.")
-    setnames(snapped_network_locs_dt, "point_id", "id")
-    snapped_network_origins_sf <- st_as_sf(snapped_network_locs_dt[!is.na(snap_lat) & !is.na(snap_lon)], coords = c("snap_lon", "snap_lat"), crs = 4326)
-    if (nrow(snapped_network_origins_sf) == 0) stop("No valid snapped network locations for transit stop search.")
-
-    gtfs_parsed_dir <- get_gtfs_dir(.GlobalEnv$data_path_r) 
-    gtfs_stops_dt <- fread(file.path(gtfs_parsed_dir, "stops.txt"))
-    if (!"id" %in% names(gtfs_stops_dt) && "stop_id" %in% names(gtfs_stops_dt)) setnames(gtfs_stops_dt, "stop_id", "id")
-    if (!"id" %in% names(gtfs_stops_dt)) stop("GTFS stops.txt needs 'id' or 'stop_id' column.")
-    if (!all(c("stop_lon", "stop_lat") %in% names(gtfs_stops_dt))) stop("GTFS stops.txt needs 'stop_lon'/'stop_lat'.")
-    setnames(gtfs_stops_dt, c("stop_lon", "stop_lat"), c("lon", "lat"), skip_absent = TRUE)
-    gtfs_stops_for_r5r <- gtfs_stops_dt[, .(id, lon, lat)]
-    walk_times_to_stops <- travel_time_matrix(
-        r5r_core = .GlobalEnv$r5r_core_glob,
-        origins = snapped_network_origins_sf,
-        destinations = gtfs_stops_for_r5r,
-        mode = "WALK",
-        max_trip_duration = .GlobalEnv$max_walk_to_stop_min_r,
-        departure_datetime = .GlobalEnv$departure_datetime_r,
-        progress = FALSE
-    )
-    if (is.null(walk_times_to_stops) || nrow(walk_times_to_stops) == 0) stop(paste0("No transit stops found within ", .GlobalEnv$max_walk_to_stop_min_r, " mins walk."))
-    time_col_name_from_r5r_walk <- if ("travel_time_p50" %in% names(walk_times_to_stops)) "travel_time_p50" else "travel_time"
-    setnames(walk_times_to_stops, c("from_id", "to_id", time_col_name_from_r5r_walk), c("from_id_park", "to_id_stop", "walk_time_to_stop_min"))
-
-    unique_snapped_stop_ids <- unique(walk_times_to_stops$to_id_stop)
-    
-    # Use .GlobalEnv$transit_freq_window_min_r when calling calculate_stop_frequencies
-    stop_frequencies <- calculate_stop_frequencies(unique_snapped_stop_ids, gtfs_parsed_dir, .GlobalEnv$departure_datetime_r, .GlobalEnv$transit_freq_window_min_r)
-    snapped_stops_with_freq <- merge(walk_times_to_stops, stop_frequencies, by.x = "to_id_stop", by.y = "stop_id", all.x = TRUE)
-    snapped_stops_with_freq[is.na(frequency_count), frequency_count := 0]
-    parking_best_stop_quality <- snapped_stops_with_freq[order(from_id_park, -frequency_count, walk_time_to_stop_min)]
-    parking_best_stop_quality <- parking_best_stop_quality[!duplicated(from_id_park)]
-    setnames(parking_best_stop_quality, c("to_id_stop", "walk_time_to_stop_min", "frequency_count"), c("best_stop_id", "walk_time_to_best_stop_min", "best_stop_frequency"))
-    parking_best_stop_quality <- parking_best_stop_quality[, .(from_id_park, best_stop_id, walk_time_to_best_stop_min, best_stop_frequency)]
-
-    ttm_park_to_dest <- travel_time_matrix(
-        r5r_core = .GlobalEnv$r5r_core_glob,
-        origins = favorable_parking_points,
-        destinations = .GlobalEnv$destination_r, 
-        mode = c("WALK", "TRANSIT"),
-        max_trip_duration = 100,
-        departure_datetime = .GlobalEnv$departure_datetime_r,
-        progress = FALSE
-    )
-    if (is.null(ttm_park_to_dest) || nrow(ttm_park_to_dest) == 0) stop("No transit routes from favorable parking to final destination.")
-    time_col_name_from_r5r_pt <- if ("travel_time_p50" %in% names(ttm_park_to_dest)) "travel_time_p50" else "travel_time"
-    setnames(ttm_park_to_dest, c("from_id", "to_id", time_col_name_from_r5r_pt), c("from_id_park_dest", "to_id_dest", "travel_time_pt_min"))
-
-    merged_times <- merge(ttm_origin_to_park[, .(id = to_id_park, travel_time_access_min)], favorable_parking_points[, .(id, lon, lat)], by = "id")
-    merged_times <- merge(merged_times, parking_best_stop_quality, by.x = "id", by.y = "from_id_park", all.x = TRUE)
-    if (!is.double(merged_times$walk_time_to_best_stop_min) && "walk_time_to_best_stop_min" %in% names(merged_times)) {
-      merged_times[, walk_time_to_best_stop_min := as.double(walk_time_to_best_stop_min)]
-    }
-    merged_times[is.na(best_stop_frequency), best_stop_frequency := 0]
-    merged_times[is.na(walk_time_to_best_stop_min), walk_time_to_best_stop_min := Inf]
-    merged_times <- merge(merged_times, ttm_park_to_dest[, .(id = from_id_park_dest, travel_time_pt_min)], by = "id", all.x = TRUE)
-    merged_times[is.na(travel_time_pt_min), travel_time_pt_min := Inf]
-    merged_times[, total_travel_time_min := travel_time_access_min + travel_time_pt_min]
-    merged_times_filtered <- merged_times[total_travel_time_min < Inf & walk_time_to_best_stop_min < Inf]
-    if (nrow(merged_times_filtered) == 0) stop("No valid park-and-ride options found after merging all criteria.")
-    setorderv(merged_times_filtered, c("total_travel_time_min", "best_stop_frequency", "walk_time_to_best_stop_min"), c(1, -1, 1))
-    optimal_parking_info <- merged_times_filtered[1]
-    if (is.na(optimal_parking_info$id)) stop("Could not determine an optimal parking point from filtered options.")
-    optimal_parking_id <- optimal_parking_info$id
-    optimal_parking <- bike_parking_points[id == optimal_parking_id]
-
-    det_origin_to_optimal_parking <- detailed_itineraries(
-        r5r_core = .GlobalEnv$r5r_core_glob,
-        origins = .GlobalEnv$origin_r,
-        destinations = optimal_parking,
-        mode = .GlobalEnv$access_mode_r,
-        departure_datetime = .GlobalEnv$departure_datetime_r,
-        max_walk_time = .GlobalEnv$max_walk_time_itinerary_min_r,
-        shortest_path = TRUE
-    )
-    det_parking_to_destination <- detailed_itineraries(
-        r5r_core = .GlobalEnv$r5r_core_glob,
-        origins = optimal_parking,
-        destinations = .GlobalEnv$destination_r,
-        mode = c("WALK", "TRANSIT"),
-        departure_datetime = .GlobalEnv$departure_datetime_r,
-        max_walk_time = .GlobalEnv$max_walk_time_itinerary_min_r,
-        shortest_path = TRUE
-    )
+# R code for moving itinerary tables to Python as an Arrow IPC stream.
+# sf geometries are sent as WKB binaries, so no WKT text is formatted or parsed.
+R_ARROW_TRANSFER = """
+    itinerary_to_arrow_ipc <- function(itinerary) {
+      if (is.null(itinerary) || nrow(itinerary) == 0) return(raw(0))
+      itinerary <- as.data.frame(itinerary)
+      geometry_wkb <- NULL
+      if ("geometry" %in% names(itinerary) && !is.character(itinerary$geometry)) {
+        geometry_wkb <- if (inherits(itinerary$geometry, "sfc")) unclass(sf::st_as_binary(itinerary$geometry)) else itinerary$geometry
+        itinerary$geometry <- NULL
+      }
+      itinerary_table <- arrow::arrow_table(itinerary)
+      if (!is.null(geometry_wkb)) itinerary_table$geometry <- arrow::Array$create(geometry_wkb, type = arrow::binary())
+      arrow::write_to_raw(itinerary_table, format = "stream")
+    }
+"""
+
+# R helpers shared by the single-trip park-and-ride logic and the batch routing functions.
+R_ROUTING_HELPERS = """
+    # Seconds spent per stage of the last routing call, read back from Python through
+    # last_stage_timings (see _call_r_ipc). A stage marked twice accumulates.
+    stage_clock <- new.env()
+    stage_reset <- function() {
+      stage_clock$timings <- numeric(0)
+      stage_clock$started <- proc.time()[["elapsed"]]
+    }
+    stage_mark <- function(stage) {
+      now <- proc.time()[["elapsed"]]
+      elapsed <- now - stage_clock$started
+      stage_clock$timings[[stage]] <- if (stage %in% names(stage_clock$timings)) stage_clock$timings[[stage]] + elapsed else elapsed
+      stage_clock$started <- now
+    }
+    last_stage_timings <- function() stage_clock$timings
+    stage_reset()
 
-    det_df_final <- data.frame() 
+    load_parking_points <- function(base_data_path) {
+      park_points_all <- fread(file.path(base_data_path, "bike_park_metz.csv"))
+      if (!all(c("id", "lon", "lat") %in% names(park_points_all))) stop("Parking CSV must have 'id', 'lon', 'lat' columns.")
+      park_points_all[, id := as.character(id)][, lon := as.numeric(lon)][, lat := as.numeric(lat)]
+      bike_parking_points <- unique(na.omit(park_points_all, cols = c("id", "lon", "lat")), by = "id")
+      if (nrow(bike_parking_points) == 0) stop("No valid parking points loaded after cleaning.")
+      bike_parking_points
+    }
 
-    if (!is.null(det_origin_to_optimal_parking) && nrow(det_origin_to_optimal_parking) > 0 &&
-        !is.null(det_parking_to_destination) && nrow(det_parking_to_destination) > 0) {
+    # Upper bounds on r5r travel speeds (km/h): its default walk (3.6) and bike (12) speeds, and the fastest
+    # road speed limit for cars. Straight-line distance never exceeds network distance, so a point farther
+    # than speed x time (+ snapping slop at both ends) cannot be reached and is dropped before r5r sees it.
+    mode_speed_bounds_kmh <- c(WALK = 5, BICYCLE = 15, CAR = 130)
+    candidate_snap_slop_m <- 2 * 1600
 
-        dt1 <- as.data.table(det_origin_to_optimal_parking)
-        if ("geometry" %in% names(dt1) && inherits(det_origin_to_optimal_parking$geometry, "sfc")) {
-            dt1[, geometry_wkt := sf::st_as_text(det_origin_to_optimal_parking$geometry)]
-            dt1[, geometry := NULL]
-        } else if ("geometry" %in% names(dt1) && is.character(dt1$geometry)) {
-            setnames(dt1, "geometry", "geometry_wkt")
-        }
+    candidate_radius_m <- function(mode, minutes) {
+      max(mode_speed_bounds_kmh[mode]) / 3.6 * 60 * minutes + candidate_snap_slop_m
+    }
 
-        dt2 <- as.data.table(det_parking_to_destination)
-        if ("geometry" %in% names(dt2) && inherits(det_parking_to_destination$geometry, "sfc")) {
-            dt2[, geometry_wkt := sf::st_as_text(det_parking_to_destination$geometry)]
-            dt2[, geometry := NULL]
-        } else if ("geometry" %in% names(dt2) && is.character(dt2$geometry)) {
-            setnames(dt2, "geometry", "geometry_wkt")
-        }
+    haversine_m <- function(lon1, lat1, lon2, lat2) {
+      to_rad <- pi / 180
+      a <- sin((lat2 - lat1) * to_rad / 2)^2 + cos(lat1 * to_rad) * cos(lat2 * to_rad) * sin((lon2 - lon1) * to_rad / 2)^2
+      2 * 6371000 * asin(pmin(1, sqrt(a)))
+    }
+
+    # Uniform lon/lat grid over a point table (id, lon, lat), built once per session.
+    build_point_grid <- function(points, cell_size_m = 1000) {
+      cell_deg_lat <- cell_size_m / 111320
+      cell_deg_lon <- cell_size_m / (111320 * cos(mean(points$lat) * pi / 180))
+      cells <- data.table(row = seq_len(nrow(points)),
+                          cx = as.integer(floor(points$lon / cell_deg_lon)),
+                          cy = as.integer(floor(points$lat / cell_deg_lat)))
+      setkey(cells, cx, cy)
+      list(points = points, cells = cells, cell_deg_lat = cell_deg_lat, cell_deg_lon = cell_deg_lon)
+    }
+
+    # Rows of grid$points within radius_m (great-circle) of at least one query point, in table order.
+    points_within <- function(grid, lon, lat, radius_m) {
+      if (length(lon) == 0 || nrow(grid$points) == 0) return(integer(0))
+      dlat <- radius_m / 111320
+      dlon <- radius_m / (111320 * cos(min(max(abs(lat)) + dlat, 89) * pi / 180))
+      offsets <- CJ(dx = -ceiling(dlon / grid$cell_deg_lon):ceiling(dlon / grid$cell_deg_lon),
+                    dy = -ceiling(dlat / grid$cell_deg_lat):ceiling(dlat / grid$cell_deg_lat))
+      queries <- data.table(qlon = lon, qlat = lat, qx = as.integer(floor(lon / grid$cell_deg_lon)), qy = as.integer(floor(lat / grid$cell_deg_lat)))
+      probes <- queries[rep(seq_len(.N), each = nrow(offsets))]
+      probes[, `:=`(cx = qx + rep(offsets$dx, nrow(queries)), cy = qy + rep(offsets$dy, nrow(queries)))]
+      candidates <- grid$cells[probes, on = c("cx", "cy"), nomatch = NULL]
+      candidates <- candidates[haversine_m(qlon, qlat, grid$points$lon[row], grid$points$lat[row]) <= radius_m]
+      sort(unique(candidates$row))
+    }
+
+    travel_time_column <- function(ttm) if ("travel_time_p50" %in% names(ttm)) "travel_time_p50" else "travel_time"
+
+    # Best nearby transit stop of each parking point: most departures in the frequency window, then shortest walk.
+    parking_stop_quality <- function(r5r_core, parking_points, gtfs_index, max_walk_to_stop, departure_datetime, freq_window) {
+      parking_points_sf <- st_as_sf(parking_points, coords = c("lon", "lat"), crs = 4326)
+      snapped_network_locs_raw <- find_snap(r5r_core = r5r_core, points = parking_points_sf)
+      if (is.null(snapped_network_locs_raw) || nrow(snapped_network_locs_raw) == 0) stop("find_snap (to network) returned no results.")
+      snapped_network_locs_dt <- as.data.table(snapped_network_locs_raw)
+      if (!"point_id" %in% names(snapped_network_locs_dt)) stop("find_snap output missing 'point_id'.")
+      if (!all(c("snap_lat", "snap_lon") %in% names(snapped_network_locs_dt))) stop("find_snap output missing 'snap_lat'/'snap_lon'.")
+      setnames(snapped_network_locs_dt, "point_id", "id")
+      snapped_network_origins_sf <- st_as_sf(snapped_network_locs_dt[!is.na(snap_lat) & !is.na(snap_lon)], coords = c("snap_lon", "snap_lat"), crs = 4326)
+      if (nrow(snapped_network_origins_sf) == 0) stop("No valid snapped network locations for transit stop search.")
+      candidate_stops <- gtfs_index$stops_for_r5r
+      if (!is.null(gtfs_index$stop_grid)) {
+        snapped_coords <- st_coordinates(snapped_network_origins_sf)
+        candidate_stops <- candidate_stops[points_within(gtfs_index$stop_grid, snapped_coords[, "X"], snapped_coords[, "Y"], candidate_radius_m("WALK", max_walk_to_stop))]
+        if (nrow(candidate_stops) == 0) stop(paste0("No transit stops found within ", max_walk_to_stop, " mins walk."))
+      }
+
+      walk_times_to_stops <- travel_time_matrix(
+          r5r_core = r5r_core,
+          origins = snapped_network_origins_sf,
+          destinations = candidate_stops,
+          mode = "WALK",
+          max_trip_duration = max_walk_to_stop,
+          departure_datetime = departure_datetime,
+          progress = FALSE
+      )
+      if (is.null(walk_times_to_stops) || nrow(walk_times_to_stops) == 0) stop(paste0("No transit stops found within ", max_walk_to_stop, " mins walk."))
+      setnames(walk_times_to_stops, c("from_id", "to_id", travel_time_column(walk_times_to_stops)), c("from_id_park", "to_id_stop", "walk_time_to_stop_min"))
+
+      stop_frequencies <- calculate_stop_frequencies(unique(walk_times_to_stops$to_id_stop), gtfs_index, departure_datetime, freq_window)
+      snapped_stops_with_freq <- merge(walk_times_to_stops, stop_frequencies, by.x = "to_id_stop", by.y = "stop_id", all.x = TRUE)
+      snapped_stops_with_freq[is.na(frequency_count), frequency_count := 0]
+      parking_best_stop_quality <- snapped_stops_with_freq[order(from_id_park, -frequency_count, walk_time_to_stop_min)]
+      parking_best_stop_quality <- parking_best_stop_quality[!duplicated(from_id_park)]
+      setnames(parking_best_stop_quality, c("to_id_stop", "walk_time_to_stop_min", "frequency_count"), c("best_stop_id", "walk_time_to_best_stop_min", "best_stop_frequency"))
+      parking_best_stop_quality[, .(from_id_park, best_stop_id, walk_time_to_best_stop_min, best_stop_frequency)]
+    }
+
+    # Persisted parking -> best stop tables. They only depend on the network, the parking points, the GTFS
+    # feed and the (departure bucket, walk limit, frequency window), never on the trip's origin/destination.
+    init_parking_quality_cache <- function(base_data_path, gtfs_index) {
+      cache_root <- Sys.getenv("PARKING_QUALITY_CACHE_DIR", file.path(base_data_path, ".parking_quality_cache"))
+      network_files <- list.files(base_data_path, pattern = "(\\\\.pbf|\\\\.mapdb|network\\\\.dat|network_settings\\\\.json)$", full.names = TRUE)
+      fingerprint_source <- tempfile()
+      writeLines(c(basename(gtfs_index$source_dir),
+                   unname(tools::md5sum(file.path(base_data_path, "bike_park_metz.csv"))),
+                   paste(basename(network_files), file.size(network_files), as.numeric(file.mtime(network_files)))),
+                 fingerprint_source)
+      fingerprint <- substr(unname(tools::md5sum(fingerprint_source)), 1, 12)
+      unlink(fingerprint_source)
+      list(root = cache_root, fingerprint = fingerprint, memo = new.env(hash = TRUE))
+    }
+
+    parking_quality_table <- function(r5r_core, parking_points, gtfs_index, max_walk_to_stop, departure_datetime,
+                                      freq_window, quality_cache, bucket_minutes = 15) {
+      bucket_start <- lubridate::floor_date(departure_datetime, paste(bucket_minutes, "mins"))
+      table_key <- paste(format(bucket_start, "%Y%m%dT%H%M"), max_walk_to_stop, freq_window, sep = "_")
+      if (exists(table_key, envir = quality_cache$memo, inherits = FALSE)) return(get(table_key, envir = quality_cache$memo, inherits = FALSE))
+
+      cache_file <- file.path(quality_cache$root, paste0("parking_quality_", quality_cache$fingerprint, "_", table_key, ".rds"))
+      quality <- if (file.exists(cache_file)) tryCatch(readRDS(cache_file), error = function(e) NULL) else NULL
+      if (is.null(quality)) {
+        quality <- parking_stop_quality(r5r_core, parking_points, gtfs_index, max_walk_to_stop, bucket_start, freq_window)
+        dir.create(quality_cache$root, showWarnings = FALSE, recursive = TRUE)
+        staging_file <- tempfile(pattern = "parking_quality_staging_", tmpdir = quality_cache$root, fileext = ".rds")
+        saveRDS(quality, staging_file)
+        if (!file.rename(staging_file, cache_file)) unlink(staging_file)
+        cached_files <- list.files(quality_cache$root, pattern = "^parking_quality_", full.names = TRUE)
+        unlink(cached_files[!grepl(paste0("^parking_quality_(", quality_cache$fingerprint, "|staging)_"), basename(cached_files))])
+      }
+      assign(table_key, quality, envir = quality_cache$memo)
+      quality
+    }
+
+    # detailed_itineraries output as a data.table whose geometry column holds WKB raw vectors.
+    itinerary_with_wkb <- function(itinerary) {
+      if (is.null(itinerary) || nrow(itinerary) == 0) return(data.table())
+      if (inherits(itinerary, "sf")) {
+        geometry_wkb <- unclass(sf::st_as_binary(sf::st_geometry(itinerary)))
+        itinerary <- as.data.table(sf::st_drop_geometry(itinerary))
+        itinerary[, geometry := list(geometry_wkb)]
+      }
+      as.data.table(itinerary)
+    }
+
+    # All-to-all itineraries for one direct mode, tagged with the OD pair they belong to.
+    batch_detailed_itineraries <- function(r5r_core, origins, destinations, mode, departure_datetime,
+                                           max_walk_time = Inf, max_trip_duration = 120, shortest_path = TRUE) {
+      det <- itinerary_with_wkb(detailed_itineraries(
+          r5r_core,
+          origins = origins,
+          destinations = destinations,
+          mode = mode,
+          departure_datetime = departure_datetime,
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          shortest_path = shortest_path,
+          all_to_all = TRUE,
+          progress = FALSE
+      ))
+      if (nrow(det) == 0) return(data.frame())
+      det[, `:=`(od_origin_id = from_id, od_destination_id = to_id)]
+      as.data.frame(det)
+    }
+
+    # Park-and-ride for every origin/destination pair. The access, parking-quality and egress matrices are
+    # computed once for the whole batch; the optimal parking of each pair follows the single-trip criteria.
+    batch_park_and_ride <- function(r5r_core, origins, destinations, parking_points, gtfs_index, access_mode,
+                                    max_access_time, max_walk_to_stop, max_walk_time, departure_datetime, freq_window,
+                                    quality_cache, parking_grid = NULL) {
+      candidate_parking_points <- parking_points
+      if (!is.null(parking_grid)) {
+        candidate_parking_points <- parking_points[points_within(parking_grid, origins$lon, origins$lat, candidate_radius_m(access_mode, max_access_time + 5))]
+        if (nrow(candidate_parking_points) == 0) return(data.frame())
+      }
+      ttm_origin_to_park <- travel_time_matrix(
+          r5r_core = r5r_core,
+          origins = origins,
+          destinations = candidate_parking_points,
+          mode = access_mode,
+          max_trip_duration = max_access_time + 5,
+          departure_datetime = departure_datetime,
+          progress = FALSE
+      )
+      if (is.null(ttm_origin_to_park) || nrow(ttm_origin_to_park) == 0) return(data.frame())
+      setnames(ttm_origin_to_park, c("from_id", "to_id", travel_time_column(ttm_origin_to_park)), c("od_origin_id", "park_id", "travel_time_access_min"))
+      ttm_origin_to_park <- ttm_origin_to_park[travel_time_access_min <= max_access_time, .(od_origin_id, park_id, travel_time_access_min)]
+      favorable_parking_points <- parking_points[id %in% ttm_origin_to_park$park_id]
+      if (nrow(favorable_parking_points) == 0) return(data.frame())
+
+      parking_best_stop_quality <- parking_quality_table(r5r_core, parking_points, gtfs_index, max_walk_to_stop, departure_datetime,
+                                                         freq_window, quality_cache)[from_id_park %in% favorable_parking_points$id]
+
+      ttm_park_to_dest <- travel_time_matrix(
+          r5r_core = r5r_core,
+          origins = favorable_parking_points,
+          destinations = destinations,
+          mode = c("WALK", "TRANSIT"),
+          max_trip_duration = 100,
+          departure_datetime = departure_datetime,
+          progress = FALSE
+      )
+      if (is.null(ttm_park_to_dest) || nrow(ttm_park_to_dest) == 0) return(data.frame())
+      setnames(ttm_park_to_dest, c("from_id", "to_id", travel_time_column(ttm_park_to_dest)), c("park_id", "od_destination_id", "travel_time_pt_min"))
+
+      candidates <- merge(ttm_origin_to_park, ttm_park_to_dest[, .(park_id, od_destination_id, travel_time_pt_min)], by = "park_id", allow.cartesian = TRUE)
+      candidates <- merge(candidates, parking_best_stop_quality, by.x = "park_id", by.y = "from_id_park")
+      candidates[, total_travel_time_min := travel_time_access_min + travel_time_pt_min]
+      if (nrow(candidates) == 0) return(data.frame())
+      setorderv(candidates, c("od_origin_id", "od_destination_id", "total_travel_time_min", "best_stop_frequency", "walk_time_to_best_stop_min"), c(1, 1, 1, -1, 1))
+      optimal_pairs <- unique(candidates, by = c("od_origin_id", "od_destination_id"))[, .(od_origin_id, od_destination_id, park_id)]
+
+      # One pairwise detailed_itineraries call per leg; legs shared by several OD pairs are routed once.
+      route_legs <- function(leg_pairs, from_points, to_points, mode) {
+        leg_key <- paste(leg_pairs[[1]], leg_pairs[[2]], sep = "|")
+        leg_origins <- from_points[match(leg_pairs[[1]], from_points$id), .(id = leg_key, lat, lon)]
+        leg_destinations <- to_points[match(leg_pairs[[2]], to_points$id), .(id = leg_key, lat, lon)]
+        det <- itinerary_with_wkb(detailed_itineraries(
+            r5r_core,
+            origins = leg_origins,
+            destinations = leg_destinations,
+            mode = mode,
+            departure_datetime = departure_datetime,
+            max_walk_time = max_walk_time,
+            shortest_path = TRUE,
+            all_to_all = FALSE,
+            progress = FALSE
+        ))
+        if (nrow(det) == 0) return(det)
+        det[, leg_key := from_id]
+        det[, from_id := leg_pairs[[1]][match(leg_key, paste(leg_pairs[[1]], leg_pairs[[2]], sep = "|"))]]
+        det[, to_id := leg_pairs[[2]][match(leg_key, paste(leg_pairs[[1]], leg_pairs[[2]], sep = "|"))]]
+        det
+      }
+      access_legs <- unique(optimal_pairs[, .(od_origin_id, park_id)])
+      egress_legs <- unique(optimal_pairs[, .(park_id, od_destination_id)])
+      det_access <- route_legs(access_legs, origins, parking_points, access_mode)
+      det_egress <- route_legs(egress_legs, parking_points, destinations, c("WALK", "TRANSIT"))
+      if (nrow(det_access) == 0 || nrow(det_egress) == 0) return(data.frame())
+
+      det_access <- merge(optimal_pairs, det_access[, !"leg_key"], by.x = c("od_origin_id", "park_id"), by.y = c("from_id", "to_id"), allow.cartesian = TRUE)
+      det_access[, `:=`(from_id = od_origin_id, to_id = park_id, leg = 1L)]
+      det_egress <- merge(optimal_pairs, det_egress[, !"leg_key"], by.x = c("park_id", "od_destination_id"), by.y = c("from_id", "to_id"), allow.cartesian = TRUE)
+      det_egress[, `:=`(from_id = park_id, to_id = od_destination_id, leg = 2L)]
+      # Pairs need both legs, as in the single-trip logic.
+      complete_pairs <- fintersect(unique(det_access[, .(od_origin_id, od_destination_id)]), unique(det_egress[, .(od_origin_id, od_destination_id)]))
+      det_combined_dt <- rbind(det_access, det_egress, fill = TRUE)[complete_pairs, on = c("od_origin_id", "od_destination_id")]
+      setorderv(det_combined_dt, c("od_origin_id", "od_destination_id", "leg", "option", "segment"))
+      det_combined_dt[, c("park_id", "leg") := NULL]
+      as.data.frame(det_combined_dt)
+    }
+"""
+
+# R code for optimal park and ride logic: the parking that minimizes access + transit time
+# (ties broken by stop frequency, then walk to the stop), and the itineraries of both legs.
+R_OPTIMAL_PARK_AND_RIDE_LOGIC = """
+    optimal_park_and_ride <- function(r5r_core, origin, destination, parking_points, parking_grid, gtfs_index, quality_cache,
+                                      access_mode, max_access_time, max_walk_to_stop, max_walk_time, departure_datetime, freq_window) {
+      bike_parking_points <- parking_points
+      access_radius_m <- candidate_radius_m(access_mode, max_access_time + 5)
+      candidate_parking_points <- bike_parking_points[points_within(parking_grid, origin$lon, origin$lat, access_radius_m)]
+      if (nrow(candidate_parking_points) == 0) stop(paste0("No parking points reachable by ", access_mode, " from origin."))
+
+      ttm_origin_to_park <- travel_time_matrix(
+          r5r_core = r5r_core,
+          origins = origin, 
+          destinations = candidate_parking_points,
+          mode = access_mode, 
+          max_trip_duration = max_access_time + 5, 
+          departure_datetime = departure_datetime, 
+          progress = FALSE
+      )
+      stage_mark("pnr_access_matrix")
+      if (is.null(ttm_origin_to_park) || nrow(ttm_origin_to_park) == 0) stop(paste0("No parking points reachable by ", access_mode, " from origin."))
+      time_col_name_from_r5r <- if ("travel_time_p50" %in% names(ttm_origin_to_park)) "travel_time_p50" else "travel_time"
+      setnames(ttm_origin_to_park, c("from_id", "to_id", time_col_name_from_r5r), c("from_id_origin", "to_id_park", "travel_time_access_min"))
+
+      reachable_parking_ids <- ttm_origin_to_park[travel_time_access_min <= max_access_time, to_id_park]
+      favorable_parking_points <- bike_parking_points[id %in% reachable_parking_ids]
+      if (nrow(favorable_parking_points) == 0) stop(paste0("No parking points reachable within ", max_access_time, " minutes by ", access_mode, "."))
+      parking_best_stop_quality <- parking_quality_table(r5r_core, parking_points, gtfs_index,
+                                                         max_walk_to_stop, departure_datetime, freq_window,
+                                                         quality_cache)[from_id_park %in% favorable_parking_points$id]
+      stage_mark("pnr_parking_quality")
+
+      ttm_park_to_dest <- travel_time_matrix(
+          r5r_core = r5r_core,
+          origins = favorable_parking_points,
+          destinations = destination, 
+          mode = c("WALK", "TRANSIT"),
+          max_trip_duration = 100,
+          departure_datetime = departure_datetime,
+          progress = FALSE
+      )
+      stage_mark("pnr_transit_matrix")
+      if (is.null(ttm_park_to_dest) || nrow(ttm_park_to_dest) == 0) stop("No transit routes from favorable parking to final destination.")
+      time_col_name_from_r5r_pt <- if ("travel_time_p50" %in% names(ttm_park_to_dest)) "travel_time_p50" else "travel_time"
+      setnames(ttm_park_to_dest, c("from_id", "to_id", time_col_name_from_r5r_pt), c("from_id_park_dest", "to_id_dest", "travel_time_pt_min"))
+
+      merged_times <- merge(ttm_origin_to_park[, .(id = to_id_park, travel_time_access_min)], favorable_parking_points[, .(id, lon, lat)], by = "id")
+      merged_times <- merge(merged_times, parking_best_stop_quality, by.x = "id", by.y = "from_id_park", all.x = TRUE)
+      if (!is.double(merged_times$walk_time_to_best_stop_min) && "walk_time_to_best_stop_min" %in% names(merged_times)) {
+        merged_times[, walk_time_to_best_stop_min := as.double(walk_time_to_best_stop_min)]
+      }
+      merged_times[is.na(best_stop_frequency), best_stop_frequency := 0]
+      merged_times[is.na(walk_time_to_best_stop_min), walk_time_to_best_stop_min := Inf]
+      merged_times <- merge(merged_times, ttm_park_to_dest[, .(id = from_id_park_dest, travel_time_pt_min)], by = "id", all.x = TRUE)
+      merged_times[is.na(travel_time_pt_min), travel_time_pt_min := Inf]
+      merged_times[, total_travel_time_min := travel_time_access_min + travel_time_pt_min]
+      merged_times_filtered <- merged_times[total_travel_time_min < Inf & walk_time_to_best_stop_min < Inf]
+      if (nrow(merged_times_filtered) == 0) stop("No valid park-and-ride options found after merging all criteria.")
+      setorderv(merged_times_filtered, c("total_travel_time_min", "best_stop_frequency", "walk_time_to_best_stop_min"), c(1, -1, 1))
+      optimal_parking_info <- merged_times_filtered[1]
+      if (is.na(optimal_parking_info$id)) stop("Could not determine an optimal parking point from filtered options.")
+      optimal_parking_id <- optimal_parking_info$id
+      optimal_parking <- bike_parking_points[id == optimal_parking_id]
+      stage_mark("pnr_select_parking")
+
+      det_origin_to_optimal_parking <- detailed_itineraries(
+          r5r_core = r5r_core,
+          origins = origin,
+          destinations = optimal_parking,
+          mode = access_mode,
+          departure_datetime = departure_datetime,
+          max_walk_time = max_walk_time,
+          shortest_path = TRUE
+      )
+      stage_mark("pnr_access_itinerary")
+      det_parking_to_destination <- detailed_itineraries(
+          r5r_core = r5r_core,
+          origins = optimal_parking,
+          destinations = destination,
+          mode = c("WALK", "TRANSIT"),
+          departure_datetime = departure_datetime,
+          max_walk_time = max_walk_time,
+          shortest_path = TRUE
+      )
+      stage_mark("pnr_transit_itinerary")
+
+      det_origin_to_optimal_parking <- itinerary_with_wkb(det_origin_to_optimal_parking)
+      det_parking_to_destination <- itinerary_with_wkb(det_parking_to_destination)
+      stage_mark("pnr_wkb_encode")
+      if (nrow(det_origin_to_optimal_parking) == 0 || nrow(det_parking_to_destination) == 0) return(data.frame())
+      as.data.frame(rbind(det_origin_to_optimal_parking, det_parking_to_destination, fill = TRUE))
+    }
+"""
 
-        det_combined_dt <- rbind(dt1, dt2, fill = TRUE)
-        det_df_final <- as.data.frame(det_combined_dt) # This will be in .GlobalEnv after R string execution
+# Entry points called from Python through rpy2 function handles (see R_FUNCTIONS). They take plain
+# typed arguments, read the per-session state built by init_r5r_core and return Arrow IPC bytes,
+# so a request costs one closure call per mode and no R source parsing.
+R_ROUTING_ENTRY_POINTS = """
+    parse_departure <- function(departure_str) as.POSIXct(departure_str, format = "%d-%m-%Y %H:%M:%S", tz = "Europe/Paris")
+
+    route_direct_ipc <- function(lat_ori, lon_ori, lat_des, lon_des, mode, departure_str,
+                                 max_walk_time, max_trip_duration, shortest_path) {
+      stage_reset()
+      itinerary <- detailed_itineraries(
+          .GlobalEnv$r5r_core_glob,
+          origins = data.table(id = "origin", lat = lat_ori, lon = lon_ori),
+          destinations = data.table(id = "destination", lat = lat_des, lon = lon_des),
+          mode = mode,
+          departure_datetime = parse_departure(departure_str),
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          shortest_path = shortest_path
+      )
+      stage_mark("detailed_itineraries")
+      ipc_stream <- itinerary_to_arrow_ipc(itinerary)
+      stage_mark("arrow_encode")
+      ipc_stream
+    }
+
+    route_park_and_ride_ipc <- function(lat_ori, lon_ori, lat_des, lon_des, access_mode, max_access_time,
+                                        walk_time, freq_window, departure_str) {
+      stage_reset()
+      itinerary <- optimal_park_and_ride(
+          .GlobalEnv$r5r_core_glob,
+          origin = data.table(id = "origin", lat = lat_ori, lon = lon_ori),
+          destination = data.table(id = "destination", lat = lat_des, lon = lon_des),
+          parking_points = .GlobalEnv$parking_points_glob,
+          parking_grid = .GlobalEnv$parking_grid_glob,
+          gtfs_index = .GlobalEnv$gtfs_index_glob,
+          quality_cache = .GlobalEnv$parking_quality_cache_glob,
+          access_mode = access_mode,
+          max_access_time = max_access_time,
+          max_walk_to_stop = walk_time,
+          max_walk_time = walk_time,
+          departure_datetime = parse_departure(departure_str),
+          freq_window = freq_window
+      )
+      ipc_stream <- itinerary_to_arrow_ipc(itinerary)
+      stage_mark("arrow_encode")
+      ipc_stream
+    }
+
+    route_batch_direct_ipc <- function(origin_ids, origin_lats, origin_lons, destination_ids, destination_lats, destination_lons,
+                                       mode, departure_str, max_walk_time, max_trip_duration, shortest_path) {
+      itinerary_to_arrow_ipc(batch_detailed_itineraries(
+          .GlobalEnv$r5r_core_glob,
+          data.table(id = origin_ids, lat = origin_lats, lon = origin_lons),
+          data.table(id = destination_ids, lat = destination_lats, lon = destination_lons),
+          mode = mode,
+          departure_datetime = parse_departure(departure_str),
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          shortest_path = shortest_path
+      ))
+    }
+
+    route_batch_park_and_ride_ipc <- function(origin_ids, origin_lats, origin_lons, destination_ids, destination_lats, destination_lons,
+                                              access_mode, max_access_time, walk_time, freq_window, departure_str) {
+      itinerary_to_arrow_ipc(batch_park_and_ride(
+          .GlobalEnv$r5r_core_glob,
+          data.table(id = origin_ids, lat = origin_lats, lon = origin_lons),
+          data.table(id = destination_ids, lat = destination_lats, lon = destination_lons),
+          .GlobalEnv$parking_points_glob, .GlobalEnv$gtfs_index_glob,
+          access_mode = access_mode,
+          max_access_time = max_access_time,
+          max_walk_to_stop = walk_time,
+          max_walk_time = walk_time,
+          departure_datetime = parse_departure(departure_str),
+          freq_window = freq_window,
+          quality_cache = .GlobalEnv$parking_quality_cache_glob,
+          parking_grid = .GlobalEnv$parking_grid_glob
+      ))
+    }
+
+    travel_time_matrix_ipc <- function(origin_ids, origin_lats, origin_lons, destination_ids, destination_lats, destination_lons,
+                                       mode, departure_str, max_walk_time, max_trip_duration) {
+      ttm <- travel_time_matrix(
+          .GlobalEnv$r5r_core_glob,
+          origins = data.table(id = origin_ids, lat = origin_lats, lon = origin_lons),
+          destinations = data.table(id = destination_ids, lat = destination_lats, lon = destination_lons),
+          mode = mode,
+          departure_datetime = parse_departure(departure_str),
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          progress = FALSE
+      )
+      if (is.null(ttm) || nrow(ttm) == 0) return(raw(0))
+      itinerary_to_arrow_ipc(setnames(ttm, travel_time_column(ttm), "travel_time")[, .(from_id, to_id, travel_time)])
+    }
+
+    # Latest departure ("%d-%m-%Y %H:%M:%S") that still reaches the destination by arrival_str, found with
+    # one range-RAPTOR sweep over the max_trip_duration minutes before the arrival; "" when none does.
+    latest_departure_for_arrival <- function(lat_ori, lon_ori, lat_des, lon_des, mode, mode_access, arrival_str,
+                                             max_walk_time, max_trip_duration) {
+      arrival <- parse_departure(arrival_str)
+      window_start <- arrival - max_trip_duration * 60
+      ettm <- expanded_travel_time_matrix(
+          .GlobalEnv$r5r_core_glob,
+          origins = data.table(id = "origin", lat = lat_ori, lon = lon_ori),
+          destinations = data.table(id = "destination", lat = lat_des, lon = lon_des),
+          mode = mode,
+          mode_access = mode_access,
+          departure_datetime = window_start,
+          time_window = max_trip_duration,
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          progress = FALSE
+      )
+      if (is.null(ettm) || nrow(ettm) == 0) return("")
+      ettm <- as.data.table(ettm)[!is.na(total_time)]
+      departures <- as.POSIXct(paste(format(window_start, "%Y-%m-%d"), ettm$departure_time), tz = "Europe/Paris")
+      departures[departures < window_start] <- departures[departures < window_start] + 86400
+      feasible <- departures[departures + ettm$total_time * 60 <= arrival]
+      if (length(feasible) == 0) return("")
+      format(max(feasible), "%d-%m-%Y %H:%M:%S")
+    }
+
+    # p10/p50/p90 travel times over every departure minute of [departure, departure + time_window).
+    travel_time_distribution_ipc <- function(lat_ori, lon_ori, lat_des, lon_des, mode, mode_access, departure_str,
+                                             time_window, max_walk_time, max_trip_duration) {
+      ttm <- travel_time_matrix(
+          .GlobalEnv$r5r_core_glob,
+          origins = data.table(id = "origin", lat = lat_ori, lon = lon_ori),
+          destinations = data.table(id = "destination", lat = lat_des, lon = lon_des),
+          mode = mode,
+          mode_access = mode_access,
+          departure_datetime = parse_departure(departure_str),
+          time_window = time_window,
+          percentiles = c(10, 50, 90),
+          max_walk_time = max_walk_time,
+          max_trip_duration = max_trip_duration,
+          progress = FALSE
+      )
+      if (is.null(ttm) || nrow(ttm) == 0) return(raw(0))
+      itinerary_to_arrow_ipc(ttm)
+    }
+
+    precompute_parking_quality <- function(walk_time, freq_window, departure_str) {
+      invisible(parking_quality_table(
+          .GlobalEnv$r5r_core_glob, .GlobalEnv$parking_points_glob, .GlobalEnv$gtfs_index_glob,
+          max_walk_to_stop = walk_time,
+          departure_datetime = parse_departure(departure_str),
+          freq_window = freq_window,
+          quality_cache = .GlobalEnv$parking_quality_cache_glob
+      ))
+    }
+
+    # Heap of r5r's JVM and memory held by R's heap, in bytes. gc(full = FALSE) only runs a minor collection.
+    session_memory_usage <- function() {
+      runtime <- rJava::J("java.lang.Runtime")$getRuntime()
+      c(jvm_heap_used_bytes = runtime$totalMemory() - runtime$freeMemory(),
+        jvm_heap_max_bytes = runtime$maxMemory(),
+        r_used_bytes = sum(gc(full = FALSE)[, 2]) * 1024^2)
     }
 """
+R_ENTRY_POINT_NAMES = ("route_direct_ipc", "route_park_and_ride_ipc", "route_batch_direct_ipc",
+                       "route_batch_park_and_ride_ipc", "travel_time_matrix_ipc", "latest_departure_for_arrival",
+                       "travel_time_distribution_ipc", "precompute_parking_quality", "last_stage_timings",
+                       "session_memory_usage")
+# Entry points that reset the R stage clock, so their stage timings can be read back after the call.
+STAGE_TIMED_ENTRY_POINTS = ("route_direct_ipc", "route_park_and_ride_ipc")
 
 # Global variable to track if r5r_core is initialized in R's globalenv
 R5R_CORE_INITIALIZED = False
+# rpy2 handles of the byte-compiled R_ROUTING_ENTRY_POINTS closures, filled by init_r5r_core.
+R_FUNCTIONS = {}
+# Seconds spent in each stage of init_r5r_core in this process (empty until it has run).
+R5R_LOAD_TIMINGS = {}
 
+# Travel modes computed for every trip, in the order they are labeled in the output.
+MODE_LABELS = ["Walk+Transit", "CAR", "Bicycle+Transit", "Car+Transit", "Bicycle"]
 
-def process_r5r(data_path, origin_str, destination_str, 
-                walk_time = 20, bicycle_time = 20, max_trip_duration = 120, car_time = 5,
-                transit_freq_window_min = 60): # New parameter
-    global R5R_CORE_INITIALIZED
+# Departure used for every trip ("%d-%m-%Y %H:%M:%S", Europe/Paris), a weekday covered by the GTFS feed.
+DEFAULT_DEPARTURE_DATETIME = "12-08-2024 07:00:00"
+
+# Minutes added to the first segment of each option (parking / unparking the vehicle).
+MODE_DURATION_OFFSETS = {"CAR": 10, "Bicycle+Transit": 5, "Car+Transit": 10, "Bicycle": 5}
 
-    ro.r('options(java.parameters = "-Xmx12G")')
+# Number of routing worker processes used by create_routing_pool; each one holds its own JVM and r5r_core.
+ROUTING_WORKERS = int(os.environ.get("ROUTING_WORKERS", len(MODE_LABELS)))
+R5R_JAVA_MEMORY = os.environ.get("R5R_JAVA_MEMORY", "12G")
+# Build (or load from disk) the parking-to-stop quality table of the default trip parameters at startup,
+# instead of on the first park-and-ride request.
+PRECOMPUTE_PARKING_QUALITY = os.environ.get("PRECOMPUTE_PARKING_QUALITY", "1") == "1"
+# Routing backend behind process_r5r: "r5r", or "replay" to serve recorded trip summaries (see ReplayBackend).
+ROUTING_BACKEND = os.environ.get("ROUTING_BACKEND", "r5r")
+# Recordings and synthetic latency of the replay backend. REPLAY_LATENCY_MS is one number of
+# milliseconds for every mode, or per-mode values such as "Walk+Transit=800,Car+Transit=2500,default=300";
+# REPLAY_LATENCY_JITTER spreads each latency uniformly by that fraction either way.
+REPLAY_RECORDINGS = os.environ.get("REPLAY_RECORDINGS", os.path.join("outputs", "trip_summary_*.csv"))
+REPLAY_LATENCY_MS = os.environ.get("REPLAY_LATENCY_MS", "0")
+REPLAY_LATENCY_JITTER = float(os.environ.get("REPLAY_LATENCY_JITTER", 0))
+# TransitServiceIndex per data path, built by get_service_index (None when the data has no GTFS feed).
+SERVICE_INDEXES = {}
+DEFAULT_WALK_TIME = 20
+DEFAULT_TRANSIT_FREQ_WINDOW_MIN = 60
+# Minimum seconds between two session memory samples taken by mode jobs (see session_memory_usage).
+MEMORY_SAMPLE_SECONDS = float(os.environ.get("MEMORY_SAMPLE_SECONDS", 30))
+LAST_MEMORY_SAMPLE_AT = None
+
+
+def init_r5r_core(data_path):
+    """
+    Starts the JVM and loads r5r_core plus the GTFS timetable index into this
+    process's R session. Safe to call repeatedly; only the first call does work.
+    Also used as the initializer of routing pool workers. Returns the seconds
+    spent per loading stage (see R5R_LOAD_TIMINGS).
+    """
+    global R5R_CORE_INITIALIZED
 
     if not os.path.exists(data_path):
         raise FileNotFoundError(f"The data path {data_path} does not exist. Please verify the path.")
 
-    if not R5R_CORE_INITIALIZED:
-        print("Initializing r5r_core in R's global environment for the first time...")
-        ro.r("library(r5r)") 
-        formatted_data_path = data_path.replace('\\', '/')
-        ro.r(f".GlobalEnv$r5r_core_glob <- setup_r5(data_path = '{formatted_data_path}', verbose = FALSE)")
-        R5R_CORE_INITIALIZED = True
-    
-    origin_coords = origin_str.split(',')
-    destination_coords = destination_str.split(',')
+    if R5R_CORE_INITIALIZED:
+        return dict(R5R_LOAD_TIMINGS)
+    if ro is None:
+        raise RuntimeError(f"The r5r routing backend needs rpy2 and R, which failed to load: {RPY2_IMPORT_ERROR}")
+
+    stage_started = time.perf_counter()
 
-    lat_ori = float(origin_coords[0])
-    lon_ori = float(origin_coords[1])
-    lat_des = float(destination_coords[0])
-    lon_des = float(destination_coords[1])
-
-    globalenv['lat_ori_r_glob'] = lat_ori 
-    globalenv['lon_ori_r_glob'] = lon_ori
-    globalenv['lat_des_r_glob'] = lat_des
-    globalenv['lon_des_r_glob'] = lon_des
-    globalenv['departure_datetime_str_glob'] = "12-08-2024 07:00:00" 
-    globalenv['walk_time_r_glob'] = float(walk_time)
-    globalenv['max_trip_duration_r_glob'] = float(max_trip_duration)
-
-    # -------- WALK + TRANSIT --------
-    ro.r(f"""
-    library(r5r)
-    library(data.table)
-    origin_r_dt_direct_wt <- data.table(id = "origin", lat = .GlobalEnv$lat_ori_r_glob, lon = .GlobalEnv$lon_ori_r_glob)
-    destination_r_dt_direct_wt <- data.table(id = "destination", lat = .GlobalEnv$lat_des_r_glob, lon = .GlobalEnv$lon_des_r_glob)
-    departure_datetime_r_obj_wt <- as.POSIXct(.GlobalEnv$departure_datetime_str_glob, format = "%d-%m-%Y %H:%M:%S", tz = "Europe/Paris")
-    mode_walk_transit_r <- c("WALK", "TRANSIT")
-    
-    .GlobalEnv$detailed_itinerary_wt <- detailed_itineraries(
-        .GlobalEnv$r5r_core_glob,
-        origins = origin_r_dt_direct_wt,
-        destinations = destination_r_dt_direct_wt,
-        mode = mode_walk_transit_r,
-        departure_datetime = departure_datetime_r_obj_wt,
-        max_walk_time = .GlobalEnv$walk_time_r_glob,
-        max_trip_duration = .GlobalEnv$max_trip_duration_r_glob,
-        shortest_path = FALSE 
+    def end_stage(stage):
+        nonlocal stage_started
+        now = time.perf_counter()
+        R5R_LOAD_TIMINGS[stage] = round(now - stage_started, 3)
+        stage_started = now
+
+    print("Initializing r5r_core in R's global environment for the first time...")
+    ro.r(f'options(java.parameters = "-Xmx{R5R_JAVA_MEMORY}")')
+    ro.r("library(r5r)") 
+    formatted_data_path = data_path.replace('\\', '/')
+    ro.r(f".GlobalEnv$r5r_core_glob <- setup_r5(data_path = '{formatted_data_path}', verbose = FALSE)")
+    end_stage("network")
+    print("Building GTFS timetable index...")
+    ro.r("library(data.table); library(lubridate)")
+    ro.r(R_GTFS_TIMETABLE_INDEX)
+    ro.r(f".GlobalEnv$gtfs_index_glob <- build_gtfs_timetable_index(get_gtfs_dir('{formatted_data_path}'))")
+    end_stage("gtfs_index")
+    ro.r(R_ARROW_TRANSFER)
+    ro.r("library(sf)")
+    ro.r(R_ROUTING_HELPERS)
+    ro.r(R_OPTIMAL_PARK_AND_RIDE_LOGIC)
+    ro.r(R_ROUTING_ENTRY_POINTS)
+    # Byte-compile the per-request closures once and keep Python handles to them.
+    for function_name in R_ENTRY_POINT_NAMES:
+        ro.r(f"{function_name} <- compiler::cmpfun({function_name})")
+        R_FUNCTIONS[function_name] = globalenv[function_name]
+    end_stage("r_helpers")
+    ro.r(f".GlobalEnv$parking_points_glob <- load_parking_points('{formatted_data_path}')")
+    # Grid indexes used to prefilter parking and stop candidates before r5r matrix calls.
+    ro.r(".GlobalEnv$parking_grid_glob <- build_point_grid(.GlobalEnv$parking_points_glob)")
+    ro.r(".GlobalEnv$gtfs_index_glob$stop_grid <- build_point_grid(.GlobalEnv$gtfs_index_glob$stops_for_r5r)")
+    ro.r(f".GlobalEnv$parking_quality_cache_glob <- init_parking_quality_cache('{formatted_data_path}', .GlobalEnv$gtfs_index_glob)")
+    end_stage("parking_points")
+    if PRECOMPUTE_PARKING_QUALITY:
+        print("Loading parking-to-stop quality table...")
+        with localconverter(default_converter):
+            R_FUNCTIONS["precompute_parking_quality"](float(DEFAULT_WALK_TIME), float(DEFAULT_TRANSIT_FREQ_WINDOW_MIN), DEFAULT_DEPARTURE_DATETIME)
+        end_stage("parking_quality")
+    R5R_CORE_INITIALIZED = True
+    return dict(R5R_LOAD_TIMINGS)
+
+
+def warmup_trips(data_path, count):
+    """
+    Up to `count` origin/destination pairs ("lat,lon" strings) drawn evenly from
+    metz_points_of_interest.csv, used to warm up a freshly started service.
+    """
+    if count <= 0:
+        return []
+    points = pd.read_csv(os.path.join(data_path, "metz_points_of_interest.csv")).dropna(subset=["lat", "lon"])
+    points = points.drop_duplicates(subset=["lat", "lon"]).reset_index(drop=True)
+    if len(points) < 2:
+        return []
+    coords = [f"{lat},{lon}" for lat, lon in zip(points["lat"], points["lon"])]
+    stride = max(1, len(coords) // (count + 1))
+    # Destinations lie half the list away from their origin, never on it.
+    offset = max(1, len(coords) // 2)
+    pairs = []
+    for i in range(count):
+        origin_idx = (i * stride) % len(coords)
+        pairs.append((coords[origin_idx], coords[(origin_idx + offset) % len(coords)]))
+        assert pairs[-1][0] != pairs[-1][1], "warm-up trip from a point to itself"
+    return pairs
+
+
+def create_routing_pool(data_path, workers=None):
+    """
+    Creates a pool of routing worker processes, each with its own loaded routing
+    backend (a warm r5r_core for the r5r backend). Workers are spawned rather
+    than forked so that no JVM or R state is shared with the parent process.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers or ROUTING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_routing_backend,
+        initargs=(data_path,)
     )
-    """)
+
+
+def _call_r_ipc(function_name, *args):
+    """
+    Calls one of the R_ROUTING_ENTRY_POINTS and moves the Arrow IPC table it returns
+    into pandas, decoding the WKB geometry column straight into shapely geometries.
+    The seconds spent per stage are left in df.attrs["stage_seconds"]: "r_call",
+    "r.<stage>" for the R-side stages of STAGE_TIMED_ENTRY_POINTS, and "to_pandas".
+    """
+    call_started = time.perf_counter()
+    with localconverter(default_converter):
+        ipc_stream = R_FUNCTIONS[function_name](*args)
+        stage_seconds = {"r_call": time.perf_counter() - call_started}
+        if function_name in STAGE_TIMED_ENTRY_POINTS:
+            r_stages = R_FUNCTIONS["last_stage_timings"]()
+            if len(r_stages):
+                stage_seconds.update((f"r.{stage}", float(seconds)) for stage, seconds in zip(r_stages.names, r_stages))
+    if len(ipc_stream) == 0:
+        itinerary_df = pd.DataFrame()
+        itinerary_df.attrs["stage_seconds"] = stage_seconds
+        return itinerary_df
+    conversion_started = time.perf_counter()
+    itinerary_table = pa.ipc.open_stream(pa.py_buffer(ipc_stream.memoryview())).read_all()
+    itinerary_df = itinerary_table.to_pandas()
+    if "geometry" in itinerary_df.columns and pa.types.is_binary(itinerary_table.schema.field("geometry").type):
+        itinerary_df["geometry"] = shapely.from_wkb(itinerary_df["geometry"].to_numpy())
+    stage_seconds["to_pandas"] = time.perf_counter() - conversion_started
+    itinerary_df.attrs["stage_seconds"] = stage_seconds
+    return itinerary_df
+
+
+# r5r mode, max_walk_time ("walk" = the trip's walk_time) and shortest_path of the direct travel modes.
+DIRECT_MODES = {
+    "Walk+Transit": (("WALK", "TRANSIT"), "walk", False),
+    "CAR": (("CAR",), None, True),
+    "Bicycle": (("BICYCLE",), None, True),
+}
+# Access mode and the trip parameter holding its maximum access time, for park-and-ride modes.
+PARK_AND_RIDE_MODES = {
+    "Bicycle+Transit": ("BICYCLE", "bicycle_time"),
+    "Car+Transit": ("CAR", "car_time"),
+}
+# r5r mode and mode_access approximating each travel mode in travel-time sweeps (arrive-by, time windows).
+SWEEP_MODES = {
+    "Walk+Transit": (("WALK", "TRANSIT"), "WALK"),
+    "CAR": (("CAR",), "WALK"),
+    "Bicycle": (("BICYCLE",), "WALK"),
+    "Bicycle+Transit": (("WALK", "TRANSIT"), "BICYCLE"),
+    "Car+Transit": (("WALK", "TRANSIT"), "CAR_PARK"),
+}
+
+
+def session_memory_usage():
+    """
+    JVM heap and R memory of this process's routing session, in bytes, with its pid.
+    """
+    with localconverter(default_converter):
+        usage = R_FUNCTIONS["session_memory_usage"]()
+    return {"pid": os.getpid(), **{name: float(value) for name, value in zip(usage.names, usage)}}
+
+
+def _sample_session_memory(itinerary_df):
+    """
+    Leaves a session_memory_usage sample in itinerary_df.attrs["session_memory"]
+    at most every MEMORY_SAMPLE_SECONDS per process, so that pool workers report
+    their memory through the jobs they already run.
+    """
+    global LAST_MEMORY_SAMPLE_AT
+    now = time.monotonic()
+    if LAST_MEMORY_SAMPLE_AT is not None and now - LAST_MEMORY_SAMPLE_AT < MEMORY_SAMPLE_SECONDS:
+        return
+    LAST_MEMORY_SAMPLE_AT = now
+    itinerary_df.attrs["session_memory"] = session_memory_usage()
+
+
+def _sweep_args(mode_label, trip):
+    r_mode, mode_access = SWEEP_MODES[mode_label]
+    max_walk_time = float("inf") if mode_label in ("CAR", "Bicycle") else float(trip["walk_time"])
+    return StrVector(r_mode), mode_access, max_walk_time
+
+
+def latest_departure(mode_label, trip):
+    """
+    Latest departure ("%d-%m-%Y %H:%M:%S") at which mode_label still arrives by
+    trip["departure"], or None if no departure in the preceding max_trip_duration
+    minutes does. Park-and-ride modes are approximated with r5r's own access modes.
+    """
+    r_mode, mode_access, max_walk_time = _sweep_args(mode_label, trip)
+    with localconverter(default_converter):
+        departure = R_FUNCTIONS["latest_departure_for_arrival"](
+            trip["lat_ori"], trip["lon_ori"], trip["lat_des"], trip["lon_des"], r_mode, mode_access,
+            trip["departure"], max_walk_time, float(trip["max_trip_duration"])
+        )[0]
+    return departure or None
+
+
+class R5RBackend:
+    """
+    Routes with r5r through the R session of whichever process runs the job
+    (the caller, or a routing pool worker), loaded on first use.
+    """
+
+    name = "r5r"
+    # The embedded R interpreter is not thread-safe, so in-process calls must be serialized.
+    thread_safe = False
+
+    def load(self, data_path):
+        return init_r5r_core(data_path)
+
+    def route_mode(self, data_path, mode_label, trip):
+        init_r5r_core(data_path)
+        endpoints = (trip["lat_ori"], trip["lon_ori"], trip["lat_des"], trip["lon_des"])
+        departure = trip.get("departure", DEFAULT_DEPARTURE_DATETIME)
+        sweep_seconds = {}
+        if trip.get("arrive_by"):
+            sweep_started = time.perf_counter()
+            departure = latest_departure(mode_label, trip)
+            sweep_seconds["arrive_by_sweep"] = time.perf_counter() - sweep_started
+            if departure is None:
+                itinerary_df = pd.DataFrame()
+                itinerary_df.attrs["stage_seconds"] = sweep_seconds
+                return itinerary_df
+        if mode_label in DIRECT_MODES:
+            r_mode, max_walk_time, shortest_path = DIRECT_MODES[mode_label]
+            itinerary_df = _call_r_ipc(
+                "route_direct_ipc", *endpoints, StrVector(r_mode), departure,
+                float(trip["walk_time"]) if max_walk_time else float("inf"), float(trip["max_trip_duration"]), shortest_path
+            )
+        elif mode_label in PARK_AND_RIDE_MODES:
+            access_mode, access_time_key = PARK_AND_RIDE_MODES[mode_label]
+            itinerary_df = _call_r_ipc(
+                "route_park_and_ride_ipc", *endpoints, access_mode, float(trip[access_time_key]),
+                float(trip["walk_time"]), float(trip["transit_freq_window_min"]), departure
+            )
+        else:
+            raise ValueError(f"Unknown travel mode: {mode_label}")
+        itinerary_df.attrs["stage_seconds"].update(sweep_seconds)
+        _sample_session_memory(itinerary_df)
+        return itinerary_df
+
+    def route_batch_mode(self, data_path, mode_label, batch):
+        init_r5r_core(data_path)
+        points = (*_point_vectors(batch["origins"], "o"), *_point_vectors(batch["destinations"], "d"))
+        if mode_label in DIRECT_MODES:
+            r_mode, max_walk_time, shortest_path = DIRECT_MODES[mode_label]
+            itinerary_df = _call_r_ipc(
+                "route_batch_direct_ipc", *points, StrVector(r_mode), batch["departure"],
+                float(batch["walk_time"]) if max_walk_time else float("inf"), float(batch["max_trip_duration"]), shortest_path
+            )
+        elif mode_label in PARK_AND_RIDE_MODES:
+            access_mode, access_time_key = PARK_AND_RIDE_MODES[mode_label]
+            itinerary_df = _call_r_ipc(
+                "route_batch_park_and_ride_ipc", *points, access_mode, float(batch[access_time_key]),
+                float(batch["walk_time"]), float(batch["transit_freq_window_min"]), batch["departure"]
+            )
+        else:
+            raise ValueError(f"Unknown travel mode: {mode_label}")
+        _sample_session_memory(itinerary_df)
+        return itinerary_df
+
+    def travel_time_distribution(self, data_path, mode_label, trip):
+        init_r5r_core(data_path)
+        r_mode, mode_access, max_walk_time = _sweep_args(mode_label, trip)
+        distribution_df = _call_r_ipc(
+            "travel_time_distribution_ipc", trip["lat_ori"], trip["lon_ori"], trip["lat_des"], trip["lon_des"],
+            r_mode, mode_access, trip["departure"], float(trip["time_window_min"]), max_walk_time, float(trip["max_trip_duration"])
+        )
+        if distribution_df.empty:
+            return None
+        duration_offset = MODE_DURATION_OFFSETS.get(mode_label, 0)
+        distribution = {}
+        for percentile in ("p10", "p50", "p90"):
+            column = f"travel_time_{percentile}"
+            minutes = pd.to_numeric(distribution_df[column], errors="coerce").iloc[0] if column in distribution_df.columns else np.nan
+            distribution[percentile] = None if pd.isna(minutes) else int(minutes) + duration_offset
+        return distribution
+
+
+def _parse_latency_ms(spec):
+    """
+    {mode label or "default": milliseconds} from a REPLAY_LATENCY_MS value.
+    """
+    if "=" not in spec:
+        return {"default": float(spec)}
+    latencies = {"default": 0.0}
+    for item in spec.split(","):
+        mode_label, milliseconds = item.split("=")
+        latencies[mode_label.strip()] = float(milliseconds)
+    return latencies
+
+
+# Columns process_r5r derives from the raw r5r table; dropped from recordings before replay.
+DERIVED_COLUMNS = ["Mode_Transport", "from_lat", "from_lon", "to_lat", "to_lon", "last_bus_time", "frequency(buses per hour)"]
+
+
+class ReplayBackend:
+    """
+    Serves itinerary tables recorded in trip summary CSVs (archive_trip_summary
+    output, such as outputs/trip_summary_*.csv) after a synthetic per-mode
+    latency, instead of routing. It needs neither R nor Java, so the Python side
+    of the service can be load-tested on any machine.
+
+    A trip gets the recording whose first and last points are closest to its
+    origin and destination; departure time and routing limits are ignored.
+    Recordings are turned back into raw tables (derived columns dropped, mode
+    offsets removed) so postprocess_itinerary does its full work on them.
+    """
+
+    name = "replay"
+    thread_safe = True
+
+    def __init__(self, recordings_pattern=REPLAY_RECORDINGS, latency_ms=REPLAY_LATENCY_MS, jitter=REPLAY_LATENCY_JITTER):
+        self.recordings_pattern = recordings_pattern
+        self.latency_ms = _parse_latency_ms(latency_ms)
+        self.jitter = jitter
+        self.recordings = None
+        self.endpoints = None
+
+    def load(self, data_path):
+        started = time.perf_counter()
+        if self.recordings is None:
+            recording_paths = sorted(glob.glob(self.recordings_pattern))
+            if not recording_paths:
+                raise FileNotFoundError(f"No trip summary recordings match {self.recordings_pattern}.")
+            recordings, endpoints = [], []
+            for recording_path in recording_paths:
+                trip_summary_df = pd.read_csv(recording_path)
+                if trip_summary_df.empty or not {"Mode_Transport", "from_lat", "from_lon", "to_lat", "to_lon"} <= set(trip_summary_df.columns):
+                    continue
+                recordings.append(self._raw_tables(trip_summary_df))
+                endpoints.append([trip_summary_df["from_lat"].iloc[0], trip_summary_df["from_lon"].iloc[0],
+                                  trip_summary_df["to_lat"].iloc[-1], trip_summary_df["to_lon"].iloc[-1]])
+            if not recordings:
+                raise ValueError(f"None of the files matching {self.recordings_pattern} is a trip summary.")
+            self.recordings = recordings
+            self.endpoints = np.asarray(endpoints, dtype=float)
+        return {"recordings": round(time.perf_counter() - started, 3)}
+
+    @staticmethod
+    def _raw_tables(trip_summary_df):
+        raw_tables = {}
+        for mode_label, mode_df in trip_summary_df.groupby("Mode_Transport", sort=False):
+            raw_df = mode_df.drop(columns=DERIVED_COLUMNS, errors="ignore").reset_index(drop=True)
+            duration_offset = MODE_DURATION_OFFSETS.get(mode_label, 0)
+            if duration_offset and "segment_duration" in raw_df.columns:
+                option = raw_df["option"] if "option" in raw_df.columns else pd.Series(1, index=raw_df.index)
+                is_first_segment = option.groupby(option, sort=False).cumcount() == 0
+                raw_df.loc[is_first_segment, "segment_duration"] -= duration_offset
+            raw_tables[mode_label] = raw_df
+        return raw_tables
+
+    def _recording(self, data_path, trip):
+        self.load(data_path)
+        requested = np.array([trip["lat_ori"], trip["lon_ori"], trip["lat_des"], trip["lon_des"]])
+        return self.recordings[int(np.argmin(((self.endpoints - requested) ** 2).sum(axis=1)))]
+
+    def _wait_latency(self, mode_label):
+        latency = self.latency_ms.get(mode_label, self.latency_ms["default"]) / 1000
+        latency *= 1 + self.jitter * random.uniform(-1, 1)
+        time.sleep(max(latency, 0))
+        return max(latency, 0)
+
+    def route_mode(self, data_path, mode_label, trip):
+        recording = self._recording(data_path, trip)
+        latency = self._wait_latency(mode_label)
+        # Shallow copy: postprocess_itinerary never modifies its input, but attrs must not be shared.
+        itinerary_df = recording[mode_label].copy(deep=False) if mode_label in recording else pd.DataFrame()
+        itinerary_df.attrs["stage_seconds"] = {"replay_latency": latency}
+        return itinerary_df
+
+    def route_batch_mode(self, data_path, mode_label, batch):
+        """
+        Every origin/destination pair gets its nearest recording, after one mode
+        latency for the whole batch, as a single r5r batch call would.
+        """
+        pair_dfs = []
+        for origin_idx, (lat_ori, lon_ori) in enumerate(batch["origins"]):
+            for destination_idx, (lat_des, lon_des) in enumerate(batch["destinations"]):
+                recording = self._recording(data_path, {"lat_ori": lat_ori, "lon_ori": lon_ori, "lat_des": lat_des, "lon_des": lon_des})
+                if mode_label in recording:
+                    pair_dfs.append(recording[mode_label].assign(od_origin_id=f"o{origin_idx}", od_destination_id=f"d{destination_idx}"))
+        latency = self._wait_latency(mode_label)
+        itinerary_df = pd.concat(pair_dfs, ignore_index=True) if pair_dfs else pd.DataFrame()
+        itinerary_df.attrs["stage_seconds"] = {"replay_latency": latency}
+        return itinerary_df
+
+    def travel_time_distribution(self, data_path, mode_label, trip):
+        """
+        The recorded duration of the mode's fastest option for every percentile.
+        """
+        itinerary_df = self._recording(data_path, trip).get(mode_label)
+        if itinerary_df is None or "segment_duration" not in itinerary_df.columns:
+            return None
+        option = itinerary_df["option"] if "option" in itinerary_df.columns else pd.Series(1, index=itinerary_df.index)
+        minutes = int(itinerary_df["segment_duration"].groupby(option).sum().min()) + MODE_DURATION_OFFSETS.get(mode_label, 0)
+        return {"p10": minutes, "p50": minutes, "p90": minutes}
+
+
+ROUTING_BACKENDS = {"r5r": R5RBackend, "replay": ReplayBackend}
+# The ROUTING_BACKEND instance of this process, created on first use.
+_ROUTING_BACKEND_INSTANCE = None
+
+
+def get_routing_backend():
+    global _ROUTING_BACKEND_INSTANCE
+    if _ROUTING_BACKEND_INSTANCE is None:
+        if ROUTING_BACKEND not in ROUTING_BACKENDS:
+            raise ValueError(f"Unknown ROUTING_BACKEND {ROUTING_BACKEND!r}, expected one of {sorted(ROUTING_BACKENDS)}.")
+        _ROUTING_BACKEND_INSTANCE = ROUTING_BACKENDS[ROUTING_BACKEND]()
+    return _ROUTING_BACKEND_INSTANCE
+
+
+def init_routing_backend(data_path):
+    """
+    Loads the routing backend of this process and returns its load timings. Used
+    as the initializer of routing pool workers.
+    """
+    return get_routing_backend().load(data_path)
+
+
+def run_mode_job(data_path, mode_label, trip):
+    """
+    Computes the raw itinerary table of one travel mode with this process's
+    routing backend. Stage timings travel back in df.attrs["stage_seconds"]
+    (see _call_r_ipc), plus "arrive_by_sweep" for arrive-by trips.
+    """
+    return get_routing_backend().route_mode(data_path, mode_label, trip)
+
+
+def run_time_window_job(data_path, mode_label, trip):
+    """
+    Distribution of mode_label's door-to-door travel time over the departures in
+    [trip["departure"], + trip["time_window_min"] minutes), from a single r5r
+    time_window call. Returns {"p10", "p50", "p90"} in minutes (mode offset
+    included), or None when the destination is not reachable.
+    """
+    return get_routing_backend().travel_time_distribution(data_path, mode_label, trip)
+
+
+def get_service_index(data_path):
+    """
+    The TransitServiceIndex of data_path's GTFS feed, built on first use, or None
+    when it cannot be built (BUS segments then go without service fields).
+    """
+    if data_path not in SERVICE_INDEXES:
+        try:
+            SERVICE_INDEXES[data_path] = TransitServiceIndex.from_data_path(data_path)
+        except (OSError, ValueError, KeyError) as exc:
+            print(f"Transit service index unavailable for {data_path}: {exc}")
+            SERVICE_INDEXES[data_path] = None
+    return SERVICE_INDEXES[data_path]
+
+
+def service_date(departure_datetime_str):
+    """
+    GTFS service day ("%Y%m%d") of a "%d-%m-%Y %H:%M:%S" departure. r5r's
+    departure_time columns are times of day only, so the date has to come from the request.
+    """
+    return datetime.strptime(departure_datetime_str, "%d-%m-%Y %H:%M:%S").strftime("%Y%m%d")
+
+
+def postprocess_itinerary(itinerary_df, mode_label):
+    """
+    Columnar post-processing of one mode's raw r5r itinerary table: segment
+    endpoints taken from the geometries, departure times propagated along each
+    option (adding BUS wait times), and the mode's fixed duration offset added
+    to the first segment of every option. Cost stays flat in the number of options.
+    """
+    if itinerary_df is None or itinerary_df.empty:
+        return pd.DataFrame()
+
+    df = itinerary_df.drop(columns=['total_duration', 'total_distance'], errors='ignore')
+    if 'option' not in df.columns:
+        df['option'] = 1
+    # Keep options contiguous, in order of first appearance.
+    option_order = pd.factorize(df['option'])[0]
+    df = df.iloc[np.argsort(option_order, kind='stable')].reset_index(drop=True)
+    is_first_segment = df.groupby('option', sort=False).cumcount() == 0
+
+    if 'geometry' in df.columns:
+        # Missing cells must be None: where(..., None) keeps NaN in str-dtype columns, which from_wkt rejects.
+        geometries = df['geometry'].to_numpy(dtype=object)
+        geometries = np.where(pd.isna(geometries), None, geometries)
+        if pd.api.types.infer_dtype(geometries, skipna=True) == 'string':
+            geometries = shapely.from_wkt(geometries)
+        df['geometry'] = geometries
+        start_points = shapely.get_point(geometries, 0)
+        end_points = shapely.get_point(geometries, -1)
+        df['from_lat'] = shapely.get_y(start_points)
+        df['from_lon'] = shapely.get_x(start_points)
+        df['to_lat'] = shapely.get_y(end_points)
+        df['to_lon'] = shapely.get_x(end_points)
+
+    if 'departure_time' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['departure_time']):
+        df['departure_time'] = pd.to_datetime(df['departure_time'], errors='coerce')
+    if 'segment_duration' in df.columns:
+        df['segment_duration'] = pd.to_numeric(df['segment_duration'], errors='coerce')
+
+    if 'departure_time' in df.columns and 'segment_duration' in df.columns:
+        # departure[j] = departure[j-1] + segment_duration[j-1] (+ wait[j] when segment j is a BUS leg)
+        options = df.groupby('option', sort=False)
+        previous_duration = options['segment_duration'].shift(1).fillna(0)
+        bus_wait = pd.to_numeric(df['wait'], errors='coerce').fillna(0).where(df['mode'] == 'BUS', 0) if 'wait' in df.columns else 0
+        step_minutes = (previous_duration + bus_wait).mask(is_first_segment, 0)
+        elapsed_minutes = step_minutes.groupby(df['option'], sort=False).cumsum()
+        df['departure_time'] = options['departure_time'].transform('first') + pd.to_timedelta(elapsed_minutes, unit='m')
+
+    df['Mode_Transport'] = mode_label
+    duration_offset = MODE_DURATION_OFFSETS.get(mode_label, 0)
+    if duration_offset and 'segment_duration' in df.columns:
+        df.loc[is_first_segment, 'segment_duration'] = df.loc[is_first_segment, 'segment_duration'].fillna(0) + duration_offset
+    return df
+
+
+def _tagged_mode_result(mode_label, get_result):
+    """
+    get_result(), with the travel mode's label put in the travel_mode attribute of any exception it raises.
+    """
     try:
-        pandas2ri.activate()
-    except DeprecationWarning:
-        pass  # Ignore deprecation error so FastAPI doesn't return 500
+        return get_result()
+    except Exception as exc:
+        exc.travel_mode = mode_label
+        raise
 
-    ro.r('if(exists("detailed_itinerary_wt", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_wt) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_wt) && inherits(.GlobalEnv$detailed_itinerary_wt$geometry, "sfc") ) {{ .GlobalEnv$detailed_itinerary_wt$geometry_wkt <- sf::st_as_text(.GlobalEnv$detailed_itinerary_wt$geometry); .GlobalEnv$detailed_itinerary_wt$geometry <- NULL }} else if (exists("detailed_itinerary_wt", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_wt) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_wt) && is.character(.GlobalEnv$detailed_itinerary_wt$geometry) ) {{ setnames(.GlobalEnv$detailed_itinerary_wt, "geometry", "geometry_wkt") }} else if (exists("detailed_itinerary_wt", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_wt) > 0) {{ .GlobalEnv$detailed_itinerary_wt$geometry_wkt <- NA_character_ }} else if (exists("detailed_itinerary_wt", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_wt$geometry_wkt <- character(0) }} else {{ .GlobalEnv$detailed_itinerary_wt <- data.frame(geometry_wkt=character(0)) }}')
 
-    ro.r('if(exists("detailed_itinerary_wt", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_wt <- as.data.frame(.GlobalEnv$detailed_itinerary_wt) }} else {{ .GlobalEnv$detailed_itinerary_wt <- data.frame() }}')
+def process_r5r(data_path, origin_str, destination_str, 
+                walk_time = 20, bicycle_time = 20, max_trip_duration = 120, car_time = 5,
+                transit_freq_window_min = 60, # New parameter
+                departure_datetime_str = DEFAULT_DEPARTURE_DATETIME, arrive_by = False, time_window_min = None,
+                executor = None, archive_dir = None, on_mode_done = None):
+    """
+    Runs all travel modes for one origin/destination pair and returns the labeled
+    trip summary as a DataFrame. With an executor from create_routing_pool the
+    modes run concurrently on separate workers, otherwise they run one after
+    another in this process. If archive_dir is given, the summary is also
+    written there as CSV.
 
-    detailed_itinerary_df_walk_transit = pandas2ri.rpy2py(ro.r('.GlobalEnv$detailed_itinerary_wt'))
+    departure_datetime_str ("%d-%m-%Y %H:%M:%S", Europe/Paris) is the departure,
+    or the latest arrival when arrive_by is set (each mode then leaves as late as
+    it can). With time_window_min, the travel-time distribution of every mode
+    over that many minutes of departures is put in
+    df.attrs["travel_time_distribution"].
 
-    if 'geometry_wkt' in detailed_itinerary_df_walk_transit.columns:
-        detailed_itinerary_df_walk_transit.rename(columns={'geometry_wkt': 'geometry'}, inplace=True)
+    on_mode_done(mode_label, labeled_df), if given, is called with each mode's
+    post-processed itineraries as soon as that mode finishes (in completion
+    order when running on an executor); labeled_df may be empty.
 
+    Where the time went is put in df.attrs["stage_seconds"]: per mode the
+    stages of run_mode_job plus "job" (its wall time as seen here; with an
+    executor, from submission to completion) and "postprocess", then "concat",
+    "archive" and "total". BUS segments get last_bus_time and
+    frequency(buses per hour) from the feed's TransitServiceIndex ("service_fields"
+    stage). Memory samples taken by the mode jobs are listed in
+    df.attrs["session_memory"]. An exception raised by a mode job carries that
+    mode's label in its travel_mode attribute.
+    """
+    started = time.perf_counter()
+    if arrive_by and time_window_min:
+        raise ValueError("time_window_min cannot be combined with arrive_by.")
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"The data path {data_path} does not exist. Please verify the path.")
 
-    # -------- CAR --------
-    ro.r(f"""
-    library(r5r)
-    library(data.table)
-    origin_r_dt_direct_c <- data.table(id = "origin", lat = .GlobalEnv$lat_ori_r_glob, lon = .GlobalEnv$lon_ori_r_glob)
-    destination_r_dt_direct_c <- data.table(id = "destination", lat = .GlobalEnv$lat_des_r_glob, lon = .GlobalEnv$lon_des_r_glob)
-    departure_datetime_r_obj_c <- as.POSIXct(.GlobalEnv$departure_datetime_str_glob, format = "%d-%m-%Y %H:%M:%S", tz = "Europe/Paris")
-    mode_car_r <- "CAR"
+    origin_coords = origin_str.split(',')
+    destination_coords = destination_str.split(',')
 
-    .GlobalEnv$detailed_itinerary_c <- detailed_itineraries(
-        .GlobalEnv$r5r_core_glob,
-        origins = origin_r_dt_direct_c,
-        destinations = destination_r_dt_direct_c,
-        mode = mode_car_r,
-        departure_datetime = departure_datetime_r_obj_c,
-        max_trip_duration = .GlobalEnv$max_trip_duration_r_glob, 
-        shortest_path = TRUE 
-    )
-    """)
-    ro.r('if(exists("detailed_itinerary_c", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_c) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_c) && inherits(.GlobalEnv$detailed_itinerary_c$geometry, "sfc") ) {{ .GlobalEnv$detailed_itinerary_c$geometry_wkt <- sf::st_as_text(.GlobalEnv$detailed_itinerary_c$geometry); .GlobalEnv$detailed_itinerary_c$geometry <- NULL }} else if (exists("detailed_itinerary_c", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_c) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_c) && is.character(.GlobalEnv$detailed_itinerary_c$geometry) ) {{ setnames(.GlobalEnv$detailed_itinerary_c, "geometry", "geometry_wkt") }} else if (exists("detailed_itinerary_c", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_c) > 0) {{ .GlobalEnv$detailed_itinerary_c$geometry_wkt <- NA_character_ }} else if(exists("detailed_itinerary_c", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_c$geometry_wkt <- character(0) }} else {{ .GlobalEnv$detailed_itinerary_c <- data.frame(geometry_wkt=character(0)) }}')
-    ro.r('if(exists("detailed_itinerary_c", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_c <- as.data.frame(.GlobalEnv$detailed_itinerary_c) }} else {{ .GlobalEnv$detailed_itinerary_c <- data.frame() }}')
-    detailed_itinerary_df_car = pandas2ri.rpy2py(ro.r('.GlobalEnv$detailed_itinerary_c'))
-    if 'geometry_wkt' in detailed_itinerary_df_car.columns:
-        detailed_itinerary_df_car.rename(columns={'geometry_wkt': 'geometry'}, inplace=True)
-
-    # -------- BICYCLE --------
-    ro.r(f"""
-    library(r5r)
-    library(data.table)
-    origin_r_dt_direct_b <- data.table(id = "origin", lat = .GlobalEnv$lat_ori_r_glob, lon = .GlobalEnv$lon_ori_r_glob)
-    destination_r_dt_direct_b <- data.table(id = "destination", lat = .GlobalEnv$lat_des_r_glob, lon = .GlobalEnv$lon_des_r_glob)
-    departure_datetime_r_obj_b <- as.POSIXct(.GlobalEnv$departure_datetime_str_glob, format = "%d-%m-%Y %H:%M:%S", tz = "Europe/Paris")
-    mode_bicycle_r <- "BICYCLE"
-
-    .GlobalEnv$detailed_itinerary_b <- detailed_itineraries(
-        .GlobalEnv$r5r_core_glob,
-        origins = origin_r_dt_direct_b,
-        destinations = destination_r_dt_direct_b,
-        mode = mode_bicycle_r,
-        departure_datetime = departure_datetime_r_obj_b,
-        max_trip_duration = .GlobalEnv$max_trip_duration_r_glob, 
-        shortest_path = TRUE 
-    )
-    """)
-    ro.r('if(exists("detailed_itinerary_b", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_b) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_b) && inherits(.GlobalEnv$detailed_itinerary_b$geometry, "sfc") ) {{ .GlobalEnv$detailed_itinerary_b$geometry_wkt <- sf::st_as_text(.GlobalEnv$detailed_itinerary_b$geometry); .GlobalEnv$detailed_itinerary_b$geometry <- NULL }} else if (exists("detailed_itinerary_b", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_b) > 0 && "geometry" %in% names(.GlobalEnv$detailed_itinerary_b) && is.character(.GlobalEnv$detailed_itinerary_b$geometry) ) {{ setnames(.GlobalEnv$detailed_itinerary_b, "geometry", "geometry_wkt") }} else if (exists("detailed_itinerary_b", envir = .GlobalEnv) && nrow(.GlobalEnv$detailed_itinerary_b) > 0) {{ .GlobalEnv$detailed_itinerary_b$geometry_wkt <- NA_character_ }} else if(exists("detailed_itinerary_b", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_b$geometry_wkt <- character(0) }} else {{ .GlobalEnv$detailed_itinerary_b <- data.frame(geometry_wkt=character(0)) }}')
-    ro.r('if(exists("detailed_itinerary_b", envir = .GlobalEnv)) {{ .GlobalEnv$detailed_itinerary_b <- as.data.frame(.GlobalEnv$detailed_itinerary_b) }} else {{ .GlobalEnv$detailed_itinerary_b <- data.frame() }}')
-    detailed_itinerary_df_bicycle = pandas2ri.rpy2py(ro.r('.GlobalEnv$detailed_itinerary_b'))
-    if 'geometry_wkt' in detailed_itinerary_df_bicycle.columns:
-        detailed_itinerary_df_bicycle.rename(columns={'geometry_wkt': 'geometry'}, inplace=True)
-
-    globalenv['data_path_r'] = data_path 
-    # Create departure_datetime_r in R's global environment once for the optimal park & ride logic
-    ro.r(".GlobalEnv$departure_datetime_r <- as.POSIXct(.GlobalEnv$departure_datetime_str_glob, format = '%d-%m-%Y %H:%M:%S', tz = 'Europe/Paris')")
-    # CORRECTED: Use the Python function parameter transit_freq_window_min
-    globalenv['transit_freq_window_min_r'] = float(transit_freq_window_min) 
-    globalenv['max_walk_time_itinerary_min_r'] = float(walk_time) 
-    
-    # -------- BICYCLE + TRANSIT (Optimal Parking) --------
-    globalenv['max_access_time_min_r'] = float(bicycle_time) 
-    globalenv['max_walk_to_stop_min_r'] = float(walk_time) 
-    globalenv['access_mode_r'] = "BICYCLE"
-    ro.r("""
-    .GlobalEnv$origin_r <- data.table(id = "origin", lat = .GlobalEnv$lat_ori_r_glob, lon = .GlobalEnv$lon_ori_r_glob)
-    .GlobalEnv$destination_r <- data.table(id = "destination", lat = .GlobalEnv$lat_des_r_glob, lon = .GlobalEnv$lon_des_r_glob)
-    """)
-    ro.r(f"""
-    library(r5r); library(sf); library(data.table); library(lubridate)
-    {R_OPTIMAL_PARK_AND_RIDE_LOGIC}
-    """)
-    detailed_itinerary_df_bicycle_transit = pandas2ri.rpy2py(ro.r('.GlobalEnv$det_df_final'))
-    if 'geometry_wkt' in detailed_itinerary_df_bicycle_transit.columns:
-        detailed_itinerary_df_bicycle_transit.rename(columns={'geometry_wkt': 'geometry'}, inplace=True)
-
-    # -------- CAR + TRANSIT (Optimal Parking) --------
-    globalenv['max_access_time_min_r'] = float(car_time) 
-    globalenv['max_walk_to_stop_min_r'] = float(walk_time) 
-    globalenv['access_mode_r'] = "CAR"
-    ro.r("""
-    .GlobalEnv$origin_r <- data.table(id = "origin", lat = .GlobalEnv$lat_ori_r_glob, lon = .GlobalEnv$lon_ori_r_glob)
-    .GlobalEnv$destination_r <- data.table(id = "destination", lat = .GlobalEnv$lat_des_r_glob, lon = .GlobalEnv$lon_des_r_glob)
-    """)
-    ro.r(f"""
-    library(r5r); library(sf); library(data.table); library(lubridate)
-    {R_OPTIMAL_PARK_AND_RIDE_LOGIC}
-    """)
-    detailed_itinerary_df_car_transit = pandas2ri.rpy2py(ro.r('.GlobalEnv$det_df_final'))
-    if 'geometry_wkt' in detailed_itinerary_df_car_transit.columns:
-        detailed_itinerary_df_car_transit.rename(columns={'geometry_wkt': 'geometry'}, inplace=True)
-    
-    # -------- Process all DataFrames --------
-    det_iten_lst = []
-    if detailed_itinerary_df_walk_transit is not None and not detailed_itinerary_df_walk_transit.empty:
-        det_iten_lst.append(detailed_itinerary_df_walk_transit)
-    if detailed_itinerary_df_car is not None and not detailed_itinerary_df_car.empty:
-        det_iten_lst.append(detailed_itinerary_df_car)
-    if detailed_itinerary_df_bicycle_transit is not None and not detailed_itinerary_df_bicycle_transit.empty:
-         det_iten_lst.append(detailed_itinerary_df_bicycle_transit) 
-    if detailed_itinerary_df_car_transit is not None and not detailed_itinerary_df_car_transit.empty:
-        det_iten_lst.append(detailed_itinerary_df_car_transit) 
-    if detailed_itinerary_df_bicycle is not None and not detailed_itinerary_df_bicycle.empty:
-        det_iten_lst.append(detailed_itinerary_df_bicycle)
-
-    fin_det_iten_lst = []
-    for idx, det_df_current in enumerate(det_iten_lst):
-        if det_df_current.empty: 
-            fin_det_iten_lst.append(pd.DataFrame())
-            continue
-        if 'departure_time' in det_df_current.columns:
-            if not pd.api.types.is_datetime64_any_dtype(det_df_current['departure_time']):
-                try:
-                    det_df_current['departure_time'] = pd.to_datetime(det_df_current['departure_time'], errors='coerce')
-                except Exception as e:
-                    print(f"Warning: Could not convert 'departure_time' to datetime for df index {idx}. Error: {e}")
-        dfs_options = []
-        if 'option' not in det_df_current.columns: 
-            if not det_df_current.empty:
-                det_df_current['option'] = 1 
-            else:
-                fin_det_iten_lst.append(pd.DataFrame()) 
-                continue
-        options = det_df_current['option'].unique()
-        for opt_val in options:
-            samp_df = det_df_current[det_df_current['option'] == opt_val].copy() 
-            cols_to_drop = ['total_duration', 'total_distance']
-            existing_cols_to_drop = [col for col in cols_to_drop if col in samp_df.columns]
-            if existing_cols_to_drop:
-                samp_df = samp_df.drop(columns=existing_cols_to_drop)
-            if 'geometry' in samp_df.columns and not samp_df['geometry'].empty and samp_df['geometry'].iloc[0] is not None:
-                if isinstance(samp_df['geometry'].iloc[0], str):
-                    try:
-                        samp_df['geometry'] = samp_df['geometry'].apply(lambda x: loads(x) if pd.notnull(x) else None)
-                    except Exception as e:
-                        samp_df['geometry'] = None 
-                if 'geometry' in samp_df.columns and samp_df['geometry'].iloc[0] is not None : 
-                    try:
-                        samp_df['from_lat'] = samp_df['geometry'].apply(lambda geom: geom.coords[0][1] if geom and hasattr(geom, 'coords') and len(geom.coords) > 0 else None)
-                        samp_df['from_lon'] = samp_df['geometry'].apply(lambda geom: geom.coords[0][0] if geom and hasattr(geom, 'coords') and len(geom.coords) > 0 else None)
-                        samp_df['to_lat'] = samp_df['geometry'].apply(lambda geom: geom.coords[-1][1] if geom and hasattr(geom, 'coords') and len(geom.coords) > 0 else None)
-                        samp_df['to_lon'] = samp_df['geometry'].apply(lambda geom: geom.coords[-1][0] if geom and hasattr(geom, 'coords') and len(geom.coords) > 0 else None)
-                    except Exception as e:
-                         print(f"Error extracting coordinates for option {opt_val}: {e}")
-            if 'departure_time' in samp_df.columns and 'segment_duration' in samp_df.columns and \
-               pd.api.types.is_datetime64_any_dtype(samp_df['departure_time']):
-                for j in range(1, len(samp_df)):
-                    try:
-                        segment_duration_val = pd.to_numeric(samp_df['segment_duration'].iloc[j-1], errors='coerce')
-                        if pd.isna(segment_duration_val): continue 
-                        segment_duration_td = pd.to_timedelta(segment_duration_val, unit='m')
-                        current_departure_time = samp_df['departure_time'].iloc[j-1]
-                        if pd.isna(current_departure_time): continue 
-                        if samp_df['mode'].iloc[j] == 'BUS' and 'wait' in samp_df.columns:
-                            wait_val = pd.to_numeric(samp_df['wait'].iloc[j], errors='coerce')
-                            wait_td = pd.to_timedelta(wait_val if pd.notnull(wait_val) else 0, unit='m')
-                            samp_df.loc[samp_df.index[j], 'departure_time'] = current_departure_time + segment_duration_td + wait_td
-                        else: 
-                             samp_df.loc[samp_df.index[j], 'departure_time'] = current_departure_time + segment_duration_td
-                    except Exception as e:
-                        print(f"Error processing departure time adjustment for option {opt_val}, row {j}: {e}")
-            dfs_options.append(samp_df)
-        if dfs_options:
-            fin_df_option = pd.concat(dfs_options, ignore_index=True)
-            fin_det_iten_lst.append(fin_df_option)
-        elif not det_df_current.empty: 
-            fin_det_iten_lst.append(det_df_current) 
-    
-    temp_labeled_dfs = []
-    original_df_map = [
-        (detailed_itinerary_df_walk_transit, "Walk+Transit"),
-        (detailed_itinerary_df_car, "CAR"),
-        (detailed_itinerary_df_bicycle_transit, "Bicycle+Transit"),
-        (detailed_itinerary_df_car_transit, "Car+Transit"),
-        (detailed_itinerary_df_bicycle, "Bicycle")
-    ]
-    processed_idx = 0 
-    for original_df, label in original_df_map:
-        if original_df is not None and not original_df.empty:
-            if processed_idx < len(fin_det_iten_lst):
-                current_processed_df = fin_det_iten_lst[processed_idx]
-                if not current_processed_df.empty:
-                    current_processed_df['Mode_Transport'] = label
-                    if 'segment_duration' in current_processed_df.columns:
-                        current_processed_df['segment_duration'] = pd.to_numeric(current_processed_df['segment_duration'], errors='coerce')
-                        if len(current_processed_df) > 0: # Make sure there is a row 0
-                            if label == "CAR":
-                                current_processed_df.loc[0, 'segment_duration'] = (current_processed_df.loc[0, 'segment_duration'] if pd.notnull(current_processed_df.loc[0, 'segment_duration']) else 0) + 10
-                            elif label == "Bicycle+Transit":
-                                current_processed_df.loc[0, 'segment_duration'] = (current_processed_df.loc[0, 'segment_duration'] if pd.notnull(current_processed_df.loc[0, 'segment_duration']) else 0) + 5
-                            elif label == "Car+Transit":
-                                current_processed_df.loc[0, 'segment_duration'] = (current_processed_df.loc[0, 'segment_duration'] if pd.notnull(current_processed_df.loc[0, 'segment_duration']) else 0) + 10
-                            elif label == "Bicycle":
-                                current_processed_df.loc[0, 'segment_duration'] = (current_processed_df.loc[0, 'segment_duration'] if pd.notnull(current_processed_df.loc[0, 'segment_duration']) else 0) + 5
-                    temp_labeled_dfs.append(current_processed_df)
-                else: 
-                    temp_labeled_dfs.append(pd.DataFrame())
-                processed_idx += 1
-            else: 
-                temp_labeled_dfs.append(pd.DataFrame())
-        else: 
-            temp_labeled_dfs.append(pd.DataFrame())
-
-    fin_det_iten_lst_non_empty = [df for df in temp_labeled_dfs if df is not None and not df.empty]
+    trip = {
+        "lat_ori": float(origin_coords[0]),
+        "lon_ori": float(origin_coords[1]),
+        "lat_des": float(destination_coords[0]),
+        "lon_des": float(destination_coords[1]),
+        "walk_time": walk_time,
+        "bicycle_time": bicycle_time,
+        "max_trip_duration": max_trip_duration,
+        "car_time": car_time,
+        "transit_freq_window_min": transit_freq_window_min,
+        "departure": departure_datetime_str,
+        "arrive_by": arrive_by,
+        "time_window_min": time_window_min
+    }
+
+    window_labels = MODE_LABELS if time_window_min else []
+    labeled_results = {}
+    mode_seconds = {}
+    memory_samples = []
+    service_index = get_service_index(data_path)
+    trip_service_date = service_date(departure_datetime_str)
+
+    def finish_mode(label, itinerary_df, job_seconds):
+        if "session_memory" in itinerary_df.attrs:
+            memory_samples.append(itinerary_df.attrs["session_memory"])
+        postprocess_started = time.perf_counter()
+        labeled_results[label] = postprocess_itinerary(itinerary_df, label)
+        service_fields_started = time.perf_counter()
+        if service_index is not None:
+            service_index.attach(labeled_results[label], trip_service_date)
+        mode_seconds[label] = {**itinerary_df.attrs.get("stage_seconds", {}), "job": job_seconds,
+                               "postprocess": service_fields_started - postprocess_started,
+                               "service_fields": time.perf_counter() - service_fields_started}
+        if on_mode_done is not None:
+            on_mode_done(label, labeled_results[label])
+
+    if executor is not None:
+        submitted = time.perf_counter()
+        futures = {executor.submit(run_mode_job, data_path, label, trip): label for label in MODE_LABELS}
+        window_futures = {label: executor.submit(run_time_window_job, data_path, label, trip) for label in window_labels}
+        for future in as_completed(futures):
+            label = futures[future]
+            finish_mode(label, _tagged_mode_result(label, future.result), time.perf_counter() - submitted)
+        travel_time_distribution = {label: future.result() for label, future in window_futures.items()}
+    else:
+        for label in MODE_LABELS:
+            job_started = time.perf_counter()
+            itinerary_df = _tagged_mode_result(label, lambda: run_mode_job(data_path, label, trip))
+            finish_mode(label, itinerary_df, time.perf_counter() - job_started)
+        travel_time_distribution = {label: run_time_window_job(data_path, label, trip) for label in window_labels}
+
+    labeled_dfs = [labeled_results[label] for label in MODE_LABELS]
+    stage_seconds = {"modes": mode_seconds}
+    # Keep only the latest sample per process.
+    memory_samples = list({sample["pid"]: sample for sample in memory_samples}.values())
+
+    fin_det_iten_lst_non_empty = [df for df in labeled_dfs if not df.empty]
     if not fin_det_iten_lst_non_empty:
         print("All resulting DataFrames are empty. Returning an empty DataFrame.")
-        return pd.DataFrame()
+        empty_df = pd.DataFrame()
+        empty_df.attrs["stage_seconds"] = {**stage_seconds, "total": time.perf_counter() - started}
+        empty_df.attrs["session_memory"] = memory_samples
+        return empty_df
 
+    concat_started = time.perf_counter()
     fin_2_concat = pd.concat(fin_det_iten_lst_non_empty, ignore_index=True)
-    os.makedirs("outputs", exist_ok=True)
-    filename = f"trip_summary_{uuid.uuid4().hex}.csv"
-    file_path = os.path.join("outputs", filename)
-    fin_2_concat.to_csv(file_path, index=False)
+    stage_seconds["concat"] = time.perf_counter() - concat_started
+    if time_window_min:
+        fin_2_concat.attrs["travel_time_distribution"] = travel_time_distribution
+    if archive_dir:
+        archive_started = time.perf_counter()
+        archive_trip_summary(fin_2_concat, archive_dir)
+        stage_seconds["archive"] = time.perf_counter() - archive_started
+    stage_seconds["total"] = time.perf_counter() - started
+    fin_2_concat.attrs["stage_seconds"] = stage_seconds
+    fin_2_concat.attrs["session_memory"] = memory_samples
 
+    return fin_2_concat
+
+
+def _parse_coordinates(coord_str):
+    lat, lon = coord_str.split(',')
+    return float(lat), float(lon)
+
+
+def _point_vectors(points, prefix):
+    lats, lons = zip(*points)
+    return StrVector([f"{prefix}{i}" for i in range(len(points))]), FloatVector(lats), FloatVector(lons)
+
+
+def run_batch_mode_job(data_path, mode_label, batch):
+    """
+    Computes the raw itinerary table of one travel mode for every
+    origin/destination pair of a batch with this process's routing backend.
+    Rows carry od_origin_id ("o<i>") and od_destination_id ("d<j>") so they can
+    be split back per pair. Raises NotImplementedError when the backend cannot
+    route batches.
+    """
+    backend = get_routing_backend()
+    if not hasattr(backend, "route_batch_mode"):
+        raise NotImplementedError(f"The {backend.name} routing backend cannot route batches.")
+    return backend.route_batch_mode(data_path, mode_label, batch)
+
+
+def process_r5r_batch(data_path, origin_strs, destination_strs,
+                      walk_time = 20, bicycle_time = 20, max_trip_duration = 120, car_time = 5,
+                      transit_freq_window_min = 60, departure_datetime_str = DEFAULT_DEPARTURE_DATETIME, executor = None,
+                      attrs = None):
+    """
+    Many-to-many version of process_r5r. Each travel mode is routed once for the
+    whole batch (all origins to all destinations), so the network, GTFS index
+    and parking/stop matrices are shared across pairs instead of being recomputed
+    per request. Returns a dict keyed "o<i>->d<j>" (indices into origin_strs and
+    destination_strs) of labeled trip summaries; pairs without any itinerary are
+    left out. BUS segments get the same service fields as in process_r5r.
+
+    If attrs (a dict) is given, it receives "stage_seconds" and "session_memory"
+    laid out as in process_r5r's df.attrs, per mode for the whole batch. An
+    exception raised by a mode job carries that mode's label in its travel_mode
+    attribute.
+    """
+    started = time.perf_counter()
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"The data path {data_path} does not exist. Please verify the path.")
+
+    batch = {
+        "origins": [_parse_coordinates(origin_str) for origin_str in origin_strs],
+        "destinations": [_parse_coordinates(destination_str) for destination_str in destination_strs],
+        "walk_time": walk_time,
+        "bicycle_time": bicycle_time,
+        "max_trip_duration": max_trip_duration,
+        "car_time": car_time,
+        "transit_freq_window_min": transit_freq_window_min,
+        "departure": departure_datetime_str
+    }
+
+    mode_results, mode_seconds = {}, {}
+    if executor is not None:
+        submitted = time.perf_counter()
+        futures = {executor.submit(run_batch_mode_job, data_path, label, batch): label for label in MODE_LABELS}
+        for future in as_completed(futures):
+            label = futures[future]
+            mode_results[label] = _tagged_mode_result(label, future.result)
+            mode_seconds[label] = {"job": time.perf_counter() - submitted}
+    else:
+        for label in MODE_LABELS:
+            job_started = time.perf_counter()
+            mode_results[label] = _tagged_mode_result(label, lambda: run_batch_mode_job(data_path, label, batch))
+            mode_seconds[label] = {"job": time.perf_counter() - job_started}
+
+    service_index = get_service_index(data_path)
+    batch_service_date = service_date(departure_datetime_str)
+    memory_samples = []
+    pair_dfs = {}
+    for label in MODE_LABELS:
+        batch_df = mode_results[label]
+        if batch_df is None:
+            continue
+        mode_seconds[label] = {**batch_df.attrs.get("stage_seconds", {}), **mode_seconds[label]}
+        if "session_memory" in batch_df.attrs:
+            memory_samples.append(batch_df.attrs["session_memory"])
+        if batch_df.empty:
+            continue
+        postprocess_started = time.perf_counter()
+        for (origin_id, destination_id), pair_df in batch_df.groupby(['od_origin_id', 'od_destination_id'], sort=False):
+            labeled_df = postprocess_itinerary(pair_df.drop(columns=['od_origin_id', 'od_destination_id']), label)
+            if service_index is not None:
+                service_index.attach(labeled_df, batch_service_date)
+            pair_dfs.setdefault(f"{origin_id}->{destination_id}", []).append(labeled_df)
+        mode_seconds[label]["postprocess"] = time.perf_counter() - postprocess_started
+
+    if attrs is not None:
+        attrs["stage_seconds"] = {"modes": mode_seconds, "total": time.perf_counter() - started}
+        attrs["session_memory"] = list({sample["pid"]: sample for sample in memory_samples}.values())
+    return {
+        pair_key: pd.concat(dfs, ignore_index=True)
+        for pair_key, dfs in sorted(pair_dfs.items(), key=lambda item: _pair_sort_key(item[0]))
+    }
+
+
+def _pair_sort_key(pair_key):
+    origin_id, destination_id = pair_key.split('->')
+    return int(origin_id[1:]), int(destination_id[1:])
+
+
+def travel_time_matrix_job(data_path, mode_label, origins, destinations,
+                           walk_time = 20, max_trip_duration = 120, departure_datetime_str = DEFAULT_DEPARTURE_DATETIME):
+    """
+    Runs r5r's travel_time_matrix for one direct travel mode between two point
+    sets given as DataFrames with id, lat and lon columns. Returns from_id,
+    to_id and travel_time (minutes) for the pairs reachable within
+    max_trip_duration.
+    """
+    if mode_label not in DIRECT_MODES:
+        raise ValueError(f"No travel time matrix for travel mode: {mode_label}")
+    init_r5r_core(data_path)
+    r_mode, max_walk_time, _ = DIRECT_MODES[mode_label]
+    return _call_r_ipc(
+        "travel_time_matrix_ipc",
+        StrVector(origins["id"].astype(str).tolist()), FloatVector(origins["lat"].astype(float).tolist()), FloatVector(origins["lon"].astype(float).tolist()),
+        StrVector(destinations["id"].astype(str).tolist()), FloatVector(destinations["lat"].astype(float).tolist()), FloatVector(destinations["lon"].astype(float).tolist()),
+        StrVector(r_mode), departure_datetime_str,
+        float(walk_time) if max_walk_time else float("inf"), float(max_trip_duration)
+    )
+
+
+def archive_trip_summary(trip_summary_df, archive_dir="outputs"):
+    """
+    Writes a trip summary to <archive_dir>/trip_summary_<uuid>.csv and returns the path.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    filename = f"trip_summary_{uuid.uuid4().hex}.csv"
+    file_path = os.path.join(archive_dir, filename)
+    trip_summary_df.to_csv(file_path, index=False)
     return file_path
@@ -0,0 +1,74 @@
+# testing/geometry_encoding.py
+
+import numpy as np
+import shapely
+
+# Supported values of InputRequest.geometry_encoding.
+GEOMETRY_ENCODINGS = ("wkt", "polyline", "quantized", "geojson")
+
+# Decimal places kept by each encoding (1e-5 deg ~ 1 m, 1e-6 deg ~ 0.1 m).
+POLYLINE_PRECISION = 5
+QUANTIZED_PRECISION = 6
+GEOJSON_PRECISION = 6
+
+
+def simplify_tolerance_for_zoom(zoom, pixel_tolerance=1.0):
+    """
+    Returns the Douglas-Peucker tolerance (in degrees) matching `pixel_tolerance`
+    screen pixels on a 256 px web-mercator tile at the given zoom level.
+    """
+    return pixel_tolerance * 360.0 / (256 * 2 ** zoom)
+
+
+def _delta_encode(coords, precision):
+    scaled = np.round(coords * 10 ** precision).astype(np.int64)
+    return np.diff(scaled, axis=0, prepend=np.zeros((1, scaled.shape[1]), dtype=np.int64))
+
+
+def encode_polyline(coords):
+    """
+    Google encoded polyline of an (n, 2) lon/lat array, at POLYLINE_PRECISION.
+    """
+    chars = []
+    for value in _delta_encode(coords[:, ::-1], POLYLINE_PRECISION).ravel().tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return "".join(chars)
+
+
+def encode_quantized(coords):
+    """
+    Flat list [lon0, lat0, dlon1, dlat1, ...] of integers scaled by 10**QUANTIZED_PRECISION,
+    each pair after the first being the delta from the previous vertex.
+    """
+    return _delta_encode(coords, QUANTIZED_PRECISION).ravel().tolist()
+
+
+def encode_geojson(coords):
+    return np.round(coords, GEOJSON_PRECISION).tolist()
+
+
+def encode_geometries(geometries, encoding="wkt", simplify_zoom=None):
+    """
+    Encodes a sequence of shapely geometries (or WKT strings) for the API response.
+    If simplify_zoom is given, lines are first simplified with Douglas-Peucker at
+    a tolerance of about one pixel at that zoom. Missing geometries stay None.
+    """
+    if encoding not in GEOMETRY_ENCODINGS:
+        raise ValueError(f"Unknown geometry encoding: {encoding}")
+
+    geoms = np.array([
+        shapely.from_wkt(geom) if isinstance(geom, str) else geom if isinstance(geom, shapely.Geometry) else None
+        for geom in geometries
+    ], dtype=object)
+    if simplify_zoom is not None:
+        geoms = shapely.simplify(geoms, simplify_tolerance_for_zoom(simplify_zoom), preserve_topology=False)
+
+    if encoding == "wkt":
+        return [shapely.to_wkt(geom, rounding_precision=-1) if geom is not None else None for geom in geoms]
+
+    encoder = {"polyline": encode_polyline, "quantized": encode_quantized, "geojson": encode_geojson}[encoding]
+    return [encoder(shapely.get_coordinates(geom)) if geom is not None else None for geom in geoms]
@@ -0,0 +1,190 @@
+# testing/hexgrid_store.py
+
+import os
+import json
+import argparse
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from result_cache import HexgridSnapper, network_fingerprint
+
+# Travel modes stored by default: the direct modes, which r5r's travel_time_matrix
+# computes exactly (park-and-ride needs the parking choice of process_r5r).
+STORE_MODES = ("Walk+Transit", "CAR", "Bicycle")
+# Minutes between origins and destinations, one uint16 per cell pair; unreachable pairs hold UNREACHABLE.
+UNREACHABLE = np.iinfo(np.uint16).max
+MANIFEST_NAME = "manifest.json"
+CELLS_NAME = "cells.csv"
+
+
+def matrix_file_name(mode_label, bucket):
+    return f"{mode_label.replace('+', '_').lower()}_{bucket.replace(':', '')}.u16"
+
+
+def matrix_entries(travel_times):
+    """
+    (rows, cols, minutes) of a travel_time_matrix_job result, ready to write into a
+    store matrix. Pairs without a travel time are left out, so they keep UNREACHABLE;
+    finite times are capped just below it.
+    """
+    minutes = pd.to_numeric(travel_times["travel_time"], errors="coerce")
+    reachable = minutes.notna().to_numpy()
+    rows = travel_times["from_id"].astype(int).to_numpy()[reachable]
+    cols = travel_times["to_id"].astype(int).to_numpy()[reachable]
+    return rows, cols, np.clip(minutes.to_numpy()[reachable], 0, UNREACHABLE - 1).astype(np.uint16)
+
+
+def build_store(data_path, store_dir, modes=STORE_MODES, departure_times=("07:00",),
+                walk_time=20, max_trip_duration=120, chunk_size=250, executor=None):
+    """
+    Precomputes all-to-all travel times between metz_hexgrid.csv cells for each
+    mode and departure time ("HH:MM" on the day of DEFAULT_DEPARTURE_DATETIME)
+    and writes them to store_dir as memory-mappable uint16 matrices. Origins are
+    routed in chunks of chunk_size cells, in parallel when an executor from
+    create_routing_pool is given. The new store replaces the old one only once
+    it is complete.
+    """
+    from functions import travel_time_matrix_job, DEFAULT_DEPARTURE_DATETIME, MODE_DURATION_OFFSETS
+
+    snapper = HexgridSnapper(os.path.join(data_path, "metz_hexgrid.csv"))
+    cell_count = len(snapper.cell_ids)
+    cells = pd.DataFrame({"id": np.arange(cell_count).astype(str), "lat": snapper.cell_lats, "lon": snapper.cell_lons})
+    service_date = DEFAULT_DEPARTURE_DATETIME.split(" ")[0]
+
+    staging_dir = store_dir.rstrip(os.sep) + ".staging"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    pd.DataFrame({"id": snapper.cell_ids, "lon": snapper.cell_lons, "lat": snapper.cell_lats}).to_csv(
+        os.path.join(staging_dir, CELLS_NAME), index=False)
+
+    for mode_label in modes:
+        for bucket in departure_times:
+            print(f"Building {mode_label} travel times for {bucket} ({cell_count} x {cell_count} cells)...")
+            matrix = np.memmap(os.path.join(staging_dir, matrix_file_name(mode_label, bucket)),
+                               dtype=np.uint16, mode="w+", shape=(cell_count, cell_count))
+            matrix[:] = UNREACHABLE
+            job_args = dict(walk_time=walk_time, max_trip_duration=max_trip_duration,
+                            departure_datetime_str=f"{service_date} {bucket}:00")
+            chunks = [cells.iloc[start:start + chunk_size] for start in range(0, cell_count, chunk_size)]
+            if executor is not None:
+                results = (future.result() for future in
+                           [executor.submit(travel_time_matrix_job, data_path, mode_label, chunk, cells, **job_args) for chunk in chunks])
+            else:
+                results = (travel_time_matrix_job(data_path, mode_label, chunk, cells, **job_args) for chunk in chunks)
+            for travel_times in results:
+                if travel_times.empty:
+                    continue
+                rows, cols, minutes = matrix_entries(travel_times)
+                matrix[rows, cols] = minutes
+            matrix.flush()
+            del matrix
+
+    manifest = {
+        "cell_count": cell_count,
+        "modes": list(modes),
+        "departure_times": sorted(departure_times),
+        "service_date": service_date,
+        "walk_time": walk_time,
+        "max_trip_duration": max_trip_duration,
+        "duration_offsets": {mode_label: MODE_DURATION_OFFSETS.get(mode_label, 0) for mode_label in modes},
+        "network_fingerprint": network_fingerprint(data_path),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(staging_dir, MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(staging_dir, store_dir)
+    return manifest
+
+
+class HexgridTravelTimeStore:
+    """
+    Read side of a store written by build_store. Matrices are memory-mapped on
+    first use, so a lookup is one snap of each endpoint plus one array read per mode.
+    """
+
+    def __init__(self, store_dir, max_snap_distance_m=500.0):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.snapper = HexgridSnapper(os.path.join(store_dir, CELLS_NAME), max_snap_distance_m)
+        self._matrices = {}
+
+    def is_stale(self, data_path):
+        return network_fingerprint(data_path) != self.manifest["network_fingerprint"]
+
+    def _matrix(self, mode_label, bucket):
+        if (mode_label, bucket) not in self._matrices:
+            cell_count = self.manifest["cell_count"]
+            self._matrices[(mode_label, bucket)] = np.memmap(
+                os.path.join(self.store_dir, matrix_file_name(mode_label, bucket)),
+                dtype=np.uint16, mode="r", shape=(cell_count, cell_count))
+        return self._matrices[(mode_label, bucket)]
+
+    def departure_bucket(self, departure_datetime_str):
+        """
+        Latest stored departure time not after the requested one ("%d-%m-%Y %H:%M:%S"),
+        or the earliest stored one.
+        """
+        requested = datetime.strptime(departure_datetime_str, "%d-%m-%Y %H:%M:%S").strftime("%H:%M")
+        buckets = self.manifest["departure_times"]
+        earlier = [bucket for bucket in buckets if bucket <= requested]
+        return earlier[-1] if earlier else buckets[0]
+
+    def _cell(self, coord_str):
+        lat, lon = (float(value) for value in coord_str.split(","))
+        cell_idx, distance_m = self.snapper.nearest(lat, lon)
+        return cell_idx if distance_m <= self.snapper.max_snap_distance_m else None
+
+    def estimate(self, origin_str, destination_str, departure_datetime_str):
+        """
+        Approximate door-to-door minutes per stored mode between the cells of
+        origin and destination (mode offsets included, as in process_r5r), or
+        None when either point lies outside the grid.
+        """
+        origin_idx, destination_idx = self._cell(origin_str), self._cell(destination_str)
+        if origin_idx is None or destination_idx is None:
+            return None
+        bucket = self.departure_bucket(departure_datetime_str)
+        durations = {}
+        for mode_label in self.manifest["modes"]:
+            minutes = int(self._matrix(mode_label, bucket)[origin_idx, destination_idx])
+            durations[mode_label] = None if minutes == UNREACHABLE else minutes + self.manifest["duration_offsets"].get(mode_label, 0)
+        reachable = {mode_label: minutes for mode_label, minutes in durations.items() if minutes is not None}
+        fastest_mode = min(reachable, key=reachable.get) if reachable else None
+        return {
+            "origin_cell": str(self.snapper.cell_ids[origin_idx]),
+            "destination_cell": str(self.snapper.cell_ids[destination_idx]),
+            "departure_bucket": bucket,
+            "durations_min": durations,
+            "fastest_mode": fastest_mode,
+            "fastest_duration_min": reachable.get(fastest_mode),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the hexgrid travel-time store used by /estimate.")
+    parser.add_argument("--data-path", required=True, help="r5r data directory containing metz_hexgrid.csv")
+    parser.add_argument("--out", required=True, help="store directory (replaced when the build completes)")
+    parser.add_argument("--modes", nargs="+", default=list(STORE_MODES), choices=list(STORE_MODES))
+    parser.add_argument("--departures", nargs="+", default=["07:00"], help="departure times as HH:MM")
+    parser.add_argument("--walk-time", type=int, default=20)
+    parser.add_argument("--max-trip-duration", type=int, default=120)
+    parser.add_argument("--chunk-size", type=int, default=250)
+    parser.add_argument("--workers", type=int, default=0, help="routing worker processes (0 = this process only)")
+    args = parser.parse_args()
+
+    pool = None
+    if args.workers:
+        from functions import create_routing_pool
+        pool = create_routing_pool(args.data_path, args.workers)
+    try:
+        build_store(args.data_path, args.out, args.modes, args.departures,
+                    args.walk_time, args.max_trip_duration, args.chunk_size, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
@@ -156,82 +156,434 @@
 
 # testing/main.py
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import pandas as pd
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, Response
+from pydantic import BaseModel, Field
 import numpy as np
 import os
 import json
-from collections import defaultdict
-
-from functions import process_r5r  
-from typing import Optional
-
-
-app = FastAPI()
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from contextlib import asynccontextmanager, nullcontext
+
+from functions import (process_r5r, process_r5r_batch, create_routing_pool, init_routing_backend, get_routing_backend,
+                       get_service_index, warmup_trips, ROUTING_WORKERS, DEFAULT_DEPARTURE_DATETIME, MODE_LABELS)
+from result_cache import HexgridSnapper, TripResultCache, SingleFlight, FlightWaitRejected
+from hexgrid_store import HexgridTravelTimeStore, MANIFEST_NAME
+from metrics import create_metrics, CONTENT_TYPE_LATEST
+from geometry_encoding import encode_geometries, POLYLINE_PRECISION, QUANTIZED_PRECISION, GEOJSON_PRECISION
+from service_index import SERVICE_COLUMNS, SERVICE_FIELD_MODES
+from typing import List, Optional, Literal
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+try:
+    import orjson
+
+    def dumps_json(value):
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    def dumps_json(value):
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+# Serving mode: with USE_ROUTING_POOL=1 every request fans out to a pool of isolated
+# routing workers (one R session and r5r_core each); otherwise requests share the
+# R session of this process one at a time.
+USE_ROUTING_POOL = os.environ.get("USE_ROUTING_POOL", "0") == "1"
+# Requests admitted at once (running or waiting for a worker); beyond that /process answers 503.
+MAX_PENDING_REQUESTS = int(os.environ.get("MAX_PENDING_REQUESTS", 2 * ROUTING_WORKERS))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", 5))
+# Largest origins x destinations product accepted by /process/batch.
+MAX_BATCH_PAIRS = int(os.environ.get("MAX_BATCH_PAIRS", 400))
+# Optional directory where every trip summary is also archived as CSV.
+TRIP_ARCHIVE_DIR = os.environ.get("TRIP_ARCHIVE_DIR")
+# Result cache in front of /process (see result_cache.py). RESULT_CACHE_DIR enables the
+# disk tier shared by all workers pointing at it; leave it unset for memory only.
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 256))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+# Identical /process requests arriving while one is being routed wait for its result.
+COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "1") == "1"
+# Each waiting request holds a server thread: beyond this many waiting at once, or after
+# waiting this long, coalesced requests are answered 503 like any request over admission.
+MAX_COALESCED_WAITING = int(os.environ.get("MAX_COALESCED_WAITING", MAX_PENDING_REQUESTS))
+COALESCE_WAIT_SECONDS = float(os.environ.get("COALESCE_WAIT_SECONDS", 120))
+# Precomputed cell-to-cell travel times served by /estimate (built with hexgrid_store.py).
+HEXGRID_STORE_DIR = os.environ.get("HEXGRID_STORE_DIR")
+# Trips from metz_points_of_interest.csv routed at startup, before /ready reports ready.
+WARMUP_QUERIES = int(os.environ.get("WARMUP_QUERIES", 3))
+# Finished /jobs are kept this long for polling and event replay.
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 600))
+# Idle /jobs/{id}/events streams send a comment this often to keep proxies from closing them.
+SSE_HEARTBEAT_SECONDS = 15
+
+# Startup warnings go to uvicorn's log.
+LOGGER = logging.getLogger("uvicorn.error")
+
+ROUTING_POOL = None
+RESULT_CACHE = None
+HEXGRID_STORE = None
+# Whether HEXGRID_STORE was built from another network or GTFS feed than DEFAULT_DATA_PATH holds.
+HEXGRID_STORE_STALE = False
+INFLIGHT_REQUESTS = SingleFlight(max_waiting=MAX_COALESCED_WAITING, wait_timeout=COALESCE_WAIT_SECONDS)
+ADMISSION_SLOTS = threading.BoundedSemaphore(MAX_PENDING_REQUESTS)
+# Prometheus metrics served on /metrics; None when prometheus_client is not installed.
+METRICS = create_metrics()
+# The embedded R interpreter is not thread-safe, so inline requests are serialized.
+R_SESSION_LOCK = threading.Lock()
+# Progress of warm_up_service, reported by /health and /ready.
+STARTUP_STATE = {"status": "starting", "started_at": None, "ready_at": None, "load_seconds": {},
+                 "warmup": [], "startup_seconds": None, "error": None}
+
+
+def warm_up_service():
+    """
+    Loads the network, GTFS index and parking data (in every routing worker when
+    serving with a pool) and then routes WARMUP_QUERIES trips end to end, so the
+    JVM is warm before the service reports ready.
+    """
+    startup_started = time.perf_counter()
+    try:
+        if ROUTING_POOL is not None:
+            # One job per worker spawns them all; each returns its own load breakdown.
+            init_jobs = [ROUTING_POOL.submit(init_routing_backend, DEFAULT_DATA_PATH) for _ in range(ROUTING_WORKERS)]
+            STARTUP_STATE["load_seconds"] = {f"worker_{i}": job.result() for i, job in enumerate(init_jobs)}
+        else:
+            with routing_session():
+                STARTUP_STATE["load_seconds"] = init_routing_backend(DEFAULT_DATA_PATH)
+        # Service fields are attached in this process, after the mode jobs return.
+        index_started = time.perf_counter()
+        get_service_index(DEFAULT_DATA_PATH)
+        STARTUP_STATE["load_seconds"]["service_index"] = round(time.perf_counter() - index_started, 3)
+        for origin_str, destination_str in warmup_trips(DEFAULT_DATA_PATH, WARMUP_QUERIES):
+            query_started = time.perf_counter()
+            warmup_entry = {"origin": origin_str, "destination": destination_str}
+            try:
+                warmup_entry["rows"] = len(run_process_r5r(DEFAULT_DATA_PATH, origin_str=origin_str, destination_str=destination_str))
+            except Exception as exc:
+                # A trip without itineraries still warmed the routing path; it must not block readiness.
+                warmup_entry["error"] = str(exc)
+            warmup_entry["seconds"] = round(time.perf_counter() - query_started, 3)
+            STARTUP_STATE["warmup"].append(warmup_entry)
+        STARTUP_STATE["status"] = "ready"
+        STARTUP_STATE["ready_at"] = datetime.now().isoformat(timespec="seconds")
+    except Exception as exc:
+        STARTUP_STATE["status"] = "failed"
+        STARTUP_STATE["error"] = str(exc)
+    STARTUP_STATE["startup_seconds"] = round(time.perf_counter() - startup_started, 3)
+
+
+def require_ready():
+    if STARTUP_STATE["status"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Routing service is {STARTUP_STATE['status']}, please retry later.",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global ROUTING_POOL, RESULT_CACHE, HEXGRID_STORE, HEXGRID_STORE_STALE
+    if METRICS is None:
+        LOGGER.warning("prometheus_client is not installed: /metrics will answer 503.")
+    if HEXGRID_STORE_DIR and os.path.exists(os.path.join(HEXGRID_STORE_DIR, MANIFEST_NAME)):
+        HEXGRID_STORE = HexgridTravelTimeStore(HEXGRID_STORE_DIR)
+        HEXGRID_STORE_STALE = HEXGRID_STORE.is_stale(DEFAULT_DATA_PATH)
+        if HEXGRID_STORE_STALE:
+            LOGGER.warning(f"The hexgrid store in {HEXGRID_STORE_DIR} was built from another network or GTFS feed "
+                           f"than {DEFAULT_DATA_PATH} holds; /estimate answers are flagged stale until it is rebuilt.")
+    if RESULT_CACHE_ENABLED:
+        RESULT_CACHE = TripResultCache(
+            DEFAULT_DATA_PATH,
+            HexgridSnapper(os.path.join(DEFAULT_DATA_PATH, "metz_hexgrid.csv")),
+            ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+            max_entries=RESULT_CACHE_MAX_ENTRIES,
+            disk_dir=RESULT_CACHE_DIR
+        )
+    if USE_ROUTING_POOL:
+        ROUTING_POOL = create_routing_pool(DEFAULT_DATA_PATH)
+    # Loading runs in the background so /health answers during startup; routing
+    # endpoints and /ready return 503 until it has finished.
+    STARTUP_STATE["started_at"] = datetime.now().isoformat(timespec="seconds")
+    threading.Thread(target=warm_up_service, name="warm-up", daemon=True).start()
+    yield
+    if ROUTING_POOL is not None:
+        ROUTING_POOL.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+# Route geometries dominate the payload; compress responses larger than ~1 KB.
+# Brotli is used when available (it falls back to gzip for clients without br support).
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=1000)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+
+@app.middleware("http")
+async def record_http_metrics(request: Request, call_next):
+    if METRICS is None:
+        return await call_next(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template (/jobs/{job_id}), not by raw path, to keep the label set bounded.
+        route = request.scope.get("route")
+        METRICS.observe_http(route.path if route is not None else "unmatched", request.method, status,
+                             time.perf_counter() - started)
 
 
-class InputRequest(BaseModel):
+class TripParameters(BaseModel):
     data_path: Optional[str] = None
-    origin_str: str
-    destination_str: str
     walk_time: int = 20
     bicycle_time: int = 20
     max_trip_duration: int = 120
     car_time: int = 5
     transit_freq_window_min: int = 60
+    geometry_encoding: Literal["wkt", "polyline", "quantized", "geojson"] = "wkt"
+    # Web map zoom level (0-22) the geometries are simplified for; None keeps them as routed.
+    simplify_zoom: Optional[int] = Field(default=None, ge=0, le=22)
+    # Local (Europe/Paris) time unless an offset is given; defaults to DEFAULT_DEPARTURE_DATETIME.
+    departure_time: Optional[datetime] = None
+
+
+class InputRequest(TripParameters):
+    origin_str: str
+    destination_str: str
+    # Treat departure_time as the latest arrival instead.
+    arrive_by: bool = False
+    # Also return p10/p50/p90 travel times over this many minutes of departures.
+    time_window_min: Optional[int] = None
+
 
+class BatchInputRequest(TripParameters):
+    origins: List[str]
+    destinations: List[str]
 
 
-DEFAULT_DATA_PATH = "/home/student-02-b0eb41bdfc2c/Travel_Demo/test_isit/metz/metz"
+class EstimateRequest(BaseModel):
+    origin_str: str
+    destination_str: str
+    departure_time: Optional[datetime] = None
+
+
+# Longest departure window accepted for time_window_min.
+MAX_TIME_WINDOW_MIN = 180
+
+
+def r5r_datetime(value):
+    """
+    Formats an optional request datetime the way the routing functions expect it.
+    """
+    if value is None:
+        return DEFAULT_DEPARTURE_DATETIME
+    if value.tzinfo is not None:
+        value = value.astimezone(ZoneInfo("Europe/Paris"))
+    return value.strftime("%d-%m-%Y %H:%M:%S")
+
+
+# r5r data directory (network, GTFS, parking points, hexgrid and points of interest).
+DEFAULT_DATA_PATH = os.environ.get("R5R_DATA_PATH", "/home/student-02-b0eb41bdfc2c/Travel_Demo/test_isit/metz/metz")
+
+def build_segment(row):
+    """
+    Maps one flat trip record to a segment of the Transport.json structure.
+    """
+    return {
+        "mode": row.get("mode"),
+        "order": row.get("segment"),  
+        "route_no": row.get("route"),
+        "source": {
+            "latitude": row.get("from_lat"),
+            "longitude": row.get("from_lon")
+        },
+        "destination": {
+            "latitude": row.get("to_lat"),
+            "longitude": row.get("to_lon")
+        },
+        "geometry": row.get("geometry"),
+        "duration": row.get("segment_duration"),
+        "distance": row.get("distance"),
+        "departure_time": row.get("departure_time"),
+        "wait_time": row.get("wait"),
+        "last_bus_time": row.get("last_bus_time"),
+        "buses_per_hour": row.get("frequency(buses per hour)")
+    }
+
+
+def index_routes(flat_data):
+    """
+    Groups row positions by mode and then by option in a single pass,
+    keeping the order in which modes and options first appear.
+    """
+    modes_index = {}
+    for row_idx, row in enumerate(flat_data):
+        modes_index.setdefault(row.get("Mode_Transport"), {}).setdefault(row.get("option"), []).append(row_idx)
+    return modes_index
+
 
 def build_transport_structure(flat_data):
     """
     Takes flat list of trip records and rearranges them
     into the hierarchical Transport.json structure (values unchanged).
     """
-    modes_dict = defaultdict(lambda: {"mode_type": None, "mode_lable": None, "routes": []})
-
-    for row in flat_data:
-        
-        mode_type = row.get("Mode_Transport")
-        mode_label = row.get("Mode_Transport")
-
-        route_option = row.get("option")
-
-        
-        if not modes_dict[mode_type]["mode_type"]:
-            modes_dict[mode_type]["mode_type"] = mode_type
-            modes_dict[mode_type]["mode_lable"] = mode_label
-
-        
-        route = next((r for r in modes_dict[mode_type]["routes"] if r["option"] == route_option), None)
-        if not route:
-            route = {"option": route_option, "segments": []}
-            modes_dict[mode_type]["routes"].append(route)
-
-        
-        segment = {
-            "mode": row.get("mode"),
-            "order": row.get("segment"),  
-            "route_no": row.get("route"),
-            "source": {
-                "latitude": row.get("from_lat"),
-                "longitude": row.get("from_lon")
-            },
-            "destination": {
-                "latitude": row.get("to_lat"),
-                "longitude": row.get("to_lon")
-            },
-            "geometry": row.get("geometry"),
-            "duration": row.get("segment_duration"),
-            "distance": row.get("distance"),
-            "departure_time": row.get("departure_time"),
-            "wait_time": row.get("wait")
+    return {"transport_modes": [
+        {
+            "mode_type": mode_type,
+            "mode_lable": mode_type,
+            "routes": [
+                {"option": route_option, "segments": [build_segment(flat_data[row_idx]) for row_idx in row_ids]}
+                for route_option, row_ids in routes.items()
+            ]
         }
-        route["segments"].append(segment)
+        for mode_type, routes in index_routes(flat_data).items()
+    ]}
+
+
+def iter_transport_json(flat_data, extra_fields):
+    """
+    Streams {"transport_data": <Transport.json structure>, **extra_fields} as JSON
+    bytes. Each segment is encoded as soon as it is built, so the nested dict tree
+    of build_transport_structure is never materialized.
+    """
+    yield b'{"transport_data":{"transport_modes":['
+    for mode_idx, (mode_type, routes) in enumerate(index_routes(flat_data).items()):
+        yield (b"," if mode_idx else b"") + b'{"mode_type":' + dumps_json(mode_type) + b',"mode_lable":' + dumps_json(mode_type) + b',"routes":['
+        for route_idx, (route_option, row_ids) in enumerate(routes.items()):
+            segments = b",".join(dumps_json(build_segment(flat_data[row_idx])) for row_idx in row_ids)
+            yield (b"," if route_idx else b"") + b'{"option":' + dumps_json(route_option) + b',"segments":[' + segments + b"]}"
+        yield b"]}"
+    yield b"]}"
+    for key, value in extra_fields.items():
+        yield b"," + dumps_json(key) + b":" + dumps_json(value)
+    yield b"}"
+
+
+GEOMETRY_PRECISION = {"wkt": None, "polyline": POLYLINE_PRECISION, "quantized": QUANTIZED_PRECISION, "geojson": GEOJSON_PRECISION}
+
+
+def sanitize_trip_summary(df, geometry_encoding="wkt", simplify_zoom=None):
+    """
+    Converts a trip summary DataFrame into JSON-ready records in one pass:
+    NaN and +/-Infinity become None, timestamps become strings and geometries
+    are encoded with geometry_encoding (see geometry_encoding.py).
+    Returns the records and a log of where invalid values were found.
+    """
+    issues_log = []
+    missing = df.isna()
+    numeric = df.select_dtypes(include=[np.number])
+    pos_inf = np.isposinf(numeric)
+    neg_inf = np.isneginf(numeric)
+    # Service fields only apply to SERVICE_FIELD_MODES rows; empty elsewhere is expected.
+    not_applicable = ~df["mode"].isin(SERVICE_FIELD_MODES).to_numpy() if "mode" in df.columns else np.zeros(len(df), dtype=bool)
+
+    for col in df.columns:
+        reported = missing[col] & ~not_applicable if col in SERVICE_COLUMNS else missing[col]
+        if reported.any():
+            issues_log.append(f"Column '{col}' has NaN at rows: {df.index[reported].tolist()}")
+        if col in numeric.columns and pos_inf[col].any():
+            issues_log.append(f"Column '{col}' has +Infinity at rows: {df.index[pos_inf[col]].tolist()}")
+        if col in numeric.columns and neg_inf[col].any():
+            issues_log.append(f"Column '{col}' has -Infinity at rows: {df.index[neg_inf[col]].tolist()}")
+
+    if issues_log:
+        issues_log.append("⚠ These values were replaced with null in JSON.")
+
+    df = df.copy()
+    for col in df.select_dtypes(include=["datetime", "datetimetz"]).columns:
+        df[col] = df[col].dt.strftime("%Y-%m-%d %H:%M:%S")
+    if "geometry" in df.columns:
+        df["geometry"] = encode_geometries(df["geometry"], geometry_encoding, simplify_zoom)
+
+    invalid = missing | (pos_inf | neg_inf).reindex(columns=df.columns, fill_value=False)
+    df = df.astype(object).mask(invalid, None)
+    return df.to_dict(orient="records"), issues_log
+
+
+def routing_session():
+    """
+    R_SESSION_LOCK when the routing backend uses this process's R session; the
+    replay backend is thread-safe and needs no lock.
+    """
+    return nullcontext() if get_routing_backend().thread_safe else R_SESSION_LOCK
 
-    return {"transport_modes": list(modes_dict.values())}
+
+def run_process_r5r(data_path, **kwargs):
+    """
+    Runs process_r5r on the routing pool when serving with workers, or on this
+    process's R session (one request at a time) otherwise.
+    """
+    try:
+        if ROUTING_POOL is not None:
+            trip_summary_df = process_r5r(data_path, executor=ROUTING_POOL, **kwargs)
+        else:
+            with routing_session():
+                trip_summary_df = process_r5r(data_path, **kwargs)
+    except Exception as exc:
+        if METRICS is not None:
+            METRICS.observe_routing_error(exc)
+        raise
+    if METRICS is not None:
+        METRICS.observe_trip(trip_summary_df)
+    return trip_summary_df
+
+
+def run_process_r5r_batch(data_path, **kwargs):
+    """
+    Batch counterpart of run_process_r5r.
+    """
+    batch_attrs = {}
+    try:
+        if ROUTING_POOL is not None:
+            pair_results = process_r5r_batch(data_path, executor=ROUTING_POOL, attrs=batch_attrs, **kwargs)
+        else:
+            with routing_session():
+                pair_results = process_r5r_batch(data_path, attrs=batch_attrs, **kwargs)
+    except Exception as exc:
+        if METRICS is not None:
+            METRICS.observe_routing_error(exc)
+        raise
+    if METRICS is not None:
+        METRICS.observe_batch(batch_attrs, pair_results)
+    return pair_results
+
+
+def iter_batch_json(pair_results, origins, destinations, geometry_encoding, simplify_zoom):
+    """
+    Streams the /process/batch response: one Transport.json object per
+    origin/destination pair under "od_pairs", each sanitized and encoded only
+    when it is reached.
+    """
+    yield b'{"od_pairs":{'
+    for pair_idx, (pair_key, trip_summary_df) in enumerate(pair_results.items()):
+        origin_id, destination_id = pair_key.split("->")
+        cleaned_data, issues_log = sanitize_trip_summary(trip_summary_df, geometry_encoding, simplify_zoom)
+        yield (b"," if pair_idx else b"") + dumps_json(pair_key) + b":"
+        yield from iter_transport_json(cleaned_data, {
+            "origin": origins[int(origin_id[1:])],
+            "destination": destinations[int(destination_id[1:])],
+            "issues_detected": bool(issues_log),
+            "log": issues_log
+        })
+    yield b"}"
+    yield b',"geometry_encoding":' + dumps_json(geometry_encoding)
+    yield b',"geometry_precision":' + dumps_json(GEOMETRY_PRECISION[geometry_encoding])
+    yield b"}"
 
 
 @app.get("/")
@@ -239,73 +591,387 @@ async def read_root():
     return {"message": "Welcome to the Trip Planner API"}
 
 
-@app.post("/process")
-def process_input(input_data: InputRequest):
-    data_path = DEFAULT_DATA_PATH
-    csv_path = process_r5r(
-        data_path,
+@app.get("/health")
+async def health():
+    """
+    Liveness: the process is up and startup has not failed. Includes the startup
+    progress and load-time breakdown.
+    """
+    if STARTUP_STATE["status"] == "failed":
+        raise HTTPException(status_code=503, detail=STARTUP_STATE)
+    return {"alive": True, **STARTUP_STATE}
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness: 200 once the network is loaded and the warm-up queries have run, 503 before.
+    """
+    if STARTUP_STATE["status"] != "ready":
+        raise HTTPException(status_code=503, detail=STARTUP_STATE, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    return STARTUP_STATE
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus exposition of request counts and latencies, per-mode and per-stage
+    routing histograms, mode outcomes, admission queue depth and JVM/R memory.
+    """
+    if METRICS is None:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed.")
+    return Response(METRICS.render(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    coalescing = {"enabled": COALESCE_REQUESTS, **INFLIGHT_REQUESTS.stats()}
+    if RESULT_CACHE is None:
+        return {"enabled": False, "coalescing": coalescing}
+    return {"enabled": True, **RESULT_CACHE.stats(), "coalescing": coalescing}
+
+
+def validate_trip_request(input_data):
+    if input_data.time_window_min is not None:
+        if input_data.arrive_by:
+            raise HTTPException(status_code=422, detail="time_window_min cannot be combined with arrive_by.")
+        if not 1 <= input_data.time_window_min <= MAX_TIME_WINDOW_MIN:
+            raise HTTPException(status_code=422, detail=f"time_window_min must be between 1 and {MAX_TIME_WINDOW_MIN}.")
+
+
+def trip_kwargs(input_data):
+    """
+    process_r5r keyword arguments of a /process or /jobs request.
+    """
+    return dict(
         origin_str=input_data.origin_str,
         destination_str=input_data.destination_str,
         walk_time=input_data.walk_time,
         bicycle_time=input_data.bicycle_time,
         max_trip_duration=input_data.max_trip_duration,
         car_time=input_data.car_time,
-        transit_freq_window_min=input_data.transit_freq_window_min
+        transit_freq_window_min=input_data.transit_freq_window_min,
+        departure_datetime_str=r5r_datetime(input_data.departure_time),
+        arrive_by=input_data.arrive_by,
+        time_window_min=input_data.time_window_min
     )
 
-    if not os.path.exists(csv_path):
-        raise HTTPException(status_code=404, detail="CSV file not found.")
 
-    try:
-        df = pd.read_csv(csv_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to read CSV: {e}")
-
-    issues_log = []
-    issues_found = False
+def cached_trip_summary(input_data):
+    """
+    Returns (cache key, cached trip summary or None); the key is None without a result cache.
+    """
+    if RESULT_CACHE is None:
+        return None, None
+    cache_key = RESULT_CACHE.key(
+        input_data.origin_str, input_data.destination_str,
+        input_data.walk_time, input_data.bicycle_time, input_data.car_time,
+        input_data.max_trip_duration, input_data.transit_freq_window_min,
+        r5r_datetime(input_data.departure_time), input_data.arrive_by, input_data.time_window_min
+    )
+    return cache_key, RESULT_CACHE.get(cache_key)
 
-    for col in df.columns:
-        nan_rows = df[df[col].isna()].index.tolist()
-        inf_rows = df[df[col] == float("inf")].index.tolist()
-        ninf_rows = df[df[col] == float("-inf")].index.tolist()
 
-        if nan_rows:
-            issues_log.append(f"Column '{col}' has NaN at rows: {nan_rows}")
-            issues_found = True
-        if inf_rows:
-            issues_log.append(f"Column '{col}' has +Infinity at rows: {inf_rows}")
-            issues_found = True
-        if ninf_rows:
-            issues_log.append(f"Column '{col}' has -Infinity at rows: {ninf_rows}")
-            issues_found = True
+def coalescing_key(input_data):
+    """
+    Exact identity of a routing request: coordinates normalized to 6 decimals
+    (about 10 cm) and every parameter that changes process_r5r's output.
+    Output-only options such as geometry_encoding are left out.
+    """
+    coordinates = [round(float(value), 6) for value in (*input_data.origin_str.split(","), *input_data.destination_str.split(","))]
+    return (tuple(coordinates), input_data.walk_time, input_data.bicycle_time, input_data.car_time,
+            input_data.max_trip_duration, input_data.transit_freq_window_min,
+            r5r_datetime(input_data.departure_time), input_data.arrive_by, input_data.time_window_min)
+
+
+def reject_routing_request():
+    if METRICS is not None:
+        METRICS.admission_rejections.inc()
+    raise HTTPException(
+        status_code=503,
+        detail="All routing workers are busy, please retry later.",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
 
-    if issues_found:
-        issues_log.append("⚠ These values were replaced with null in JSON and CSV.")
 
-    df.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df = df.astype(object).where(pd.notnull(df), None)
-    df.to_csv(csv_path, index=False)
+def admit_routing_request():
+    require_ready()
+    if not ADMISSION_SLOTS.acquire(blocking=False):
+        reject_routing_request()
+    if METRICS is not None:
+        METRICS.admitted_requests.inc()
 
-    cleaned_data = json.loads(df.to_json(orient="records"))
-    os.remove(csv_path)
 
-    
-    transformed_data = build_transport_structure(cleaned_data)
+def track_coalesced_wait(delta):
+    # A request waiting for an identical one is admitted work too.
+    if METRICS is not None:
+        METRICS.admitted_requests.inc(delta)
 
-    return {
-        "transport_data": transformed_data
-    }
 
+def release_routing_slot():
+    ADMISSION_SLOTS.release()
+    if METRICS is not None:
+        METRICS.admitted_requests.dec()
 
 
+def response_fields(input_data, trip_summary_df):
+    """
+    Fields sent next to transport_data: the timing and encoding of the request,
+    plus the travel-time distribution when a time window was requested.
+    """
+    fields = {
+        "departure_time" if not input_data.arrive_by else "arrival_time": r5r_datetime(input_data.departure_time),
+        "geometry_encoding": input_data.geometry_encoding,
+        "geometry_precision": GEOMETRY_PRECISION[input_data.geometry_encoding],
+    }
+    if input_data.time_window_min is not None:
+        fields["time_window_min"] = input_data.time_window_min
+        fields["travel_time_distribution"] = trip_summary_df.attrs.get("travel_time_distribution", {})
+    return fields
 
 
+@app.post("/process")
+def process_input(input_data: InputRequest):
+    data_path = DEFAULT_DATA_PATH
+    validate_trip_request(input_data)
+    cache_key, trip_summary_df = cached_trip_summary(input_data)
+
+    if trip_summary_df is None:
+        def route():
+            admit_routing_request()
+            try:
+                routed_df = run_process_r5r(data_path, **trip_kwargs(input_data), archive_dir=TRIP_ARCHIVE_DIR)
+            finally:
+                release_routing_slot()
+            if cache_key is not None and not routed_df.empty:
+                RESULT_CACHE.put(cache_key, routed_df)
+            return routed_df
+
+        if COALESCE_REQUESTS:
+            # sanitize_trip_summary works on a copy, so coalesced requests can share one DataFrame.
+            try:
+                trip_summary_df, _ = INFLIGHT_REQUESTS.run(coalescing_key(input_data), route, on_wait=track_coalesced_wait)
+            except FlightWaitRejected:
+                reject_routing_request()
+        else:
+            trip_summary_df = route()
+
+    if trip_summary_df.empty:
+        raise HTTPException(status_code=404, detail="No itineraries found for the given origin and destination.")
+
+    cleaned_data, issues_log = sanitize_trip_summary(trip_summary_df, input_data.geometry_encoding, input_data.simplify_zoom)
+    extra_fields = {**response_fields(input_data, trip_summary_df), "issues_detected": bool(issues_log), "log": issues_log}
+    return StreamingResponse(iter_transport_json(cleaned_data, extra_fields), media_type="application/json")
+
+
+class RoutingJob:
+    """
+    One /jobs submission. Events are only ever appended, so subscribers that
+    connect late (or reconnect) replay them from the start.
+    """
 
+    def __init__(self, input_data):
+        self.id = uuid.uuid4().hex
+        self.input_data = input_data
+        self.status = "queued"
+        self.finished_at = None
+        self.events = []
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def publish(self, event, data, status=None):
+        with self.condition:
+            self.events.append((event, data))
+            if status is not None:
+                self.status = status
+                if self.finished:
+                    self.finished_at = time.time()
+            self.condition.notify_all()
+
+    def wait_for_events(self, start, timeout):
+        """
+        Events from index start on, waiting up to timeout seconds for one to arrive.
+        """
+        with self.condition:
+            if len(self.events) <= start and not self.finished:
+                self.condition.wait(timeout)
+            return self.events[start:], self.finished
+
+
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+
+
+def mode_event_data(input_data, mode_label, labeled_df):
+    """
+    The "mode" event of one finished travel mode: its Transport.json entry
+    (None when the mode found no itinerary) and the sanitization log.
+    """
+    if labeled_df is None or labeled_df.empty:
+        return {"mode": mode_label, "transport_mode": None, "issues_detected": False, "log": []}
+    cleaned_data, issues_log = sanitize_trip_summary(labeled_df, input_data.geometry_encoding, input_data.simplify_zoom)
+    transport_modes = build_transport_structure(cleaned_data)["transport_modes"]
+    return {"mode": mode_label, "transport_mode": transport_modes[0] if transport_modes else None,
+            "issues_detected": bool(issues_log), "log": issues_log}
 
 
+def run_routing_job(job, cache_key, cached_df):
+    """
+    Runs a job in a background thread, publishing one "mode" event per travel
+    mode as it finishes and a final "done" (or "error") event. A job started
+    without a cached result holds an admission slot, released here.
+    """
+    input_data = job.input_data
 
+    def publish_mode(mode_label, labeled_df):
+        job.publish("mode", mode_event_data(input_data, mode_label, labeled_df))
 
+    try:
+        if cached_df is not None:
+            trip_summary_df = cached_df
+            # Same events as a live run: one per travel mode, empty for modes without itineraries.
+            mode_dfs = dict(tuple(trip_summary_df.groupby("Mode_Transport", sort=False))) if not trip_summary_df.empty else {}
+            for mode_label in MODE_LABELS:
+                publish_mode(mode_label, mode_dfs.get(mode_label))
+        else:
+            job.status = "running"
+            try:
+                trip_summary_df = run_process_r5r(DEFAULT_DATA_PATH, **trip_kwargs(input_data),
+                                                  archive_dir=TRIP_ARCHIVE_DIR, on_mode_done=publish_mode)
+            finally:
+                release_routing_slot()
+            if cache_key is not None and not trip_summary_df.empty:
+                RESULT_CACHE.put(cache_key, trip_summary_df)
+        job.publish("done", {**response_fields(input_data, trip_summary_df),
+                             "itineraries_found": not trip_summary_df.empty,
+                             "cached": cached_df is not None}, status="done")
+    except Exception as exc:
+        job.publish("error", {"error": str(exc)}, status="failed")
+
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job id.")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+def submit_job(input_data: InputRequest):
+    """
+    Starts routing in the background and returns a job id at once. Poll
+    /jobs/{id}, or subscribe to /jobs/{id}/events (Server-Sent Events) to get
+    each mode's segments as soon as that mode is done.
+    """
+    validate_trip_request(input_data)
+    cache_key, cached_df = cached_trip_summary(input_data)
+    if cached_df is None:
+        admit_routing_request()
+
+    job = RoutingJob(input_data)
+    expired_before = time.time() - JOB_TTL_SECONDS
+    with JOBS_LOCK:
+        for expired_id in [job_id for job_id, old_job in JOBS.items() if old_job.finished and old_job.finished_at < expired_before]:
+            del JOBS[expired_id]
+        JOBS[job.id] = job
+    threading.Thread(target=run_routing_job, args=(job, cache_key, cached_df), name=f"job-{job.id}", daemon=True).start()
+    return {"job_id": job.id, "status": job.status,
+            "poll_url": f"/jobs/{job.id}", "events_url": f"/jobs/{job.id}/events"}
+
+
+@app.get("/jobs/{job_id}")
+def poll_job(job_id: str):
+    """
+    Current state of a job: the modes finished so far and, once done, the final result fields.
+    """
+    job = get_job(job_id)
+    events, _ = job.wait_for_events(0, 0)
+    modes = [data for event, data in events if event == "mode"]
+    final = next((data for event, data in events if event in ("done", "error")), None)
+    return {"job_id": job.id, "status": job.status, "modes": modes, "result": final}
 
 
+@app.get("/jobs/{job_id}/events")
+def job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    """
+    Server-Sent Events stream of a job: one "mode" event per finished mode, then
+    "done" or "error". Honors Last-Event-ID so reconnecting clients resume.
+    """
+    job = get_job(job_id)
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    def iter_events():
+        next_index = start
+        while True:
+            events, finished = job.wait_for_events(next_index, SSE_HEARTBEAT_SECONDS)
+            if not events and not finished:
+                yield b": keep-alive\n\n"
+                continue
+            for event, data in events:
+                yield b"id: %d\nevent: %s\ndata: %s\n\n" % (next_index, event.encode(), dumps_json(data))
+                next_index += 1
+            if finished and next_index >= len(job.events):
+                return
+
+    return StreamingResponse(iter_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/process/batch")
+def process_batch_input(input_data: BatchInputRequest):
+    """
+    Routes every origin to every destination in one call. Each travel mode is
+    computed once for the whole batch, which is much cheaper than one /process
+    request per pair.
+    """
+    data_path = DEFAULT_DATA_PATH
+    if not input_data.origins or not input_data.destinations:
+        raise HTTPException(status_code=422, detail="origins and destinations must not be empty.")
+    if len(input_data.origins) * len(input_data.destinations) > MAX_BATCH_PAIRS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_PAIRS} origin/destination pairs.")
+    admit_routing_request()
+    try:
+        pair_results = run_process_r5r_batch(
+            data_path,
+            origin_strs=input_data.origins,
+            destination_strs=input_data.destinations,
+            walk_time=input_data.walk_time,
+            bicycle_time=input_data.bicycle_time,
+            max_trip_duration=input_data.max_trip_duration,
+            car_time=input_data.car_time,
+            transit_freq_window_min=input_data.transit_freq_window_min,
+            departure_datetime_str=r5r_datetime(input_data.departure_time)
+        )
+    except NotImplementedError as exc:
+        raise HTTPException(status_code=501, detail=str(exc))
+    finally:
+        release_routing_slot()
+
+    if not pair_results:
+        raise HTTPException(status_code=404, detail="No itineraries found for any origin/destination pair.")
+
+    return StreamingResponse(
+        iter_batch_json(pair_results, input_data.origins, input_data.destinations,
+                        input_data.geometry_encoding, input_data.simplify_zoom),
+        media_type="application/json"
+    )
 
 
+@app.post("/estimate")
+def estimate_input(input_data: EstimateRequest):
+    """
+    Duration-only answer (minutes per mode and the fastest mode) looked up in the
+    precomputed hexgrid store, without running r5r. Use /process for itineraries.
+    store_stale is true when the store predates the current network or GTFS feed.
+    """
+    if HEXGRID_STORE is None:
+        raise HTTPException(status_code=503, detail="No hexgrid travel-time store is loaded (set HEXGRID_STORE_DIR).")
+    estimate = HEXGRID_STORE.estimate(input_data.origin_str, input_data.destination_str, r5r_datetime(input_data.departure_time))
+    if estimate is None:
+        raise HTTPException(status_code=404, detail="Origin or destination is outside the hexgrid.")
+    return {**estimate, "approximate": True, "store_built_at": HEXGRID_STORE.manifest["built_at"],
+            "store_stale": HEXGRID_STORE_STALE}
@@ -0,0 +1,110 @@
+# testing/metrics.py
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+except ImportError:
+    CollectorRegistry = None
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# Routing stages range from a few milliseconds (post-processing) to tens of seconds (cold park-and-ride).
+ROUTING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+HTTP_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+class ServiceMetrics:
+    """
+    Prometheus metrics of the routing service, kept in a registry of their own.
+
+    Per-mode and per-stage histograms are fed from the stage timings process_r5r
+    leaves in df.attrs["stage_seconds"]: stage names are those of run_mode_job
+    ("r_call", "to_pandas", "postprocess", ...) and of the R stage clock
+    ("r.detailed_itineraries", "r.pnr_access_matrix", "r.pnr_parking_quality", ...).
+    """
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.http_requests = Counter(
+            "isit_http_requests", "HTTP requests by endpoint and status code.",
+            ["endpoint", "method", "status"], registry=self.registry)
+        self.http_seconds = Histogram(
+            "isit_http_request_seconds", "Time to the start of the response, by endpoint.",
+            ["endpoint"], buckets=HTTP_BUCKETS, registry=self.registry)
+        self.trip_seconds = Histogram(
+            "isit_routing_trip_seconds", "Wall time of process_r5r for one origin/destination pair.",
+            buckets=ROUTING_BUCKETS, registry=self.registry)
+        self.batch_seconds = Histogram(
+            "isit_routing_batch_seconds", "Wall time of process_r5r_batch for one /process/batch request.",
+            buckets=ROUTING_BUCKETS, registry=self.registry)
+        self.mode_seconds = Histogram(
+            "isit_routing_mode_seconds", "Wall time of one travel mode's job.",
+            ["mode"], buckets=ROUTING_BUCKETS, registry=self.registry)
+        self.stage_seconds = Histogram(
+            "isit_routing_stage_seconds", "Time spent in one stage of a travel mode's job.",
+            ["mode", "stage"], buckets=ROUTING_BUCKETS, registry=self.registry)
+        self.mode_outcomes = Counter(
+            "isit_routing_mode_outcomes", "Travel mode jobs by outcome (ok, empty or error).",
+            ["mode", "outcome"], registry=self.registry)
+        self.admitted_requests = Gauge(
+            "isit_admitted_requests", "Routing requests admitted and not finished (running, waiting for a worker or for an identical request).",
+            registry=self.registry)
+        self.admission_rejections = Counter(
+            "isit_admission_rejections", "Routing requests answered 503 because every admission slot was taken.",
+            registry=self.registry)
+        self.jvm_heap_used = Gauge(
+            "isit_jvm_heap_used_bytes", "Heap used by r5r's JVM, per routing process.", ["pid"], registry=self.registry)
+        self.jvm_heap_max = Gauge(
+            "isit_jvm_heap_max_bytes", "Maximum heap of r5r's JVM, per routing process.", ["pid"], registry=self.registry)
+        self.r_memory_used = Gauge(
+            "isit_r_memory_used_bytes", "Memory held by the R heap, per routing process.", ["pid"], registry=self.registry)
+
+    def observe_http(self, endpoint, method, status, seconds):
+        self.http_requests.labels(endpoint, method, str(status)).inc()
+        self.http_seconds.labels(endpoint).observe(seconds)
+
+    def observe_trip(self, trip_summary_df):
+        """
+        Records the stage timings, mode outcomes and memory samples of one process_r5r result.
+        """
+        modes_found = set(trip_summary_df["Mode_Transport"].unique()) if "Mode_Transport" in trip_summary_df.columns else set()
+        self._observe_routing(trip_summary_df.attrs, modes_found, self.trip_seconds)
+
+    def observe_batch(self, batch_attrs, pair_results):
+        """
+        Same for one process_r5r_batch call, given the attrs it filled and the trip
+        summaries it returned; a mode counts as found when any pair has it.
+        """
+        modes_found = set()
+        for trip_summary_df in pair_results.values():
+            if "Mode_Transport" in trip_summary_df.columns:
+                modes_found.update(trip_summary_df["Mode_Transport"].unique())
+        self._observe_routing(batch_attrs, modes_found, self.batch_seconds)
+
+    def _observe_routing(self, attrs, modes_found, total_histogram):
+        stage_seconds = attrs.get("stage_seconds", {})
+        if "total" in stage_seconds:
+            total_histogram.observe(stage_seconds["total"])
+        for mode_label, mode_stages in stage_seconds.get("modes", {}).items():
+            for stage, seconds in mode_stages.items():
+                if stage == "job":
+                    self.mode_seconds.labels(mode_label).observe(seconds)
+                else:
+                    self.stage_seconds.labels(mode_label, stage).observe(seconds)
+            self.mode_outcomes.labels(mode_label, "ok" if mode_label in modes_found else "empty").inc()
+        for sample in attrs.get("session_memory", []):
+            pid = str(sample["pid"])
+            self.jvm_heap_used.labels(pid).set(sample["jvm_heap_used_bytes"])
+            self.jvm_heap_max.labels(pid).set(sample["jvm_heap_max_bytes"])
+            self.r_memory_used.labels(pid).set(sample["r_used_bytes"])
+
+    def observe_routing_error(self, exc):
+        self.mode_outcomes.labels(getattr(exc, "travel_mode", "unknown"), "error").inc()
+
+    def render(self):
+        return generate_latest(self.registry)
+
+
+def create_metrics():
+    """
+    ServiceMetrics, or None when prometheus_client is not installed.
+    """
+    return ServiceMetrics() if CollectorRegistry is not None else None
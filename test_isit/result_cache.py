@@ -0,0 +1,320 @@
+# testing/result_cache.py
+
+import os
+import glob
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Files whose change invalidates every cached result: the street network, the GTFS
+# feed, r5r's network settings and the parking points used by park-and-ride.
+NETWORK_FILE_PATTERNS = ("*.pbf", "*.pbf.mapdb", "*.zip", "network.dat", "network_settings.json", "bike_park_metz.csv")
+
+EARTH_RADIUS_M = 6371000.0
+
+
+class HexgridSnapper:
+    """
+    Snaps coordinates to the nearest metz_hexgrid.csv cell. Points farther than
+    max_snap_distance_m from every cell centroid fall back to a coordinate grid
+    of `fallback_decimals` decimal places, so they still get a stable cell key.
+    """
+
+    def __init__(self, hexgrid_csv, max_snap_distance_m=500.0, fallback_decimals=3):
+        cells = pd.read_csv(hexgrid_csv, usecols=["id", "lon", "lat"]).drop_duplicates("id")
+        self.cell_ids = cells["id"].astype(str).to_numpy()
+        self.cell_lats = cells["lat"].to_numpy(dtype=float)
+        self.cell_lons = cells["lon"].to_numpy(dtype=float)
+        self.cell_lat_rad = np.radians(self.cell_lats)
+        self.cell_lon_rad = np.radians(self.cell_lons)
+        self.max_snap_distance_m = max_snap_distance_m
+        self.fallback_decimals = fallback_decimals
+
+    def nearest(self, lat, lon):
+        """
+        Index of the nearest cell centroid and its distance in metres
+        (equirectangular approximation, accurate at city scale).
+        """
+        lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+        dx = (self.cell_lon_rad - lon_rad) * np.cos((self.cell_lat_rad + lat_rad) / 2)
+        dy = self.cell_lat_rad - lat_rad
+        squared = dx * dx + dy * dy
+        cell_idx = int(np.argmin(squared))
+        return cell_idx, float(np.sqrt(squared[cell_idx]) * EARTH_RADIUS_M)
+
+    def cell_key(self, lat, lon):
+        cell_idx, distance_m = self.nearest(lat, lon)
+        if distance_m <= self.max_snap_distance_m:
+            return f"hex:{self.cell_ids[cell_idx]}"
+        return f"q:{round(lat, self.fallback_decimals)},{round(lon, self.fallback_decimals)}"
+
+
+def departure_bucket(departure_datetime_str, bucket_minutes=15):
+    """
+    Floors a "%d-%m-%Y %H:%M:%S" departure to the start of its bucket_minutes window.
+    """
+    departure = datetime.strptime(departure_datetime_str, "%d-%m-%Y %H:%M:%S")
+    minute_of_day = (departure.hour * 60 + departure.minute) // bucket_minutes * bucket_minutes
+    return f"{departure:%Y-%m-%d}T{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+
+def network_fingerprint(data_path):
+    """
+    Short hash of the names, sizes and modification times of the network and GTFS
+    files in data_path. Rebuilding the network or replacing the feed changes it.
+    """
+    digest = hashlib.md5()
+    for pattern in NETWORK_FILE_PATTERNS:
+        for file_path in sorted(glob.glob(os.path.join(data_path, pattern))):
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:12]
+
+
+class TripResultCache:
+    """
+    Two-tier cache of process_r5r trip summaries.
+
+    - memory tier: per-process LRU of up to max_entries DataFrames, each valid for ttl_seconds
+    - disk tier (optional): pickled DataFrames under <disk_dir>/<network fingerprint>/,
+      shared by every worker process pointing at the same directory
+
+    Keys combine the snapped origin/destination cells, the routing limits and the
+    departure bucket. When the network fingerprint changes both tiers are dropped.
+    """
+
+    def __init__(self, data_path, snapper, ttl_seconds=3600, max_entries=256, disk_dir=None,
+                 bucket_minutes=15, fingerprint_check_seconds=30):
+        self.data_path = data_path
+        self.snapper = snapper
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.bucket_minutes = bucket_minutes
+        self.fingerprint_check_seconds = fingerprint_check_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = network_fingerprint(data_path)
+        self._fingerprint_checked_at = time.monotonic()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def key(self, origin_str, destination_str, walk_time, bicycle_time, car_time,
+            max_trip_duration, transit_freq_window_min, departure_datetime_str,
+            arrive_by=False, time_window_min=None):
+        lat_ori, lon_ori = (float(value) for value in origin_str.split(","))
+        lat_des, lon_des = (float(value) for value in destination_str.split(","))
+        # An arrive-by answer computed for a later arrival could arrive too late, so arrivals are not bucketed.
+        timing = (f"arrive:{departure_datetime_str}" if arrive_by
+                  else f"{departure_bucket(departure_datetime_str, self.bucket_minutes)}+{time_window_min or 0}")
+        return "|".join([
+            self.snapper.cell_key(lat_ori, lon_ori),
+            self.snapper.cell_key(lat_des, lon_des),
+            f"w{walk_time}b{bicycle_time}c{car_time}m{max_trip_duration}f{transit_freq_window_min}",
+            timing,
+        ])
+
+    def _disk_path(self, key):
+        file_name = hashlib.sha1(key.encode()).hexdigest() + ".pkl"
+        return os.path.join(self.disk_dir, self._fingerprint, file_name)
+
+    def _check_fingerprint(self):
+        now = time.monotonic()
+        if now - self._fingerprint_checked_at < self.fingerprint_check_seconds:
+            return
+        self._fingerprint_checked_at = now
+        fingerprint = network_fingerprint(self.data_path)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops the memory tier and every disk entry not made with the current network fingerprint.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.counters["invalidations"] += 1
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for stale_dir in glob.glob(os.path.join(self.disk_dir, "*")):
+                if os.path.basename(stale_dir) == self._fingerprint:
+                    continue
+                for stale_file in glob.glob(os.path.join(stale_dir, "*")):
+                    try:
+                        os.remove(stale_file)
+                    except OSError:
+                        pass
+                try:
+                    os.rmdir(stale_dir)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """
+        Returns a copy of the cached trip summary for key, or None.
+        """
+        self._check_fingerprint()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[1].copy()
+            self._entries.pop(key, None)
+
+        if self.disk_dir:
+            disk_path = self._disk_path(key)
+            try:
+                stored_at = os.path.getmtime(disk_path)
+                if now - stored_at <= self.ttl_seconds:
+                    trip_summary_df = pd.read_pickle(disk_path)
+                    self._remember(key, trip_summary_df, stored_at)
+                    with self._lock:
+                        self.counters["disk_hits"] += 1
+                    return trip_summary_df.copy()
+                os.remove(disk_path)
+            except (OSError, EOFError, ValueError):
+                pass
+
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, trip_summary_df):
+        self._remember(key, trip_summary_df.copy(), time.time())
+        if self.disk_dir:
+            disk_path = self._disk_path(key)
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            # Write then rename, so other workers never read a partial file.
+            staging_path = f"{disk_path}.{uuid.uuid4().hex}.tmp"
+            trip_summary_df.to_pickle(staging_path)
+            os.replace(staging_path, disk_path)
+        with self._lock:
+            self.counters["stores"] += 1
+
+    def _remember(self, key, trip_summary_df, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, trip_summary_df)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_ratio": hits / lookups if lookups else None,
+                "memory_entries": len(self._entries),
+                "network_fingerprint": self._fingerprint,
+            }
+
+
+class FlightWaitRejected(Exception):
+    """
+    Raised to a SingleFlight follower that could not wait for the running
+    computation: too many callers were already waiting, or it outlasted the wait timeout.
+    """
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.started_at = time.monotonic()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical computations: the first caller of run() for a
+    key computes, callers arriving while it runs wait for that result (or error)
+    instead of starting their own. Nothing is kept once the computation ends;
+    that is the job of TripResultCache.
+
+    Each follower holds its caller's thread, so at most max_waiting callers
+    wait at once (across keys) and each for at most wait_timeout seconds;
+    the others get FlightWaitRejected.
+    """
+
+    def __init__(self, max_waiting=None, wait_timeout=None):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self.counters = {"computations": 0, "coalesced": 0, "failed_computations": 0, "saved_seconds": 0.0,
+                         "rejected_followers": 0, "timed_out_followers": 0}
+
+    def run(self, key, compute, on_wait=None):
+        """
+        Returns (result, coalesced): coalesced is True when the result came from
+        another caller's computation, in which case it is shared and must not be mutated.
+        on_wait(delta), if given, is called with 1 when this caller starts waiting
+        as a follower and with -1 when it stops.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.counters["computations"] += 1
+            elif self.max_waiting is not None and self._waiting >= self.max_waiting:
+                self.counters["rejected_followers"] += 1
+                raise FlightWaitRejected(f"{self._waiting} requests are already waiting for identical computations.")
+            else:
+                flight.followers += 1
+                self._waiting += 1
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            if on_wait is not None:
+                on_wait(1)
+            try:
+                finished = flight.done.wait(self.wait_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    if not finished:
+                        self.counters["timed_out_followers"] += 1
+                if on_wait is not None:
+                    on_wait(-1)
+            if not finished:
+                raise FlightWaitRejected(f"The identical computation did not finish within {self.wait_timeout} s.")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = compute()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is not None:
+                    self.counters["failed_computations"] += 1
+                # Every follower would have run the same computation for about as long.
+                self.counters["saved_seconds"] += flight.followers * (time.monotonic() - flight.started_at)
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        with self._lock:
+            requests = self.counters["computations"] + self.counters["coalesced"]
+            return {
+                **self.counters,
+                "saved_seconds": round(self.counters["saved_seconds"], 3),
+                "coalesced_ratio": self.counters["coalesced"] / requests if requests else None,
+                "in_flight": len(self._flights),
+                "waiting": self._waiting,
+            }
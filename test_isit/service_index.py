@@ -0,0 +1,273 @@
+# testing/service_index.py
+
+import os
+import re
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import zipfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from result_cache import EARTH_RADIUS_M
+
+# Itinerary segment modes that get last_bus_time and frequency(buses per hour).
+SERVICE_FIELD_MODES = ("BUS",)
+# Columns added by TransitServiceIndex.attach; they stay empty on rows of other modes.
+SERVICE_COLUMNS = ("last_bus_time", "frequency(buses per hour)")
+# A boarding point farther than this from every stop of its route is left without service fields.
+MAX_STOP_DISTANCE_M = 300.0
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+
+REQUIRED_GTFS_FILES = ("stops.txt", "stop_times.txt", "routes.txt", "trips.txt")
+# Abandoned staging directories older than this are removed from the GTFS cache.
+STAGING_MAX_AGE_S = 3600
+
+
+def _find_gtfs_file(directory, file_name):
+    """
+    Path of file_name in directory, matched case-insensitively like the R index does, or None.
+    """
+    for entry in sorted(os.listdir(directory)):
+        if entry.lower() == file_name.lower() and os.path.isfile(os.path.join(directory, entry)):
+            return os.path.join(directory, entry)
+    return None
+
+
+def _has_gtfs_files(directory):
+    return all(_find_gtfs_file(directory, file_name) for file_name in REQUIRED_GTFS_FILES)
+
+
+def _gtfs_dir_in(directory):
+    """
+    directory, or its first subdirectory, holding the core GTFS files; None when neither does.
+    """
+    if _has_gtfs_files(directory):
+        return directory
+    for entry in sorted(os.listdir(directory)):
+        subdir = os.path.join(directory, entry)
+        if os.path.isdir(subdir) and _has_gtfs_files(subdir):
+            return subdir
+    return None
+
+
+def gtfs_dir(data_path):
+    """
+    Directory of data_path's GTFS feed, resolved exactly like get_gtfs_dir in
+    the R timetable index (functions.R_GTFS_TIMETABLE_INDEX) so both read the
+    same extraction: the first zip named like "gtfs" (else the first zip) is
+    extracted once into GTFS_CACHE_DIR (default <data_path>/.gtfs_cache) as
+    <zip stem>_<md5 of the zip>. Without a zip, unzipped .txt files in
+    data_path or one of its subdirectories are used.
+    """
+    zip_files = sorted(path for path in glob.glob(os.path.join(data_path, "*"))
+                       if path.lower().endswith(".zip") and os.path.isfile(path))
+    gtfs_named = [path for path in zip_files if "gtfs" in os.path.basename(path).lower()]
+    candidates = gtfs_named or zip_files
+    if not candidates:
+        found = _gtfs_dir_in(data_path)
+        if found is None:
+            raise FileNotFoundError(f"No GTFS feed (zip or unzipped .txt files) found in {data_path}.")
+        return found
+
+    selected_zip = candidates[0]
+    cache_root = os.environ.get("GTFS_CACHE_DIR", os.path.join(data_path, ".gtfs_cache"))
+    os.makedirs(cache_root, exist_ok=True)
+    zip_stem = os.path.splitext(os.path.basename(selected_zip))[0]
+    with open(selected_zip, "rb") as feed:
+        digest = hashlib.md5(feed.read()).hexdigest()
+    cached_dir = os.path.join(cache_root, f"{zip_stem}_{digest}")
+    if not os.path.isdir(cached_dir):
+        staging_dir = tempfile.mkdtemp(prefix=f"{zip_stem}_staging_", dir=cache_root)
+        try:
+            with zipfile.ZipFile(selected_zip) as feed:
+                feed.extractall(staging_dir)
+            # rename is atomic; if another process published the same hash first, keep theirs.
+            os.rename(staging_dir, cached_dir)
+        except OSError:
+            if not os.path.isdir(cached_dir):
+                raise
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        for entry in os.listdir(cache_root):
+            path = os.path.join(cache_root, entry)
+            stale = (entry.startswith(f"{zip_stem}_") and re.search(r"_[0-9a-f]{32}$", entry)
+                     and path != cached_dir)
+            abandoned = "_staging_" in entry and time.time() - os.path.getmtime(path) > STAGING_MAX_AGE_S
+            if os.path.isdir(path) and (stale or abandoned):
+                shutil.rmtree(path, ignore_errors=True)
+
+    found = _gtfs_dir_in(cached_dir)
+    if found is None:
+        shutil.rmtree(cached_dir, ignore_errors=True)
+        raise ValueError(f"Unzipped GTFS archive '{selected_zip}' but could not find required GTFS .txt files.")
+    return found
+
+
+def gtfs_seconds(times):
+    """
+    Seconds after midnight of GTFS "H:MM:SS" times, which may run past 24:00:00.
+    """
+    parts = times.str.strip().str.split(":", expand=True).astype(int)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def route_keys(routes):
+    """
+    Route names as GTFS writes them: numeric routes read back from CSV or a
+    recording as floats ("5.0") become "5".
+    """
+    return routes.astype(str).str.strip().str.replace(r"^(\d+)\.0+$", r"\1", regex=True)
+
+
+def format_service_time(seconds):
+    """
+    "HH:MM" strings of seconds after midnight; times past midnight wrap to the next day's clock.
+    """
+    seconds = seconds.astype(int)
+    hours = ((seconds // 3600) % 24).astype(str).str.zfill(2)
+    minutes = ((seconds % 3600) // 60).astype(str).str.zfill(2)
+    return hours + ":" + minutes
+
+
+class TransitServiceIndex:
+    """
+    Departures of a GTFS feed aggregated once, so that itinerary segments can be
+    given their last bus and frequency with a few joins instead of scans of stop_times:
+
+    - last_departures: latest departure (seconds after midnight) per (route, stop_id, service_id)
+    - hourly_departures: departures per (route, stop_id, service_id, hour)
+
+    Routes are keyed both by route_id and route_short_name, whichever r5r reports.
+    The feed is read from the directory gtfs_dir resolves, the extraction the R
+    timetable index also uses.
+    A service day is the set of service_ids running on a date (calendar.txt and
+    calendar_dates.txt), so seasonal services never add up.
+    """
+
+    def __init__(self, feed_dir):
+        def read(file_name, usecols=None):
+            path = _find_gtfs_file(feed_dir, file_name)
+            if path is None:
+                return None
+            return pd.read_csv(path, dtype=str, usecols=lambda column: usecols is None or column in usecols)
+
+        routes = read("routes.txt", {"route_id", "route_short_name"})
+        trips = read("trips.txt", {"route_id", "service_id", "trip_id"})
+        stops = read("stops.txt", {"stop_id", "stop_lat", "stop_lon"})
+        stop_times = read("stop_times.txt", {"trip_id", "stop_id", "departure_time", "pickup_type"})
+        self.calendar = read("calendar.txt")
+        self.calendar_dates = read("calendar_dates.txt", {"service_id", "date", "exception_type"})
+
+        # Only stops where passengers can board count as departures.
+        if "pickup_type" in stop_times.columns:
+            stop_times = stop_times[stop_times["pickup_type"].fillna("0").str.strip() != "1"]
+        stop_times = stop_times.dropna(subset=["departure_time"])
+        stop_times = stop_times[stop_times["departure_time"].str.strip() != ""]
+        departures = stop_times[["trip_id", "stop_id"]].assign(departure_s=gtfs_seconds(stop_times["departure_time"])).merge(trips, on="trip_id")
+        departures["hour"] = departures["departure_s"] // 3600
+
+        route_keys = routes[["route_id"]].assign(route=routes["route_id"])
+        if "route_short_name" in routes.columns:
+            short_names = routes.dropna(subset=["route_short_name"])
+            route_keys = pd.concat([route_keys, short_names[["route_id"]].assign(route=short_names["route_short_name"])])
+        route_keys = route_keys.drop_duplicates()
+
+        self.last_departures = (departures.groupby(["route_id", "stop_id", "service_id"], as_index=False)["departure_s"].max()
+                                .merge(route_keys, on="route_id")
+                                .groupby(["route", "stop_id", "service_id"], as_index=False)["departure_s"].max())
+        self.hourly_departures = (departures.groupby(["route_id", "stop_id", "service_id", "hour"]).size().rename("departures").reset_index()
+                                  .merge(route_keys, on="route_id")
+                                  .groupby(["route", "stop_id", "service_id", "hour"], as_index=False)["departures"].sum())
+        route_stops = departures[["route_id", "stop_id"]].drop_duplicates().merge(route_keys, on="route_id")
+        stops = stops.assign(stop_lat=pd.to_numeric(stops["stop_lat"]), stop_lon=pd.to_numeric(stops["stop_lon"]))
+        self.route_stops = route_stops[["route", "stop_id"]].drop_duplicates().merge(stops, on="stop_id")
+        self._active_services = {}
+
+    @classmethod
+    def from_data_path(cls, data_path):
+        return cls(gtfs_dir(data_path))
+
+    def active_services(self, service_date):
+        """
+        service_ids running on service_date ("%Y%m%d").
+        """
+        if service_date not in self._active_services:
+            active = set()
+            if self.calendar is not None and not self.calendar.empty:
+                weekday = WEEKDAYS[datetime.strptime(service_date, "%Y%m%d").weekday()]
+                running = ((self.calendar[weekday] == "1") & (self.calendar["start_date"] <= service_date)
+                           & (self.calendar["end_date"] >= service_date))
+                active.update(self.calendar.loc[running, "service_id"])
+            if self.calendar_dates is not None and not self.calendar_dates.empty:
+                exceptions = self.calendar_dates[self.calendar_dates["date"] == service_date]
+                active.update(exceptions.loc[exceptions["exception_type"] == "1", "service_id"])
+                active.difference_update(exceptions.loc[exceptions["exception_type"] == "2", "service_id"])
+            self._active_services[service_date] = sorted(active)
+        return self._active_services[service_date]
+
+    def attach(self, df, service_date=None):
+        """
+        Adds last_bus_time ("HH:MM") and frequency(buses per hour) to the BUS
+        segments of a post-processed itinerary table, in place. Each segment is
+        matched to the nearest stop of its route to its boarding point, on
+        service_date ("%Y%m%d", the trip's requested departure date); frequency
+        counts the departures of the segment's departure hour. r5r only reports
+        times of day, so without service_date the date of departure_time is used.
+
+        Both columns (SERVICE_COLUMNS) are added to every non-empty table so its
+        schema does not depend on the modes found; they stay empty on rows of
+        other modes, which sanitize_trip_summary does not report as issues.
+        """
+        if df.empty:
+            return df
+        last_bus_column, frequency_column = SERVICE_COLUMNS
+        if last_bus_column not in df.columns:
+            df[last_bus_column] = None
+        if frequency_column not in df.columns:
+            df[frequency_column] = np.nan
+        required = {"mode", "route", "from_lat", "from_lon", "departure_time"}
+        if not required <= set(df.columns) or not pd.api.types.is_datetime64_any_dtype(df["departure_time"]):
+            return df
+        is_bus = df["mode"].isin(SERVICE_FIELD_MODES) & df["route"].notna() & df["departure_time"].notna()
+        if not is_bus.any():
+            return df
+
+        bus_rows = df.loc[is_bus]
+        segments = pd.DataFrame({
+            "row": bus_rows.index,
+            "route": route_keys(bus_rows["route"]).to_numpy(),
+            "lat": bus_rows["from_lat"].to_numpy(dtype=float),
+            "lon": bus_rows["from_lon"].to_numpy(dtype=float),
+            "service_date": (service_date if service_date is not None
+                             else bus_rows["departure_time"].dt.strftime("%Y%m%d").to_numpy()),
+            "hour": bus_rows["departure_time"].dt.hour.to_numpy(),
+        })
+        candidates = segments.merge(self.route_stops, on="route")
+        if candidates.empty:
+            df.loc[is_bus, "frequency(buses per hour)"] = 0
+            return df
+        lat_rad = np.radians(candidates["lat"].to_numpy())
+        dx = np.radians(candidates["stop_lon"].to_numpy() - candidates["lon"].to_numpy()) * np.cos(lat_rad)
+        dy = np.radians(candidates["stop_lat"].to_numpy()) - lat_rad
+        candidates["distance_m"] = np.sqrt(dx * dx + dy * dy) * EARTH_RADIUS_M
+        boarding = candidates.loc[candidates.groupby("row")["distance_m"].idxmin()]
+        boarding = boarding[boarding["distance_m"] <= MAX_STOP_DISTANCE_M]
+
+        service_days = pd.DataFrame(
+            [(day, service_id) for day in boarding["service_date"].unique()
+             for service_id in self.active_services(day)],
+            columns=["service_date", "service_id"])
+        served = boarding[["row", "route", "stop_id", "service_date", "hour"]].merge(service_days, on="service_date")
+        last_departure = served.merge(self.last_departures, on=["route", "stop_id", "service_id"]).groupby("row")["departure_s"].max()
+        hourly = served.merge(self.hourly_departures, on=["route", "stop_id", "service_id", "hour"]).groupby("row")["departures"].sum()
+
+        df.loc[last_departure.index, "last_bus_time"] = format_service_time(last_departure).to_numpy()
+        df.loc[is_bus, "frequency(buses per hour)"] = 0
+        df.loc[hourly.index, "frequency(buses per hour)"] = hourly.to_numpy()
+        return df
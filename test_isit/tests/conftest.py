@@ -0,0 +1,9 @@
+# testing/tests/conftest.py
+#
+#   cd test_isit && python -m pytest -q tests
+
+import os
+import sys
+
+# The service modules import each other as top-level modules (from result_cache import ...).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,56 @@
+# testing/tests/test_batch_routing.py
+
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import functions
+import main
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # No lifespan: the routing backend is swapped in and the service marked ready by hand.
+    monkeypatch.setattr(main, "DEFAULT_DATA_PATH", os.path.join(PACKAGE_DIR, "metz", "metz"))
+    monkeypatch.setitem(main.STARTUP_STATE, "status", "ready")
+    return TestClient(main.app)
+
+
+def use_backend(monkeypatch, backend):
+    monkeypatch.setattr(functions, "_ROUTING_BACKEND_INSTANCE", backend)
+
+
+def test_batch_under_replay_backend(client, monkeypatch):
+    use_backend(monkeypatch, functions.ReplayBackend(os.path.join(PACKAGE_DIR, "outputs", "trip_summary_*.csv"), "0", 0))
+    response = client.post("/process/batch", json={"origins": ["49.06917,6.187276", "49.0692,6.1873"],
+                                                   "destinations": ["49.11526,6.173629"]})
+    assert response.status_code == 200
+    od_pairs = response.json()["od_pairs"]
+    assert sorted(od_pairs) == ["o0->d0", "o1->d0"]
+    modes = {mode["mode_type"] for mode in od_pairs["o0->d0"]["transport_data"]["transport_modes"]}
+    assert modes == set(functions.MODE_LABELS)
+
+
+class SingleTripBackend:
+    name = "single-trip"
+    thread_safe = True
+
+
+def test_batch_without_batch_support(client, monkeypatch):
+    use_backend(monkeypatch, SingleTripBackend())
+    response = client.post("/process/batch", json={"origins": ["49.06917,6.187276"], "destinations": ["49.11526,6.173629"]})
+    assert response.status_code == 501
+
+
+def test_batch_is_recorded_in_metrics(client, monkeypatch):
+    if main.METRICS is None:
+        pytest.skip("prometheus_client is not installed")
+    use_backend(monkeypatch, functions.ReplayBackend(os.path.join(PACKAGE_DIR, "outputs", "trip_summary_*.csv"), "0", 0))
+    batches_before = main.METRICS.registry.get_sample_value("isit_routing_batch_seconds_count") or 0
+    response = client.post("/process/batch", json={"origins": ["49.06917,6.187276"], "destinations": ["49.11526,6.173629"]})
+    assert response.status_code == 200
+    assert main.METRICS.registry.get_sample_value("isit_routing_batch_seconds_count") == batches_before + 1
+    assert main.METRICS.registry.get_sample_value("isit_routing_mode_outcomes_total", {"mode": "CAR", "outcome": "ok"}) >= 1
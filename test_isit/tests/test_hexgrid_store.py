@@ -0,0 +1,17 @@
+# testing/tests/test_hexgrid_store.py
+
+import numpy as np
+import pandas as pd
+
+from hexgrid_store import UNREACHABLE, matrix_entries
+
+
+def test_unreachable_pairs_keep_unreachable():
+    travel_times = pd.DataFrame({"from_id": ["0", "0", "1"], "to_id": ["1", "2", "2"],
+                                 "travel_time": [12.0, np.nan, 1e6]})
+    matrix = np.full((3, 3), UNREACHABLE, dtype=np.uint16)
+    rows, cols, minutes = matrix_entries(travel_times)
+    matrix[rows, cols] = minutes
+    assert matrix[0, 1] == 12
+    assert matrix[0, 2] == UNREACHABLE
+    assert matrix[1, 2] == UNREACHABLE - 1
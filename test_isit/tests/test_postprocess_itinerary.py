@@ -0,0 +1,58 @@
+# testing/tests/test_postprocess_itinerary.py
+
+import os
+
+import pandas as pd
+import pytest
+
+from functions import MODE_DURATION_OFFSETS, MODE_LABELS, postprocess_itinerary
+
+# Trip summary archived by the per-option loop postprocess_itinerary replaced.
+RECORDED_TRIP_SUMMARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     "outputs", "trip_summary_8f32a9fc8dc643e3aa2f2d5f529b0018.csv")
+DERIVED_COLUMNS = ["from_lat", "from_lon", "to_lat", "to_lon", "Mode_Transport"]
+
+
+@pytest.fixture(scope="module")
+def recorded():
+    return pd.read_csv(RECORDED_TRIP_SUMMARY)
+
+
+def raw_itinerary(recorded_df, mode_label):
+    """
+    The mode's rows as r5r returns them: no derived columns, no duration offset,
+    and only each option's first departure time meaningful.
+    """
+    raw = recorded_df[recorded_df["Mode_Transport"] == mode_label].drop(columns=DERIVED_COLUMNS).reset_index(drop=True)
+    raw.loc[0, "segment_duration"] -= MODE_DURATION_OFFSETS.get(mode_label, 0)
+    raw["departure_time"] = raw.groupby("option")["departure_time"].transform("first")
+    return raw
+
+
+@pytest.mark.parametrize("mode_label", MODE_LABELS)
+def test_matches_recorded_trip_summary(recorded, mode_label):
+    expected = recorded[recorded["Mode_Transport"] == mode_label].reset_index(drop=True)
+    result = postprocess_itinerary(raw_itinerary(recorded, mode_label), mode_label)
+
+    assert (result["Mode_Transport"] == mode_label).all()
+    assert list(result["option"]) == list(expected["option"])
+    pd.testing.assert_series_equal(result["departure_time"], pd.to_datetime(expected["departure_time"]),
+                                   check_names=False, check_dtype=False)
+    for column in ["segment_duration", "from_lat", "from_lon", "to_lat", "to_lon"]:
+        pd.testing.assert_series_equal(result[column].astype(float), expected[column].astype(float),
+                                       check_names=False, atol=1e-9)
+
+
+def test_missing_geometry_leg(recorded):
+    raw = raw_itinerary(recorded, "Walk+Transit")
+    raw.loc[1, "geometry"] = None
+    expected = recorded[recorded["Mode_Transport"] == "Walk+Transit"].reset_index(drop=True)
+
+    result = postprocess_itinerary(raw, "Walk+Transit")
+
+    assert result["geometry"].iloc[1] is None
+    assert result[["from_lat", "from_lon", "to_lat", "to_lon"]].iloc[1].isna().all()
+    pd.testing.assert_series_equal(result["from_lat"].drop(1).astype(float), expected["from_lat"].drop(1).astype(float),
+                                   check_names=False, atol=1e-9)
+    pd.testing.assert_series_equal(result["departure_time"], pd.to_datetime(expected["departure_time"]),
+                                   check_names=False, check_dtype=False)
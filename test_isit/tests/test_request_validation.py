@@ -0,0 +1,19 @@
+# testing/tests/test_request_validation.py
+
+import pytest
+from pydantic import ValidationError
+
+from main import InputRequest
+
+TRIP = {"origin_str": "49.06917,6.187276", "destination_str": "49.11526,6.173629"}
+
+
+@pytest.mark.parametrize("zoom", [0, 16, 22])
+def test_simplify_zoom_in_range(zoom):
+    assert InputRequest(**TRIP, simplify_zoom=zoom).simplify_zoom == zoom
+
+
+@pytest.mark.parametrize("zoom", [-1, 23, 1000])
+def test_simplify_zoom_out_of_range(zoom):
+    with pytest.raises(ValidationError):
+        InputRequest(**TRIP, simplify_zoom=zoom)
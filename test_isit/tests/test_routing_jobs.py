@@ -0,0 +1,24 @@
+# testing/tests/test_routing_jobs.py
+
+import os
+
+import pandas as pd
+
+from functions import MODE_LABELS
+from main import InputRequest, RoutingJob, run_routing_job
+
+RECORDED_TRIP_SUMMARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     "outputs", "trip_summary_8f32a9fc8dc643e3aa2f2d5f529b0018.csv")
+
+
+def test_cached_job_publishes_every_mode():
+    cached_df = pd.read_csv(RECORDED_TRIP_SUMMARY)
+    cached_df = cached_df[cached_df["Mode_Transport"] != "CAR"]
+    job = RoutingJob(InputRequest(origin_str="49.06917,6.187276", destination_str="49.11526,6.173629"))
+
+    run_routing_job(job, None, cached_df)
+
+    mode_events = [data for event, data in job.events if event == "mode"]
+    assert [data["mode"] for data in mode_events] == MODE_LABELS
+    assert [data["mode"] for data in mode_events if data["transport_mode"] is None] == ["CAR"]
+    assert job.events[-1][0] == "done"
@@ -0,0 +1,112 @@
+# testing/tests/test_service_index.py
+
+import hashlib
+import zipfile
+
+import pandas as pd
+import pytest
+
+from functions import service_date
+from main import sanitize_trip_summary
+from service_index import TransitServiceIndex, gtfs_dir
+
+STOP_LAT, STOP_LON = 49.1, 6.2
+
+GTFS_FILES = {
+    "routes.txt": "route_id,route_short_name\nR5,5\n",
+    "trips.txt": "route_id,service_id,trip_id\nR5,WEEKDAY,T1\nR5,WEEKDAY,T2\nR5,WEEKDAY,T3\n",
+    "stops.txt": f"stop_id,stop_lat,stop_lon\nA,{STOP_LAT},{STOP_LON}\nB,49.2,6.3\n",
+    "stop_times.txt": ("trip_id,stop_id,departure_time,pickup_type\n"
+                       "T1,A,07:05:00,0\nT1,B,07:25:00,0\n"
+                       "T2,A,07:35:00,0\nT2,B,07:55:00,0\n"
+                       "T3,A,22:11:00,0\nT3,B,22:31:00,1\n"),
+    # Like the Metz feed: no calendar.txt, services only run on listed dates.
+    "calendar_dates.txt": "service_id,date,exception_type\nWEEKDAY,20240812,1\n",
+}
+
+
+def write_feed(data_path, folder=""):
+    gtfs_zip = data_path / "feed.zip"
+    with zipfile.ZipFile(gtfs_zip, "w") as feed:
+        for file_name, content in GTFS_FILES.items():
+            feed.writestr(folder + file_name, content)
+    return gtfs_zip
+
+
+@pytest.fixture(scope="module")
+def service_index(tmp_path_factory):
+    data_path = tmp_path_factory.mktemp("gtfs")
+    write_feed(data_path)
+    return TransitServiceIndex.from_data_path(str(data_path))
+
+
+def itinerary(route):
+    # r5r departure times are times of day; parsing them puts them on today's date.
+    return pd.DataFrame({
+        "mode": ["WALK", "BUS"],
+        "route": [None, route],
+        "from_lat": [49.0, STOP_LAT + 0.0001],
+        "from_lon": [6.1, STOP_LON],
+        "departure_time": pd.to_datetime(["07:00:00", "07:10:00"], format="%H:%M:%S"),
+    })
+
+
+def test_service_date_of_request():
+    assert service_date("12-08-2024 07:00:00") == "20240812"
+
+
+def test_attach_uses_requested_service_date(service_index):
+    df = service_index.attach(itinerary("5"), service_date("12-08-2024 07:00:00"))
+    assert df.loc[1, "last_bus_time"] == "22:11"
+    assert df.loc[1, "frequency(buses per hour)"] == 2
+    assert pd.isna(df.loc[0, "last_bus_time"])
+
+
+def test_attach_without_service_on_departure_date(service_index):
+    df = service_index.attach(itinerary("5"))
+    assert pd.isna(df.loc[1, "last_bus_time"])
+    assert df.loc[1, "frequency(buses per hour)"] == 0
+
+
+def test_attach_matches_float_route_names(service_index):
+    df = service_index.attach(itinerary(5.0), "20240812")
+    assert df.loc[1, "last_bus_time"] == "22:11"
+
+
+def test_attach_adds_columns_without_candidate_stops(service_index):
+    df = service_index.attach(itinerary("99"), "20240812")
+    assert {"last_bus_time", "frequency(buses per hour)"} <= set(df.columns)
+    assert pd.isna(df.loc[1, "last_bus_time"])
+    assert df.loc[1, "frequency(buses per hour)"] == 0
+
+
+def test_gtfs_dir_shares_the_r_extraction_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("GTFS_CACHE_DIR", raising=False)
+    gtfs_zip = write_feed(tmp_path, folder="feed/")
+    digest = hashlib.md5(gtfs_zip.read_bytes()).hexdigest()
+    stale = tmp_path / ".gtfs_cache" / ("feed_" + "0" * 32)
+    stale.mkdir(parents=True)
+
+    feed_dir = gtfs_dir(str(tmp_path))
+    assert feed_dir == str(tmp_path / ".gtfs_cache" / f"feed_{digest}" / "feed")
+    assert not stale.exists()
+
+    # An existing extraction (e.g. made by the R index) is read as is.
+    (tmp_path / ".gtfs_cache" / f"feed_{digest}" / "feed" / "marker").write_text("")
+    assert gtfs_dir(str(tmp_path)) == feed_dir
+    assert (tmp_path / ".gtfs_cache" / f"feed_{digest}" / "feed" / "marker").exists()
+
+
+def test_sanitize_ignores_service_fields_of_other_modes(service_index):
+    df = service_index.attach(itinerary("5"), "20240812")
+    records, issues_log = sanitize_trip_summary(df)
+    assert not any("'last_bus_time'" in issue or "'frequency(buses per hour)'" in issue for issue in issues_log)
+    assert records[0]["last_bus_time"] is None
+    assert records[1]["last_bus_time"] == "22:11"
+
+
+def test_sanitize_reports_missing_service_fields_of_bus_rows(service_index):
+    df = service_index.attach(itinerary("99"), "20240812")
+    _, issues_log = sanitize_trip_summary(df)
+    assert any("'last_bus_time'" in issue and "[1]" in issue for issue in issues_log)
+    assert not any("'frequency(buses per hour)'" in issue for issue in issues_log)
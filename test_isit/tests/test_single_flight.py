@@ -0,0 +1,61 @@
+# testing/tests/test_single_flight.py
+
+import threading
+
+import pytest
+
+from result_cache import FlightWaitRejected, SingleFlight
+
+
+def start_leader(flight, key="trip"):
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return "routed"
+
+    leader = threading.Thread(target=flight.run, args=(key, compute))
+    leader.start()
+    started.wait(5)
+    return leader, release
+
+
+def test_follower_gets_leader_result():
+    flight = SingleFlight()
+    leader, release = start_leader(flight)
+    results = []
+    follower = threading.Thread(target=lambda: results.append(flight.run("trip", lambda: "again")))
+    follower.start()
+    while flight.stats()["waiting"] == 0:
+        pass
+    release.set()
+    follower.join(5)
+    leader.join(5)
+    assert results == [("routed", True)]
+    assert flight.stats()["computations"] == 1
+
+
+def test_follower_wait_is_bounded():
+    flight = SingleFlight(wait_timeout=0.05)
+    leader, release = start_leader(flight)
+    waits = []
+    with pytest.raises(FlightWaitRejected):
+        flight.run("trip", lambda: "again", on_wait=waits.append)
+    release.set()
+    leader.join(5)
+    assert waits == [1, -1]
+    assert flight.stats()["timed_out_followers"] == 1
+    assert flight.stats()["waiting"] == 0
+
+
+def test_followers_beyond_max_waiting_are_rejected():
+    flight = SingleFlight(max_waiting=0)
+    leader, release = start_leader(flight)
+    with pytest.raises(FlightWaitRejected):
+        flight.run("trip", lambda: "again")
+    # Other keys still compute.
+    assert flight.run("other", lambda: "routed") == ("routed", False)
+    release.set()
+    leader.join(5)
+    assert flight.stats()["rejected_followers"] == 1
@@ -0,0 +1,59 @@
+# testing/tests/test_startup.py
+
+import json
+import logging
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from hexgrid_store import CELLS_NAME, MANIFEST_NAME, matrix_file_name
+from result_cache import network_fingerprint
+
+
+@pytest.fixture
+def light_startup(monkeypatch):
+    # Run the lifespan without loading routing data.
+    monkeypatch.setattr(main, "warm_up_service", lambda: None)
+    monkeypatch.setattr(main, "RESULT_CACHE_ENABLED", False)
+    monkeypatch.setattr(main, "USE_ROUTING_POOL", False)
+    monkeypatch.setattr(main, "HEXGRID_STORE_DIR", None)
+    # Globals the lifespan assigns, restored after each test.
+    monkeypatch.setattr(main, "HEXGRID_STORE", None)
+    monkeypatch.setattr(main, "HEXGRID_STORE_STALE", False)
+
+
+def test_missing_metrics_are_logged_at_startup(light_startup, monkeypatch, caplog):
+    monkeypatch.setattr(main, "METRICS", None)
+    with caplog.at_level(logging.WARNING, logger="uvicorn.error"):
+        with TestClient(main.app) as client:
+            assert client.get("/metrics").status_code == 503
+    assert "prometheus_client is not installed" in caplog.text
+
+
+def write_store(store_dir, data_path):
+    store_dir.mkdir()
+    (store_dir / CELLS_NAME).write_text("id,lon,lat\nA,6.18,49.10\nB,6.20,49.12\n")
+    np.array([[0, 12], [14, 0]], dtype=np.uint16).tofile(store_dir / matrix_file_name("CAR", "07:00"))
+    (store_dir / MANIFEST_NAME).write_text(json.dumps({
+        "cell_count": 2, "modes": ["CAR"], "departure_times": ["07:00"], "duration_offsets": {"CAR": 10},
+        "network_fingerprint": network_fingerprint(str(data_path)), "built_at": "2024-08-01T00:00:00"}))
+
+
+@pytest.mark.parametrize("network_changed", [False, True])
+def test_estimates_are_flagged_when_the_network_changed(light_startup, monkeypatch, tmp_path, network_changed):
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    (data_path / "network.dat").write_text("network")
+    write_store(tmp_path / "store", data_path)
+    if network_changed:
+        (data_path / "network.dat").write_text("rebuilt network")
+    monkeypatch.setattr(main, "DEFAULT_DATA_PATH", str(data_path))
+    monkeypatch.setattr(main, "HEXGRID_STORE_DIR", str(tmp_path / "store"))
+
+    with TestClient(main.app) as client:
+        response = client.post("/estimate", json={"origin_str": "49.10,6.18", "destination_str": "49.12,6.20"})
+    assert response.status_code == 200
+    assert response.json()["durations_min"] == {"CAR": 22}
+    assert response.json()["store_stale"] is network_changed
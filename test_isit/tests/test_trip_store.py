@@ -0,0 +1,23 @@
+# testing/tests/test_trip_store.py
+
+import os
+
+import pandas as pd
+
+from trip_store import TripStore
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_trip_table_with_missing_geometry():
+    trip_df = pd.read_csv(os.path.join(PACKAGE_DIR, "fin_2_concat.csv"))
+    blank_row = 1
+    trip_df.loc[blank_row, "geometry"] = None
+    mode_key, option = trip_df.loc[blank_row, "Mode_Transport"].lower(), trip_df.loc[blank_row, "option"]
+    option_rows = trip_df[(trip_df["Mode_Transport"].str.lower() == mode_key) & (trip_df["option"] == option)]
+
+    store = TripStore(trip_df)
+
+    lines = store.route_lines[(mode_key, option)]
+    assert len(lines) == option_rows["geometry"].notna().sum()
+    assert all(len(line["coordinates"]) > 0 for line in lines)
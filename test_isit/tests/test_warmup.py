@@ -0,0 +1,20 @@
+# testing/tests/test_warmup.py
+
+import pandas as pd
+import pytest
+
+from functions import warmup_trips
+
+
+def write_points(tmp_path, point_count):
+    pd.DataFrame({"lat": [49.10 + i / 100 for i in range(point_count)], "lon": [6.17] * point_count}).to_csv(
+        tmp_path / "metz_points_of_interest.csv", index=False)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("point_count", [2, 3, 7, 8, 9])
+@pytest.mark.parametrize("count", [1, 2, 3, 20])
+def test_warmup_trips_never_route_a_point_to_itself(tmp_path, point_count, count):
+    trips = warmup_trips(write_points(tmp_path, point_count), count)
+    assert len(trips) == count
+    assert all(origin != destination for origin, destination in trips)
@@ -1,14 +1,24 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import pydeck as pdk
+import os
 import time
 import base64
-from shapely.wkt import loads
+import threading
+from time import monotonic
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit.components.v1 as components
 from datetime import datetime, timedelta
 import qrcode
 from io import BytesIO
 from PIL import Image
+from trip_store import TripStore
 
 # === Session State ===
 if 'search_triggered' not in st.session_state:
@@ -16,12 +26,21 @@ if 'search_triggered' not in st.session_state:
 if 'clicked_icon_index' not in st.session_state:
     st.session_state['clicked_icon_index'] = None
 
+if 'trip_query' not in st.session_state:
+    st.session_state['trip_query'] = None
+
 # === Read Clicked Icon from URL ===
+# Icon links reload the page (a new session), so they also carry the search they belong to.
 query_params = st.query_params
 if 'clicked' in query_params:
     try:
         clicked_index = int(query_params['clicked'])
         st.session_state['clicked_icon_index'] = clicked_index
+        if 'origin' in query_params and 'destination' in query_params:
+            st.session_state['trip_query'] = (
+                query_params['origin'], query_params['destination'],
+                int(query_params.get('walk', 0)), int(query_params.get('bicycle', 0))
+            )
         st.query_params.clear()
     except ValueError:
         st.session_state['clicked_icon_index'] = None
@@ -132,14 +151,192 @@ with col2:
     if st.button('🔍 Search'):
         st.session_state['search_triggered'] = True
         st.session_state['clicked_icon_index'] = None
+        st.session_state['trip_query'] = None
 def embed_image(path):
     with open(path, "rb") as f:
         return base64.b64encode(f.read()).decode()
 
-# === Read options and transport images ===
-option_df = pd.read_csv("fin_2_concat.csv")
+# === Cached data layer ===
+# Streamlit reruns this script on every click. Everything read from disk is cached
+# in memory, keyed on the source file's modification time and size, so an edited
+# file is picked up on the next rerun and an unchanged one is never read again.
+TRIP_TABLE_PATH = "fin_2_concat.csv"
 img_dir = "static/"
-optimal_mode = "bicycle+transit"  # <- this should come from your backend logic
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# cache_resource hands back the same object on every rerun (cache_data would unpickle a copy).
+# Callers only read from it. Old versions are evicted by max_entries.
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_trip_store(path, version):
+    return TripStore(pd.read_csv(path))
+
+
+# === Backend API client ===
+API_URL = os.environ.get("TRAVEL_API_URL", "http://localhost:8000")
+# Route the return trip in the background after every search, so it is ready if asked next.
+API_PREFETCH = os.environ.get("TRAVEL_API_PREFETCH", "1") == "1"
+# Origin and destination used when the search fields do not hold "lat,lon" coordinates.
+DEFAULT_ORIGIN = (49.10667, 6.234854)
+DEFAULT_DESTINATION = (49.09702, 6.139394)
+
+
+def parse_location(text, default):
+    try:
+        lat, lon = (float(value) for value in text.split(","))
+        return lat, lon
+    except (AttributeError, ValueError):
+        return default
+
+
+def trip_store_from_response(payload):
+    """
+    TripStore of a /process response requested with geometry_encoding="geojson",
+    whose geometries already are [lon, lat] lists. Distances become kilometres,
+    as in fin_2_concat.csv.
+    """
+    rows, segment_coords = [], []
+    for transport_mode in payload["transport_data"]["transport_modes"]:
+        for route in transport_mode["routes"]:
+            for segment in route["segments"]:
+                rows.append({
+                    "Mode_Transport": transport_mode["mode_type"],
+                    "option": route["option"],
+                    "segment": segment.get("order"),
+                    "mode": segment.get("mode") or "",
+                    "route": segment.get("route_no"),
+                    "from_lat": segment["source"]["latitude"],
+                    "from_lon": segment["source"]["longitude"],
+                    "to_lat": segment["destination"]["latitude"],
+                    "to_lon": segment["destination"]["longitude"],
+                    "segment_duration": segment.get("duration") or 0,
+                    "distance": (segment.get("distance") or 0) / 1000,
+                    "departure_time": segment.get("departure_time"),
+                    "wait": segment.get("wait_time") or 0,
+                    "last_bus_time": segment.get("last_bus_time"),
+                    "frequency(buses per hour)": segment.get("buses_per_hour"),
+                })
+                segment_coords.append(np.asarray(segment.get("geometry") or [], dtype=float).reshape(-1, 2))
+    return TripStore(pd.DataFrame(rows), segment_coords)
+
+
+class TravelApiClient:
+    """
+    Client of the routing API shared by every session of this Streamlit server:
+    one keep-alive connection pool, and the TripStore of each recent search kept
+    as a future, so icon switches, page reloads and prefetched return trips never
+    route twice. Failed fetches are dropped and retried on the next call.
+    """
+
+    def __init__(self, base_url, pool_size=8, ttl_seconds=600, max_entries=32):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        # /process is a long, non-idempotent POST: retry it only when the server never started
+        # on it (connection refused, or 502/503/504 from the proxy or the admission limiter,
+        # whose Retry-After urllib3 waits for), never after a read timeout.
+        retries = Retry(total=2, connect=2, read=0, other=0, status=2, backoff_factor=0.5,
+                        status_forcelist=(502, 503, 504), allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="travel-api")
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fetch(self, query):
+        origin, destination, walk_time, bicycle_time = query
+        payload = {"origin_str": origin, "destination_str": destination,
+                   "geometry_encoding": "geojson", "simplify_zoom": 16}
+        if walk_time:
+            payload["walk_time"] = walk_time
+        if bicycle_time:
+            payload["bicycle_time"] = bicycle_time
+        response = self.session.post(f"{self.base_url}/process", json=payload, timeout=(3.05, 180))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return trip_store_from_response(response.json())
+
+    def _future(self, query):
+        now = monotonic()
+        with self._lock:
+            entry = self._futures.get(query)
+            if entry is not None:
+                created_at, future = entry
+                failed = future.done() and future.exception() is not None
+                if not failed and now - created_at <= self.ttl_seconds:
+                    self._futures.move_to_end(query)
+                    return future
+            future = self.executor.submit(self._fetch, query)
+            self._futures[query] = (now, future)
+            while len(self._futures) > self.max_entries:
+                self._futures.popitem(last=False)
+            return future
+
+    def trip_store(self, query):
+        """
+        TripStore of query (origin, destination, walk_time, bicycle_time), or None when
+        no itinerary was found. Raises requests.RequestException when the API fails.
+        """
+        return self._future(query).result()
+
+    def prefetch(self, query):
+        self._future(query)
+
+
+@st.cache_resource(show_spinner=False)
+def api_client(base_url):
+    return TravelApiClient(base_url)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_icons(paths, versions):
+    return {path: embed_image(path) for path in paths}
+
+
+# === Read options and transport images ===
+# A search is routed by the API once; its TripStore lives in session state for reruns
+# and in the shared client for page reloads. Without the API, the static table is shown.
+if st.session_state.get('search_triggered') and st.session_state['trip_query'] is None:
+    origin_lat, origin_lon = parse_location(current_location, DEFAULT_ORIGIN)
+    destination_lat, destination_lon = parse_location(destination, DEFAULT_DESTINATION)
+    st.session_state['trip_query'] = (
+        f"{origin_lat},{origin_lon}", f"{destination_lat},{destination_lon}",
+        int(st.session_state.get("walk_input") or 0), int(st.session_state.get("bicycle_input") or 0)
+    )
+
+trip_query = st.session_state['trip_query']
+trip_source = "csv"
+trip_store = None
+if trip_query is not None:
+    if st.session_state.get('trip_store_query') == trip_query:
+        trip_store = st.session_state['trip_store']
+        trip_source = "api"
+    else:
+        client = api_client(API_URL)
+        try:
+            with st.spinner("Finding routes..."):
+                trip_store = client.trip_store(trip_query)
+            trip_source = "api"
+            st.session_state['trip_store_query'] = trip_query
+            st.session_state['trip_store'] = trip_store
+            if API_PREFETCH:
+                origin_str, destination_str, walk_time, bicycle_time = trip_query
+                client.prefetch((destination_str, origin_str, walk_time, bicycle_time))
+        except requests.RequestException as exc:
+            st.warning(f"Routing service unavailable ({exc.__class__.__name__}), showing saved routes.")
+if trip_source == "api" and trip_store is None:
+    st.warning("No itineraries found for this search.")
+if trip_source == "csv":
+    trip_store = load_trip_store(TRIP_TABLE_PATH, file_version(TRIP_TABLE_PATH))
+option_df = trip_store.df if trip_store is not None else pd.DataFrame()
+optimal_mode = trip_store.fastest_mode() if trip_source == "api" and trip_store is not None else "bicycle+transit"
 
 # === Image Config ===
 base_modes = [
@@ -159,14 +356,21 @@ for item in base_modes:
         "label": item["label"]
     })
 
+icon_paths = tuple(f"{img_dir}{image['filename']}" for image in images)
+encoded_icons = load_icons(icon_paths, tuple(file_version(path) for path in icon_paths))
+
 # === Render Mode Icons ===
 if st.session_state.get('search_triggered') or st.session_state.get('clicked_icon_index') is not None:
     cols = st.columns(5)
     for i, col in enumerate(cols):
         with col:
             path = f"{img_dir}{images[i]['filename']}"
-            b64img = embed_image(path)
+            b64img = encoded_icons[path]
             target = f"?clicked={i}"
+            if trip_source == "api":
+                origin_str, destination_str, walk_time, bicycle_time = trip_query
+                target += "&" + urlencode({"origin": origin_str, "destination": destination_str,
+                                           "walk": walk_time, "bicycle": bicycle_time})
             col.markdown(f"""
                 <div style="text-align:center;">
                     <a href="{target}" target="_self" style="text-decoration:none; color: inherit;">
@@ -184,49 +388,26 @@ if st.session_state.get('search_triggered') or st.session_state.get('clicked_ico
 
 # === Map + Journey Breakdown ===
 clicked = st.session_state['clicked_icon_index']
-if clicked is not None:
+if clicked is not None and trip_store is not None:
     selected_transport = images[clicked]["mode"]
-    from_lat, from_lon = 49.10667, 6.234854
-    to_lat, to_lon = 49.09702, 6.139394
-    tolerance = 0.005
-
-    mode_filtered_df = option_df[option_df["Mode_Transport"].str.lower() == selected_transport.lower()]
-    grouped = mode_filtered_df.groupby("option")
-    matching_options = [
-        opt for opt, group in grouped
-        if abs(group["from_lat"].iloc[0] - from_lat) <= tolerance and
-           abs(group["from_lon"].iloc[0] - from_lon) <= tolerance and
-           abs(group["to_lat"].iloc[-1] - to_lat) <= tolerance and
-           abs(group["to_lon"].iloc[-1] - to_lon) <= tolerance
-    ]
-
-    filtered_df = mode_filtered_df[mode_filtered_df["option"].isin(matching_options)]
-    if filtered_df.empty:
-        st.warning("No route data available for selected mode.")
+    mode_key = selected_transport.lower()
+    if trip_source == "api":
+        from_lat, from_lon = (float(value) for value in trip_query[0].split(","))
+        to_lat, to_lon = (float(value) for value in trip_query[1].split(","))
+        # The API routed exactly this search, so every option of the mode belongs to it.
+        matching_options = trip_store.mode_options(mode_key)
     else:
-        selected_opt = sorted(filtered_df['option'].unique())[0]
-        opt_df = filtered_df[filtered_df["option"] == selected_opt]
-
-        color_map = {
-            "walk": [51, 136, 255],
-            "car": [255, 87, 51],
-            "bicycle": [51, 204, 51],
-            "bus": [128, 0, 128],
-            "transit": [128, 0, 128]
-        }
+        from_lat, from_lon = DEFAULT_ORIGIN
+        to_lat, to_lon = DEFAULT_DESTINATION
+        tolerance = 0.005
+        matching_options = trip_store.matching_options(mode_key, from_lat, from_lon, to_lat, to_lon, tolerance)
 
-        route_lines = []
-        for _, row in opt_df.iterrows():
-            if pd.notna(row['geometry']):
-                line = loads(row['geometry'])
-                coords = [[lon, lat] for lon, lat in line.coords]
-                base_mode = row["mode"].split('+')[0].lower()
-                route_lines.append({
-                    'coordinates': coords,
-                    'mode': base_mode,
-                    'color': color_map.get(base_mode, [0, 0, 0]),
-                    'tooltip': base_mode.capitalize()
-                })
+    if not matching_options:
+        st.warning("No route data available for selected mode.")
+    else:
+        selected_opt = matching_options[0]
+        opt_df = trip_store.options[(mode_key, selected_opt)]
+        route_lines = trip_store.route_lines[(mode_key, selected_opt)]
 
         if not route_lines:
             st.warning("No route data available for selected mode.")
@@ -262,7 +443,6 @@ if clicked is not None:
                 get_color='[200, 30, 0, 160]',
                 get_radius=50
             )
-            opt_df = filtered_df[filtered_df["option"] == selected_opt]
             # === Extract Optimal Parking Zones for car & bicycle
             parking_zones = opt_df[opt_df["mode"].str.lower().isin(["car", "bicycle"])][["to_lat", "to_lon"]].drop_duplicates()
 
@@ -301,13 +481,12 @@ if clicked is not None:
             # === Breakdown
             total_distance = int(opt_df["distance"].sum())
             total_duration = int(opt_df["segment_duration"].sum())
-            co2_emission = float(opt_df['co2_emission(kg) '].sum()) 
+            # The API does not report emissions, only the saved table has them.
+            co2_str = f" – 🌱 {opt_df['co2_emission(kg) '].sum():.4f} kg co2" if 'co2_emission(kg) ' in opt_df.columns else ""
             
             breakdown = f"""
                 <p style="color:#2196F3;font-weight:bold">
-                    <b>Trip details:</b> 📏 {opt_df['distance'].sum():.2f} kms – 🕒 {total_duration} mins 
-                     – 
-                    🌱 {opt_df['co2_emission(kg) '].sum():.4f} kg co2
+                    <b>Trip details:</b> 📏 {opt_df['distance'].sum():.2f} kms – 🕒 {total_duration} mins{co2_str}
 
                 </p>
                 <p style="font-weight:bold;margin-top:10px;">⏰ {start_time_str} ➡️ {end_time_str}</p>
@@ -362,7 +541,9 @@ if clicked is not None:
                     wait_time = row.get("wait", 0)
                     route_id = row.get("route", "N/A")
                     frequency=row.get("frequency(buses per hour)",0)
+                    frequency=frequency if pd.notna(frequency) else 0
                     last_bus_time=row.get("last_bus_time","N/A")
+                    last_bus_time=last_bus_time if pd.notna(last_bus_time) else "N/A"
                     st.markdown(f"### 🚌 Get Bus Ticket for Route {route_id}")
                     st.markdown(f"""
                     🎟️ Ticket Price: €{ticket_price} per person <br>
@@ -0,0 +1,88 @@
+# testing/trip_store.py
+#
+# Trip tables prepared for travel_companion_app_v2.py; kept free of Streamlit so it can be imported on its own.
+
+import numpy as np
+import pandas as pd
+import shapely
+
+color_map = {
+    "walk": [51, 136, 255],
+    "car": [255, 87, 51],
+    "bicycle": [51, 204, 51],
+    "bus": [128, 0, 128],
+    "transit": [128, 0, 128]
+}
+
+
+class TripStore:
+    """
+    A trip table split once per (mode, option): the segment rows, the PathLayer
+    lines with WKT already decoded into [lon, lat] lists, and each option's first
+    and last point for origin/destination matching.
+    """
+
+    def __init__(self, trip_df, segment_coords=None):
+        """
+        segment_coords holds each row's (n, 2) lon/lat array when they are already
+        decoded; otherwise they are decoded from the WKT geometry column.
+        """
+        trip_df = trip_df.reset_index(drop=True)
+        trip_df["mode_key"] = trip_df["Mode_Transport"].str.lower()
+        self.df = trip_df
+
+        if segment_coords is None:
+            # Missing cells must be None: where(..., None) keeps NaN in str-dtype columns, which from_wkt rejects.
+            geometries = trip_df["geometry"].to_numpy(dtype=object)
+            geometries = shapely.from_wkt(np.where(pd.isna(geometries), None, geometries))
+            coords, owners = shapely.get_coordinates(geometries, return_index=True)
+            split_at = np.searchsorted(owners, np.arange(1, len(trip_df)))
+            segment_coords = np.split(coords, split_at)
+
+        self.options = {}
+        self.route_lines = {}
+        for key, rows in trip_df.groupby(["mode_key", "option"], sort=True):
+            self.options[key] = rows
+            lines = []
+            for row_idx, segment_mode in zip(rows.index, rows["mode"]):
+                if len(segment_coords[row_idx]) == 0:
+                    continue
+                base_mode = segment_mode.split('+')[0].lower()
+                lines.append({
+                    'coordinates': segment_coords[row_idx].tolist(),
+                    'mode': base_mode,
+                    'color': color_map.get(base_mode, [0, 0, 0]),
+                    'tooltip': base_mode.capitalize()
+                })
+            self.route_lines[key] = lines
+
+        options = trip_df.groupby(["mode_key", "option"], sort=True)
+        self.endpoints = pd.DataFrame({
+            "from_lat": options["from_lat"].first(),
+            "from_lon": options["from_lon"].first(),
+            "to_lat": options["to_lat"].last(),
+            "to_lon": options["to_lon"].last(),
+        }).reset_index()
+
+    def matching_options(self, mode_key, from_lat, from_lon, to_lat, to_lon, tolerance):
+        endpoints = self.endpoints
+        matches = endpoints[
+            (endpoints["mode_key"] == mode_key) &
+            ((endpoints["from_lat"] - from_lat).abs() <= tolerance) &
+            ((endpoints["from_lon"] - from_lon).abs() <= tolerance) &
+            ((endpoints["to_lat"] - to_lat).abs() <= tolerance) &
+            ((endpoints["to_lon"] - to_lon).abs() <= tolerance)
+        ]
+        return sorted(matches["option"])
+
+    def mode_options(self, mode_key):
+        return sorted(option for option_mode, option in self.options if option_mode == mode_key)
+
+    def fastest_mode(self):
+        """
+        Lower-cased Mode_Transport of the option with the shortest total duration.
+        """
+        if self.df.empty:
+            return None
+        durations = self.df.groupby(["mode_key", "option"])["segment_duration"].sum()
+        return durations.idxmin()[0]